@@ -0,0 +1,73 @@
+"""Compares the threaded and asyncio Datastore proxies against a
+local stub server.
+
+Usage::
+
+  python benchmarks/bench_aio.py --requests 2000 --concurrency 200 --latency 0.05
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from google.auth.credentials import Credentials
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from gcloud_requests import DatastoreRequestsProxy  # noqa: E402
+from gcloud_requests.aio import AsyncDatastoreRequestsProxy  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+
+class BenchmarkCredentials(Credentials):
+    def refresh(self, request):
+        self.token = "benchmark"
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+def bench_threaded(url, n, concurrency):
+    proxy = DatastoreRequestsProxy(credentials=BenchmarkCredentials())
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda _: proxy.request("POST", url, data=b"{}"), range(n)))
+        return time.perf_counter() - start
+
+
+def bench_async(url, n, concurrency):
+    async def main():
+        proxy = AsyncDatastoreRequestsProxy(credentials=BenchmarkCredentials())
+        limit = asyncio.Semaphore(concurrency)
+
+        async def one():
+            async with limit:
+                await proxy.request("POST", url, data=b"{}")
+
+        start = time.perf_counter()
+        await asyncio.gather(*[one() for _ in range(n)])
+        elapsed = time.perf_counter() - start
+        await proxy.close()
+        return elapsed
+
+    return asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    with StubServer(latency=args.latency) as server:
+        for name, bench in (("threaded", bench_threaded), ("asyncio", bench_async)):
+            elapsed = bench(server.url, args.requests, args.concurrency)
+            print("{:<10} {:>8.1f} req/s  ({:.2f}s)".format(name, args.requests / elapsed, elapsed))
+
+
+if __name__ == "__main__":
+    main()
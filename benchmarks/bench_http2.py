@@ -0,0 +1,70 @@
+"""Compares the HTTP/1.1 HTTPAdapter path with the HTTP/2 transport
+against local stub servers.
+
+Usage::
+
+  python benchmarks/bench_http2.py --requests 2000 --threads 64 --latency 0.02
+"""
+import argparse
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from google.auth.credentials import Credentials
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from gcloud_requests import DatastoreRequestsProxy, get_pool_manager  # noqa: E402
+from h2_server import H2StubServer  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+
+class BenchmarkCredentials(Credentials):
+    def refresh(self, request):
+        self.token = "benchmark"
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+class HTTP1DatastoreProxy(DatastoreRequestsProxy):
+    pass
+
+
+class HTTP2DatastoreProxy(DatastoreRequestsProxy):
+    HTTP2 = "prior_knowledge"
+    CONNECTION_POOL_SIZE = 4
+
+
+def bench(proxy_class, url, n, threads):
+    proxy = proxy_class(credentials=BenchmarkCredentials())
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda _: proxy.request("POST", url, data=b"{}"), range(n)))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    servers = (
+        ("http/1.1", HTTP1DatastoreProxy, StubServer(latency=args.latency)),
+        ("http/2", HTTP2DatastoreProxy, H2StubServer(latency=args.latency)),
+    )
+    for name, proxy_class, server in servers:
+        with server:
+            elapsed = bench(proxy_class, server.url, args.requests, args.threads)
+
+        print("{:<10} {:>8.1f} req/s  ({:.2f}s)".format(name, args.requests / elapsed, elapsed))
+
+    get_pool_manager().clear()
+
+
+if __name__ == "__main__":
+    main()
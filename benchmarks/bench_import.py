@@ -0,0 +1,44 @@
+"""Measures how long importing the package takes on top of importing
+requests, in fresh interpreters.
+
+Usage::
+
+  python benchmarks/bench_import.py --runs 10 --max-time 0.2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def measure():
+    code = """if True:
+        import json, time
+        import requests
+        start = time.perf_counter()
+        import gcloud_requests
+        print(json.dumps(time.perf_counter() - start))
+    """
+    return json.loads(subprocess.check_output([sys.executable, "-c", code], cwd=ROOT).decode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-time", type=float, default=None,
+                        help="Exit with an error if the fastest import takes longer than this.")
+    args = parser.parse_args()
+
+    samples = sorted(measure() for _ in range(args.runs))
+    print("min {:.1f}ms  median {:.1f}ms  max {:.1f}ms".format(
+        samples[0] * 1000, samples[len(samples) // 2] * 1000, samples[-1] * 1000,
+    ))
+    if args.max_time is not None and samples[0] > args.max_time:
+        sys.exit("Importing the package took longer than {}s.".format(args.max_time))
+
+
+if __name__ == "__main__":
+    main()
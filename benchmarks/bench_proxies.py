@@ -0,0 +1,205 @@
+"""Measures throughput, latency, CPU and memory of the Datastore, Cloud
+Storage and Pub/Sub proxies against a local stub server.
+
+Results are written as JSON so that runs can be compared across
+versions::
+
+  python benchmarks/bench_proxies.py --threads 1 8 64 --output before.json
+  git checkout some-branch
+  python benchmarks/bench_proxies.py --threads 1 8 64 --compare before.json
+
+Errors are injected with ``--error KIND=RATE``, where ``KIND`` is one of
+``ABORTED``, ``503``, ``502``, ``429`` or ``401``::
+
+  python benchmarks/bench_proxies.py --error ABORTED=0.01 --error 503=0.01
+
+Every case runs in a fresh process so that its peak RSS isn't
+inflated by the cases that ran before it.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from google.auth.credentials import Credentials
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+
+import gcloud_requests  # noqa: E402
+
+from gcloud_requests import CloudStorageRequestsProxy, DatastoreRequestsProxy  # noqa: E402
+from gcloud_requests import PubSubRequestsProxy, RetryBudget, get_pool_manager  # noqa: E402
+from stub_server import ERRORS, stub_server_process  # noqa: E402
+
+SERVICES = {
+    "datastore": (DatastoreRequestsProxy, "POST", "/v1/projects/bench:lookup"),
+    "storage": (CloudStorageRequestsProxy, "GET", "/storage/v1/b/bench/o/object?alt=media"),
+    "pubsub": (PubSubRequestsProxy, "POST", "/v1/projects/bench/topics/bench:publish"),
+}
+
+
+class BenchmarkCredentials(Credentials):
+    def refresh(self, request):
+        self.token = "benchmark"
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+def percentile(samples, p):
+    return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+
+def bench(service, base_url, n, threads, payload_size):
+    proxy_class, method, path = SERVICES[service]
+
+    # Every case gets its own proxy type, and thus its own pool and
+    # a full retry budget, so that cases don't affect one another.
+    proxy_class = type("Bench" + proxy_class.__name__, (proxy_class,), {
+        "CONNECTION_POOL_SIZE": max(threads, 1),
+        "RETRY_BUDGET": RetryBudget(),
+    })
+    proxy = proxy_class(credentials=BenchmarkCredentials())
+    url, data = base_url + path, b"x" * payload_size if method == "POST" else None
+
+    def one(_):
+        start = time.perf_counter()
+        try:
+            response = proxy.request(method, url, data=data)
+            response.content
+            ok = response.status_code < 400
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    # Warm up the connection pool and the credentials.
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(threads)))
+
+        cpu_start, start = time.process_time(), time.perf_counter()
+        results = list(pool.map(one, range(n)))
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+
+    get_pool_manager().clear()
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "service": service,
+        "threads": threads,
+        "requests": n,
+        "errors": sum(1 for _, ok in results if not ok),
+        "elapsed": elapsed,
+        "requests_per_second": n / elapsed,
+        "latency": {
+            "mean": sum(latencies) / n,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1],
+        },
+        "cpu_per_request": cpu / n,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench_in_subprocess(log_level, *args):
+    # Spawned rather than forked so that the case doesn't inherit the
+    # memory of the parent or of previous cases.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=configure_logging,
+                             initargs=(log_level,)) as executor:
+        return executor.submit(bench, *args).result()
+
+
+def configure_logging(log_level):
+    logging.basicConfig(level=log_level)
+
+
+def parse_error(value):
+    kind, _, rate = value.partition("=")
+    if kind not in ERRORS:
+        raise argparse.ArgumentTypeError("error kind must be one of {}".format(", ".join(ERRORS)))
+    return kind, float(rate)
+
+
+def compare(results, baseline):
+    cases = {(case["service"], case["threads"]): case for case in baseline["results"]}
+    print("{:<10} {:>7} {:>12} {:>12} {:>12}".format("service", "threads", "req/s", "p99", "cpu/req"))
+    for case in results:
+        before = cases.get((case["service"], case["threads"]))
+        if before is None:
+            continue
+
+        def delta(current, previous):
+            return "{:+.1f}%".format((current - previous) / previous * 100) if previous else "n/a"
+
+        print("{:<10} {:>7} {:>12} {:>12} {:>12}".format(
+            case["service"], case["threads"],
+            delta(case["requests_per_second"], before["requests_per_second"]),
+            delta(case["latency"]["p99"], before["latency"]["p99"]),
+            delta(case["cpu_per_request"], before["cpu_per_request"]),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--services", nargs="+", choices=sorted(SERVICES), default=sorted(SERVICES))
+    parser.add_argument("--threads", nargs="+", type=int, default=[1, 8, 64])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.005)
+    parser.add_argument("--payload-size", type=int, default=1024)
+    parser.add_argument("--error", type=parse_error, action="append", default=[], metavar="KIND=RATE")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="ERROR", help="the level at which proxies log, eg. WARNING")
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="print deltas against the JSON results in this file")
+    args = parser.parse_args()
+    configure_logging(args.log_level)
+
+    server_options = {
+        "latency": args.latency,
+        "errors": dict(args.error),
+        "payload_size": args.payload_size,
+        "seed": args.seed,
+    }
+    results = []
+    with stub_server_process(**server_options) as url:
+        for service in args.services:
+            for threads in args.threads:
+                result = bench_in_subprocess(
+                    args.log_level, service, url, args.requests, threads, args.payload_size,
+                )
+                results.append(result)
+                sys.stderr.write("{:<10} {:>3} threads {:>8.1f} req/s  p99 {:.4f}s  {} errors\n".format(
+                    service, threads, result["requests_per_second"], result["latency"]["p99"],
+                    result["errors"],
+                ))
+
+    report = json.dumps({
+        "version": gcloud_requests.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "options": dict(server_options, requests=args.requests),
+        "results": results,
+    }, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    elif not args.compare:
+        print(report)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""A tiny plaintext (prior knowledge) HTTP/2 stand-in for Google API
+endpoints used by the benchmarks in this directory.
+"""
+import asyncio
+import json
+import threading
+
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import ConnectionTerminated, DataReceived, RequestReceived, StreamEnded
+
+
+class H2Protocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.conn = H2Connection(config=H2Configuration(client_side=False, header_encoding="utf-8"))
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.server.connections += 1
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                asyncio.ensure_future(self.respond(event.stream_id))
+            elif isinstance(event, ConnectionTerminated):
+                self.transport.close()
+            elif isinstance(event, RequestReceived):
+                pass
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id):
+        await asyncio.sleep(self.server.latency)
+        body = json.dumps({}).encode("utf-8")
+        self.conn.send_headers(stream_id, [
+            (":status", "200"),
+            ("content-type", "application/json"),
+            ("content-length", str(len(body))),
+        ])
+        self.conn.send_data(stream_id, body, end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+
+class H2StubServer(object):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.connections = 0
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: H2Protocol(self), "127.0.0.1", 0
+        ))
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server.sockets[0].getsockname()[1])
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.server.close()
@@ -0,0 +1,163 @@
+"""A tiny local stand-in for Google API endpoints used by the
+benchmarks in this directory.
+
+Errors can be injected at random with a given rate per kind of error:
+
+* ``ABORTED``: a Datastore-style protobuf status for Datastore
+  requests and a JSON error otherwise,
+* ``503``: a 503 with an empty body,
+* ``502``: a 502 with an HTML body, like the ones returned by GFEs,
+* ``429``: a JSON ``RESOURCE_EXHAUSTED`` error,
+* ``401``: a JSON ``UNAUTHENTICATED`` error.
+"""
+import json
+import multiprocessing
+import random
+import threading
+import time
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from google.rpc import status_pb2
+
+#: The kinds of errors that can be injected.
+ERRORS = ("ABORTED", "503", "502", "429", "401")
+
+
+def _json_error(code, status):
+    return code, "application/json", json.dumps({"error": {"code": code, "status": status}}).encode("utf-8")
+
+
+def _render_error(kind, service):
+    if kind == "ABORTED":
+        if service == "datastore":
+            return 409, "application/x-protobuf", status_pb2.Status(code=10).SerializeToString()
+        return _json_error(409, "ABORTED")
+    elif kind == "503":
+        return 503, None, b""
+    elif kind == "502":
+        return 502, "text/html; charset=UTF-8", b"<html><body>502 Bad Gateway</body></html>"
+    elif kind == "429":
+        return _json_error(429, "RESOURCE_EXHAUSTED")
+    elif kind == "401":
+        return _json_error(401, "UNAUTHENTICATED")
+    raise ValueError("unknown error kind {!r}".format(kind))
+
+
+def _get_service(path):
+    if path.startswith("/storage/") or path.startswith("/upload/storage/"):
+        return "storage"
+    elif "/topics/" in path or "/subscriptions/" in path:
+        return "pubsub"
+    return "datastore"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and bodies are written separately so Nagle's algorithm
+    # would add a delayed ACK's worth of latency to every response.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._respond()
+
+    def do_POST(self):
+        self._respond()
+
+    def _respond(self):
+        length = int(self.headers.get("content-length") or 0)
+        if length:
+            self.rfile.read(length)
+
+        time.sleep(self.server.latency)
+        status, content_type, body = self.server.render(_get_service(self.path))
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """Serves successful responses after `latency` seconds, except
+    for errors injected at the rates given by `errors`.
+
+    Parameters:
+      latency(float): The number of seconds to wait before responding.
+      errors(dict): A mapping from error kinds to the ratio of
+        responses that should be that error.
+      payload_size(int): The approximate size of successful response
+        bodies in bytes.
+      seed(int): Seeds the random error injection.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.0, errors=None, payload_size=0, seed=None):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), StubHandler)
+        self.latency = latency
+        self.errors = errors or {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.payloads = {
+            "datastore": b"\0" * payload_size,
+            "storage": b"x" * payload_size,
+            "pubsub": json.dumps({"messageIds": ["1"], "padding": "x" * payload_size}).encode("utf-8"),
+        }
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def render(self, service):
+        with self.lock:
+            roll = self.random.random()
+
+        for kind, rate in sorted(self.errors.items()):
+            if roll < rate:
+                return _render_error(kind, service)
+            roll -= rate
+
+        content_type = "application/json" if service == "pubsub" else "application/octet-stream"
+        return 200, content_type, self.payloads[service]
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def _serve(connection, kwargs):
+    server = StubServer(**kwargs)
+    connection.send(server.url)
+    server.serve_forever()
+
+
+@contextmanager
+def stub_server_process(**kwargs):
+    """Run a :class:`StubServer` in a separate process so that its
+    CPU usage doesn't count against the benchmarked process.
+
+    Yields:
+      str: The server's URL.
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=_serve, args=(child, kwargs))
+    process.daemon = True
+    process.start()
+    try:
+        yield parent.recv()
+    finally:
+        process.terminate()
+        process.join()
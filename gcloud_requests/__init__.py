@@ -1,7 +1,21 @@
+from .breakers import CircuitBreaker, CircuitOpen  # noqa
+from .cache import EntityCache, LRUEntityCache  # noqa
 from .credentials_watcher import CredentialsWatcher  # noqa
-from .proxy import RequestsProxy  # noqa
+from .dns import DNSCache  # noqa
+from .hedging import HedgingPolicy  # noqa
+from .instrumentation import CompositeInstrumentation, Instrumentation, RequestCall  # noqa
+from .limits import ConcurrencyLimiter, ConcurrencyLimitExceeded  # noqa
+from .metrics import MetricsAggregator, PrometheusExporter  # noqa
+from .pools import ConnectionPoolManager  # noqa
+from .proxy import RequestsProxy, get_credentials_watcher, get_pool_manager  # noqa
+from .retries import RetryBudget  # noqa
 from .datastore import DatastoreRequestsProxy, enter_transaction, exit_transaction  # noqa
+from .publisher import PubSubPublisher  # noqa
 from .pubsub import PubSubRequestsProxy  # noqa
-from .storage import CloudStorageRequestsProxy  # noqa
+from .splits import QuerySplitter  # noqa
+from .subscriber import Message, PubSubSubscriber  # noqa
+from .storage import CloudStorageRequestsProxy, DataCorruption  # noqa
+from .token_cache import SharedTokenCache  # noqa
+from .tracing import TracingInstrumentation  # noqa
 
 __version__ = "2.0.3"
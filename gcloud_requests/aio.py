@@ -0,0 +1,248 @@
+"""Native asyncio variants of the requests proxies.
+
+These proxies require Python 3.5+ and aiohttp.  Install them with::
+
+  pip install gcloud_requests[aio]
+"""
+import asyncio
+import time
+import weakref
+
+import aiohttp
+import requests
+
+from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request as AuthRequest
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from . import proxy
+from .breakers import CircuitOpen
+from .datastore import DatastoreRequestsProxy
+from .proxy import RequestsProxy
+from .pubsub import PubSubRequestsProxy
+from .storage import CloudStorageRequestsProxy
+
+# Settings of the threaded proxies that the async proxies don't
+# implement.  Proxies that set any of them fail to construct rather
+# than silently ignoring them.
+_UNSUPPORTED_SETTINGS = (
+    "HEDGING_POLICY",
+    "CONCURRENCY_LIMITER",
+    "INSTRUMENTATION",
+    "WARM_CONNECTIONS",
+    "HTTP2",
+    "LOOKUP_BATCH_WINDOW",
+    "ENTITY_CACHE",
+    "QUERY_PREFETCH_DEPTH",
+)
+
+
+class AsyncRequestsProxy(RequestsProxy):
+    """An asyncio-compatible RequestsProxy.
+
+    Requests are made through a single :class:`aiohttp.ClientSession`
+    per event loop, so connections are pooled by the loop that owns
+    them rather than by thread.  Retry tables, 401 refresh handling
+    and error conversion are shared with :class:`.RequestsProxy`.
+
+    Responses are returned as fully-read :class:`requests.Response`
+    instances so that existing error handling keeps working, so
+    `stream=True` isn't supported.
+
+    Deadlines, the `RETRY_BUDGET` and the `CIRCUIT_BREAKER` are
+    supported.  Hedging, concurrency limiting, instrumentation,
+    connection warming, HTTP/2 and the Datastore lookup batching,
+    entity cache and query prefetching aren't.
+
+    Raises:
+      ValueError: If any of the unsupported settings are set.
+    """
+
+    def __init__(self, credentials=None, logger=None):
+        unsupported = [
+            name for name in _UNSUPPORTED_SETTINGS
+            if getattr(self, name, None) is not None and getattr(self, name) is not False
+        ]
+        if unsupported:
+            raise ValueError("Async proxies don't support {}.".format(", ".join(unsupported)))
+
+        super(AsyncRequestsProxy, self).__init__(credentials, logger)
+        self._sessions = weakref.WeakKeyDictionary()
+
+    async def request(self, method, url, data=None, headers=None, deadline=None, **kwargs):
+        if kwargs.pop("stream", False):
+            raise NotImplementedError("Async proxies can't stream responses. Use a threaded proxy instead.")
+
+        session = self._get_async_session()
+        headers = headers.copy() if headers is not None else {}
+        expires_at = self._compute_expiry(deadline)
+        if self.RETRY_BUDGET is not None:
+            self.RETRY_BUDGET.deposit()
+
+        retries, refresh_attempts = 0, 0
+        while True:
+            try:
+                token = await self._before_request(method, url, headers)
+            except RefreshError:
+                if refresh_attempts < proxy._max_refresh_attempts and not self._is_expired(expires_at):
+                    retries, refresh_attempts = 0, refresh_attempts + 1
+                    continue
+                raise
+
+            # Do not allow multiple timeout kwargs.  The session's
+            # timeouts apply unless there's a deadline.
+            kwargs.pop("timeout", None)
+            response = await self._send_async_attempt(
+                session, method, url, data, headers, expires_at, **kwargs
+            )
+            if response.status_code in proxy._refresh_status_codes and \
+               refresh_attempts < proxy._max_refresh_attempts and not self._is_expired(expires_at):
+                self.logger.info(
+                    "Refreshing credentials due to a %s response. Attempt %s/%s.",
+                    response.status_code, refresh_attempts + 1, proxy._max_refresh_attempts
+                )
+
+                try:
+                    await self._refresh(token)
+                except RefreshError:
+                    pass
+
+                # Retries intentionally get reset to 0.
+                retries, refresh_attempts = 0, refresh_attempts + 1
+                continue
+
+            elif response.status_code >= 400:
+                backoff = self._compute_retry_backoff(response, retries, expires_at)
+                if backoff is not None:
+                    await asyncio.sleep(backoff)
+                    retries += 1
+                    continue
+
+            return response
+
+    async def close(self):
+        """Close the client session owned by the running event loop.
+        """
+        session = self._sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _get_async_session(self):
+        # Ensure we use exactly one connection-pooling client session
+        # per event loop.  aiohttp sessions must not be shared across
+        # loops.  This must be called from a coroutine.
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.CONNECTION_POOL_SIZE,
+                limit_per_host=self.CONNECTION_POOL_SIZE,
+            )
+            connect_timeout, read_timeout = self.TIMEOUT_CONFIG
+            timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+            session = self._sessions[loop] = aiohttp.ClientSession(
+                connector=connector,
+                timeout=timeout,
+                auto_decompress=True,
+            )
+        return session
+
+    async def _before_request(self, method, url, headers):
+        # Credentials refreshes are made using the blocking transport
+        # so we push them onto the default executor.
+        if not self.credentials.valid:
+            await self._refresh()
+        self.credentials.apply(headers)
+        return self.credentials.token
+
+    async def _refresh(self, token=None):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None, proxy._credentials_watcher.refresh, self.credentials, AuthRequest(), token,
+        )
+
+    async def _send_async_attempt(self, session, method, url, data, headers, expires_at, **kwargs):
+        breaker = self.CIRCUIT_BREAKER
+        if breaker is None:
+            return await self._send(session, method, url, data, headers, expires_at, **kwargs)
+
+        endpoint = self._get_endpoint(method, url)
+        if not breaker.allow(endpoint):
+            raise CircuitOpen(endpoint)
+
+        try:
+            response = await self._send(session, method, url, data, headers, expires_at, **kwargs)
+        except Exception:
+            breaker.record(endpoint, False)
+            raise
+
+        breaker.record(endpoint, not self._is_endpoint_failure(response))
+        return response
+
+    async def _send(self, session, method, url, data, headers, expires_at, **kwargs):
+        # aiohttp has no equivalent of urllib3's Retry so connection
+        # errors are retried here instead, until the deadline.
+        connect_retries = 0
+        while True:
+            if expires_at is not None:
+                kwargs["timeout"] = self._compute_async_timeout(expires_at)
+
+            try:
+                async with session.request(method, url, data=data, headers=headers, **kwargs) as resp:
+                    response = requests.Response()
+                    response.status_code = resp.status
+                    response.reason = resp.reason
+                    response.url = str(resp.url)
+                    response.headers = CaseInsensitiveDict(resp.headers)
+                    response.encoding = get_encoding_from_headers(response.headers)
+                    response._content = await resp.read()
+                    return response
+            except aiohttp.ClientConnectionError:
+                if connect_retries >= self.RETRY_CONFIG.connect or self._is_expired(expires_at):
+                    raise
+
+                backoff = self._compute_backoff(connect_retries)
+                if expires_at is not None:
+                    backoff = min(backoff, max(expires_at - time.time(), 0))
+
+                connect_retries += 1
+                self.logger.warning(
+                    "Retrying request after connection error. Attempt %d/%d.",
+                    connect_retries, self.RETRY_CONFIG.connect, exc_info=True
+                )
+                await asyncio.sleep(backoff)
+
+                # Like the threaded proxies, give up with the last
+                # connection error once the deadline has passed.
+                if self._is_expired(expires_at):
+                    raise
+
+    def _compute_async_timeout(self, expires_at):
+        connect_timeout, read_timeout = self._compute_timeout(expires_at)
+        remaining = max(expires_at - time.time(), 0.001)
+        return aiohttp.ClientTimeout(total=remaining, sock_connect=connect_timeout, sock_read=read_timeout)
+
+
+class AsyncDatastoreRequestsProxy(AsyncRequestsProxy, DatastoreRequestsProxy):
+    """An asyncio-compatible DatastoreRequestsProxy.
+    """
+
+
+class AsyncCloudStorageRequestsProxy(AsyncRequestsProxy, CloudStorageRequestsProxy):
+    """An asyncio-compatible CloudStorageRequestsProxy.
+
+    The parallel :meth:`download` and :meth:`upload` helpers are only
+    available on :class:`.CloudStorageRequestsProxy`.
+    """
+
+    def download(self, *args, **kwargs):
+        raise NotImplementedError("Async proxies can't download objects. Use CloudStorageRequestsProxy.")
+
+    def upload(self, *args, **kwargs):
+        raise NotImplementedError("Async proxies can't upload files. Use CloudStorageRequestsProxy.")
+
+
+class AsyncPubSubRequestsProxy(AsyncRequestsProxy, PubSubRequestsProxy):
+    """An asyncio-compatible PubSubRequestsProxy.
+    """
@@ -0,0 +1,217 @@
+import logging
+import time
+
+from threading import Lock
+
+#: Requests are let through and their outcomes are recorded.
+CLOSED = "closed"
+
+#: Requests fail fast with :class:`.CircuitOpen`.
+OPEN = "open"
+
+#: A limited number of probe requests are let through to find out
+#: whether the endpoint has recovered.
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """Raised when a request is rejected because the circuit for its
+    endpoint is open.
+    """
+
+    def __init__(self, endpoint):
+        super(CircuitOpen, self).__init__("The circuit for {!r} is open.".format(endpoint))
+        self.endpoint = endpoint
+
+
+class _Circuit(object):
+    def __init__(self, buckets):
+        self.state = CLOSED
+        self.opened_at = None
+        self.probes = 0
+        self.probe_successes = 0
+        # Each bucket is a list of [start time, requests, failures].
+        self.buckets = [[0, 0, 0] for _ in range(buckets)]
+
+
+class CircuitBreaker(object):
+    """Tracks the health of every endpoint a proxy talks to and fails
+    requests to unhealthy endpoints fast.
+
+    An endpoint's circuit opens when at least `failure_rate` of the
+    requests made to it over the last `window` seconds have failed,
+    provided there were at least `min_requests` of them.  After
+    `open_duration` seconds, up to `half_open_probes` requests are let
+    through.  The circuit closes once all of them succeed and opens
+    again as soon as one of them fails.
+
+    Parameters:
+      failure_rate(float): The ratio of failed requests at which
+        circuits open.
+      min_requests(int): The min number of requests in the window
+        before a circuit may open.
+      window(float): The length of the rolling window in seconds.
+      open_duration(float): The number of seconds circuits stay open
+        for before letting probes through.
+      half_open_probes(int): The number of probes to let through.
+    """
+
+    # The number of buckets the rolling window is divided into.
+    _BUCKETS = 10
+
+    def __init__(self, failure_rate=0.5, min_requests=20, window=10, open_duration=5, half_open_probes=1,
+                 logger=None):
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.window = window
+        self.open_duration = open_duration
+        self.half_open_probes = half_open_probes
+        self.logger = logger or logging.getLogger("gcloud_requests.CircuitBreaker")
+
+        self._lock = Lock()
+        self._circuits = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Register a function to be called whenever a circuit changes
+        state.  Listeners are called with the endpoint, its previous
+        state and its new state.
+
+        Parameters:
+          listener(callable)
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Unregister a listener.
+
+        Parameters:
+          listener(callable)
+        """
+        self._listeners.remove(listener)
+
+    def allow(self, endpoint):
+        """Check whether a request to an endpoint may go ahead.  Every
+        allowed request must be followed by a call to :meth:`record`.
+
+        Parameters:
+          endpoint(tuple)
+
+        Returns:
+          bool
+        """
+        transition = None
+        with self._lock:
+            circuit = self._get_circuit(endpoint)
+            if circuit.state == OPEN:
+                if time.time() < circuit.opened_at + self.open_duration:
+                    return False
+
+                transition = self._transition(endpoint, circuit, HALF_OPEN)
+
+            if circuit.state == HALF_OPEN:
+                if circuit.probes >= self.half_open_probes:
+                    allowed = False
+                else:
+                    circuit.probes += 1
+                    allowed = True
+            else:
+                allowed = True
+
+        self._notify(transition)
+        return allowed
+
+    def record(self, endpoint, success):
+        """Record the outcome of a request to an endpoint.
+
+        Parameters:
+          endpoint(tuple)
+          success(bool): Whether or not the request succeeded, or None
+            if it was cancelled before it had an outcome, in which case
+            it isn't counted and any probe it used is given back.
+        """
+        transition = None
+        with self._lock:
+            circuit = self._get_circuit(endpoint)
+            if success is None:
+                if circuit.state == HALF_OPEN and circuit.probes:
+                    circuit.probes -= 1
+
+            elif circuit.state == HALF_OPEN:
+                if not success:
+                    transition = self._transition(endpoint, circuit, OPEN)
+                else:
+                    circuit.probe_successes += 1
+                    if circuit.probe_successes >= self.half_open_probes:
+                        transition = self._transition(endpoint, circuit, CLOSED)
+
+            elif circuit.state == CLOSED:
+                bucket = self._get_bucket(circuit)
+                bucket[1] += 1
+                bucket[2] += not success
+                requests, failures = self._count(circuit)
+                if not success and requests >= self.min_requests and \
+                   failures >= requests * self.failure_rate:
+                    transition = self._transition(endpoint, circuit, OPEN)
+
+        self._notify(transition)
+
+    def stats(self):
+        """Get the state of every circuit.
+
+        Returns:
+          dict: A mapping from endpoints to dicts containing their
+          `state` and the number of `requests` and `failures` in the
+          current window.
+        """
+        with self._lock:
+            stats = {}
+            for endpoint, circuit in self._circuits.items():
+                requests, failures = self._count(circuit)
+                stats[endpoint] = {"state": circuit.state, "requests": requests, "failures": failures}
+            return stats
+
+    def _get_circuit(self, endpoint):
+        circuit = self._circuits.get(endpoint)
+        if circuit is None:
+            circuit = self._circuits[endpoint] = _Circuit(self._BUCKETS)
+        return circuit
+
+    def _get_bucket(self, circuit):
+        width = float(self.window) / self._BUCKETS
+        start = time.time() // width * width
+        bucket = circuit.buckets[int(start // width) % self._BUCKETS]
+        if bucket[0] != start:
+            bucket[:] = [start, 0, 0]
+        return bucket
+
+    def _count(self, circuit):
+        cutoff = time.time() - self.window
+        requests = failures = 0
+        for start, bucket_requests, bucket_failures in circuit.buckets:
+            if start > cutoff:
+                requests += bucket_requests
+                failures += bucket_failures
+        return requests, failures
+
+    def _transition(self, endpoint, circuit, state):
+        previous_state, circuit.state = circuit.state, state
+        circuit.probes = circuit.probe_successes = 0
+        if state == OPEN:
+            circuit.opened_at = time.time()
+        elif state == CLOSED:
+            for bucket in circuit.buckets:
+                bucket[:] = [0, 0, 0]
+        return endpoint, previous_state, state
+
+    def _notify(self, transition):
+        if transition is None:
+            return
+
+        endpoint, previous_state, state = transition
+        self.logger.warning("Circuit for %r went from %s to %s.", endpoint, previous_state, state)
+        for listener in list(self._listeners):
+            try:
+                listener(endpoint, previous_state, state)
+            except Exception:
+                self.logger.exception("Circuit breaker listener %r failed.", listener)
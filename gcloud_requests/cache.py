@@ -0,0 +1,204 @@
+import time
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class EntityCache(object):
+    """Base class for Datastore entity caches.
+
+    Keys and values are both byte strings: keys are serialized
+    Datastore keys and values are serialized entity results.  To plug
+    in an external backend (memcached, redis, etc.), subclass this and
+    implement :meth:`_get_many`, :meth:`_set_many` and
+    :meth:`_delete_many`.  Hit, miss and eviction counters are kept by
+    this class.
+
+    Reads that may be cached are bracketed by :meth:`begin_read` and
+    :meth:`end_read`.  Keys that are invalidated while a read is in
+    progress aren't cached by it, since it may have read them before
+    the write that invalidated them.  Reads are only tracked within
+    the current process.
+    """
+
+    def __init__(self):
+        self._stats_lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Every read and invalidation is stamped with the next version.
+        # Invalidations are only remembered while there are reads in
+        # progress that started before them.
+        self._versions_lock = Lock()
+        self._version = 0
+        self._reads = OrderedDict()
+        self._invalidated = {}
+
+    def get_many(self, keys):
+        """Get the cached values for the given keys.
+
+        Parameters:
+          keys(list[bytes])
+
+        Returns:
+          dict: A mapping from the keys that were found to their values.
+        """
+        values = self._get_many(keys)
+        with self._stats_lock:
+            self.hits += len(values)
+            self.misses += len(keys) - len(values)
+        return values
+
+    def set_many(self, values, version=None):
+        """Cache the given values.
+
+        Parameters:
+          values(dict): A mapping from keys to values.
+          version(int): The version returned by :meth:`begin_read`
+            when the values were read.  Keys that have been invalidated
+            since then are skipped.
+        """
+        with self._versions_lock:
+            if version is not None:
+                values = {
+                    key: value for key, value in values.items()
+                    if self._invalidated.get(key, 0) < version
+                }
+
+            # Values are written while holding the lock so that they
+            # can't land after an invalidation that's meant to skip them.
+            if values:
+                self._set_many(values)
+
+    def delete_many(self, keys):
+        """Invalidate the given keys.
+
+        Parameters:
+          keys(list[bytes])
+        """
+        with self._versions_lock:
+            if self._reads:
+                self._version += 1
+                for key in keys:
+                    self._invalidated[key] = self._version
+
+            self._delete_many(keys)
+
+    def begin_read(self):
+        """Start a read whose results are going to be cached.  Every
+        call must be followed by a call to :meth:`end_read`.
+
+        Returns:
+          int: The version to pass to :meth:`set_many`.
+        """
+        with self._versions_lock:
+            self._version += 1
+            self._reads[self._version] = True
+            return self._version
+
+    def end_read(self, version):
+        """Finish a read started by :meth:`begin_read`.
+
+        Parameters:
+          version(int)
+        """
+        with self._versions_lock:
+            oldest = next(iter(self._reads))
+            del self._reads[version]
+            if not self._reads:
+                self._invalidated = {}
+            elif version == oldest:
+                oldest = next(iter(self._reads))
+                self._invalidated = {
+                    key: invalidated for key, invalidated in self._invalidated.items()
+                    if invalidated > oldest
+                }
+
+    def stats(self):
+        """Get this cache's hit, miss and eviction counts.
+
+        Returns:
+          dict
+        """
+        with self._stats_lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _record_evictions(self, count):
+        with self._stats_lock:
+            self.evictions += count
+
+    def _get_many(self, keys):  # pragma: no cover
+        raise NotImplementedError
+
+    def _set_many(self, values):  # pragma: no cover
+        raise NotImplementedError
+
+    def _delete_many(self, keys):  # pragma: no cover
+        raise NotImplementedError
+
+
+class LRUEntityCache(EntityCache):
+    """A thread-safe in-process entity cache.
+
+    Entries expire `ttl` seconds after they're written and the least
+    recently used entries are evicted once the cache holds more than
+    `max_bytes` bytes of keys and values.
+
+    Parameters:
+      max_bytes(int): The max size of the cache in bytes.
+      ttl(float): The number of seconds entries are valid for.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl=60):
+        super(LRUEntityCache, self).__init__()
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._lock = Lock()
+        self._entries = OrderedDict()
+
+    def _get_many(self, keys):
+        values, now, expired = {}, time.time(), 0
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+
+                expires_at, value = entry
+                if expires_at <= now:
+                    self._remove(key)
+                    expired += 1
+                    continue
+
+                # Move the entry to the most recently used end.
+                self._entries[key] = self._entries.pop(key)
+                values[key] = value
+
+        self._record_evictions(expired)
+        return values
+
+    def _set_many(self, values):
+        expires_at, evicted = time.time() + self.ttl, 0
+        with self._lock:
+            for key, value in values.items():
+                self._remove(key)
+                self._entries[key] = (expires_at, value)
+                self.size += len(key) + len(value)
+
+            while self.size > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                evicted += 1
+
+        self._record_evictions(evicted)
+
+    def _delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remove(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(key) + len(entry[1])
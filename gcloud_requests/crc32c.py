@@ -0,0 +1,128 @@
+"""CRC32C checksums as used by Google Cloud Storage.
+
+The C implementation from ``google-crc32c`` is used when it's
+installed.  Otherwise, a (much slower) pure-Python table-driven
+implementation is used.
+"""
+import base64
+import struct
+
+try:
+    import google_crc32c
+except ImportError:  # pragma: no cover
+    google_crc32c = None
+
+_POLY = 0x82F63B78
+_SLICE_SIZE = 1024 * 1024
+
+
+def _make_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ _POLY if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_TABLE = _make_table()
+
+
+def extend(crc, data):
+    """Extend a CRC32C checksum with more data.
+
+    Parameters:
+      crc(int): The checksum of the data seen so far, or 0.
+      data(bytes): A bytes-like object.
+
+    Returns:
+      int
+    """
+    if google_crc32c is not None:
+        if isinstance(data, bytes):
+            return google_crc32c.extend(crc, data)
+
+        # google_crc32c only accepts bytes so other buffers are copied
+        # a slice at a time to keep memory use flat.
+        view = memoryview(data)
+        for start in range(0, len(view), _SLICE_SIZE):
+            crc = google_crc32c.extend(crc, view[start:start + _SLICE_SIZE].tobytes())
+        return crc
+
+    crc ^= 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = _TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def combine(crc1, crc2, length2):
+    """Compute the checksum of two concatenated blocks of data given
+    each block's checksum and the length of the second block.
+
+    This is zlib's ``crc32_combine`` for the CRC32C polynomial.
+
+    Parameters:
+      crc1(int): The checksum of the first block.
+      crc2(int): The checksum of the second block.
+      length2(int): The length of the second block.
+
+    Returns:
+      int
+    """
+    if length2 == 0:
+        return crc1
+
+    def times(matrix, vector):
+        result, i = 0, 0
+        while vector:
+            if vector & 1:
+                result ^= matrix[i]
+            vector >>= 1
+            i += 1
+        return result
+
+    def square(matrix):
+        return [times(matrix, matrix[n]) for n in range(32)]
+
+    # The operator for a single zero bit followed by the operators
+    # for two and four zero bits.
+    odd = [_POLY] + [1 << n for n in range(31)]
+    even = square(odd)
+    odd = square(even)
+
+    while True:
+        even = square(odd)
+        if length2 & 1:
+            crc1 = times(even, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+        odd = square(even)
+        if length2 & 1:
+            crc1 = times(odd, crc1)
+        length2 >>= 1
+        if not length2:
+            break
+
+    return crc1 ^ crc2
+
+
+def decode(value):
+    """Decode a base64-encoded, big-endian CRC32C checksum as found in
+    GCS object metadata.
+
+    Returns:
+      int
+    """
+    return struct.unpack(">I", base64.b64decode(value))[0]
+
+
+def encode(crc):
+    """Encode a CRC32C checksum the way GCS expects it.
+
+    Returns:
+      str
+    """
+    return base64.b64encode(struct.pack(">I", crc)).decode("ascii")
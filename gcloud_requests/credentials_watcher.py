@@ -1,27 +1,105 @@
+import atexit
+import heapq
+import itertools
 import logging
+import os
+import random
+import time
+import weakref
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
-from google.auth.exceptions import RefreshError
-from google.auth.transport.requests import Request as AuthRequest
-from threading import Condition, Thread
+from threading import Condition, Lock, Thread
 
 
 #: The max number of seconds to wait between refresh attempts.
 MAX_WAIT_TIME = 3600
 
+#: The max number of seconds to wait before retrying credentials
+#: that failed to refresh.
+MAX_RETRY_WAIT_TIME = 60
+
+# Every watcher in the process, so that they can be restarted in
+# forked children.
+_watchers = weakref.WeakSet()
+
+
+class _Entry(object):
+    """A watched credentials object and the number of times it's
+    been watched.
+    """
+
+    __slots__ = ["credentials", "refs", "scheduled_at", "expiry", "failures"]
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.refs = 1
+        self.scheduled_at = None
+        self.expiry = None
+        self.failures = 0
+
 
 class CredentialsWatcher(Thread):
     """Watches Credentials objects in a background thread,
     periodically refreshing them.
+
+    Credentials are kept in a queue ordered by expiry so the watcher
+    only wakes up when something needs refreshing.  Credentials shared
+    between many proxies are only tracked once and stop being watched
+    once every proxy has unwatched them.  Refreshes run on a small
+    pool of worker threads so that one slow token endpoint doesn't
+    hold up the rest.
+
+    Tokens are refreshed ahead of their expiry, once `refresh_fraction`
+    of their remaining lifetime has passed, minus up to
+    `refresh_jitter` of it at random so that processes started together
+    don't all refresh at once.  Every refresh, whether it's made by the
+    watcher or by a proxy, goes through :meth:`refresh` so there's at
+    most one refresh in flight per credentials object.
+
+    The background thread is started the first time credentials are
+    watched.  Forked child processes get a fresh thread that keeps
+    watching the credentials the parent was watching.
+
+    When a :class:`.SharedTokenCache` is set, refreshes first look for
+    a token published by another process and publish the tokens they
+    fetch themselves.
+
+    Parameters:
+      max_workers(int): The max number of concurrent refreshes.
+      refresh_fraction(float): The fraction of a token's lifetime
+        after which it gets refreshed.
+      refresh_jitter(float): The max fraction of a token's lifetime
+        by which refreshes are randomly brought forward.
+      token_cache(SharedTokenCache): An optional cache to share
+        tokens with other processes through.
     """
 
-    def __init__(self):
+    def __init__(self, max_workers=4, refresh_fraction=0.75, refresh_jitter=0.05, token_cache=None):
         super(CredentialsWatcher, self).__init__()
-        self.setDaemon(True)
+        self.daemon = True
+        self.running = True
+        self.refresh_fraction = refresh_fraction
+        self.refresh_jitter = refresh_jitter
+        self.token_cache = token_cache
         self.watch_list_updated = Condition()
-        self.watch_list = []
         self.logger = logging.getLogger("gcloud_requests.CredentialsWatcher")
-        self.start()
+        self._entries = {}
+        self._schedule = []
+        self._counter = itertools.count()
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._refreshes_lock = Lock()
+        self._refreshes = {}
+        self._launched = False
+        _watchers.add(self)
+
+    @property
+    def watch_list(self):
+        """list: The credentials being watched.
+        """
+        with self.watch_list_updated:
+            return [entry.credentials for entry in self._entries.values()]
 
     def stop(self):
         self.logger.debug("Stopping watcher...")
@@ -29,12 +107,14 @@ class CredentialsWatcher(Thread):
             self.running = False
             self.watch_list_updated.notify()
 
-        self.logger.debug("Joining on watcher...")
-        self.join()
+        if self._launched:
+            self.logger.debug("Joining on watcher...")
+            self.join()
+
+        self._executor.shutdown(wait=False)
         self.logger.debug("Watcher successfully stopped.")
 
     def run(self):
-        self.running = True
         with self.watch_list_updated:
             while self.running:
                 self.logger.debug("Ticking...")
@@ -44,20 +124,28 @@ class CredentialsWatcher(Thread):
                 self.watch_list_updated.wait(timeout=wait_time)
 
     def tick(self):
-        wait_time = MAX_WAIT_TIME
-        for credentials in self.watch_list:
-            try:
-                self._try_refresh(credentials)
-
-                if credentials.expiry:
-                    # We don't need to skew this value backward because of
-                    # https://github.com/GoogleCloudPlatform/google-auth-library-python/blob/9281ca026019869bc5fb10ee288a5cd9e837808f/google/auth/credentials.py#L62
-                    delta = (credentials.expiry - datetime.utcnow()).total_seconds()
-                    wait_time = min(wait_time, delta)
-            except Exception:
-                self.logger.exception("Unexpected error processing credentials %r.", credentials)
-                self.watch_list.remove(credentials)
-        return wait_time
+        """Hand every due entry off to a refresh worker.  Must be
+        called while holding `watch_list_updated`.
+
+        Returns:
+          float: The number of seconds until the next entry is due.
+        """
+        now = time.time()
+        while self._schedule and self._schedule[0][0] <= now:
+            scheduled_at, _, entry = heapq.heappop(self._schedule)
+            if self._is_current(entry, scheduled_at):
+                entry.scheduled_at = None
+                try:
+                    self._executor.submit(self._refresh, entry)
+                except RuntimeError:
+                    # The executor stops taking work once the
+                    # interpreter starts shutting down.
+                    self.running = False
+                    return 0
+
+        if self._schedule:
+            return min(self._schedule[0][0] - now, MAX_WAIT_TIME)
+        return MAX_WAIT_TIME
 
     def watch(self, credentials):
         # Eagerly refresh the given credentials so that all the
@@ -65,20 +153,200 @@ class CredentialsWatcher(Thread):
         # This avoids deadlocking due to runtime imports in Python 2.x.
         # See also: https://github.com/requests/requests/issues/2925
         # And: https://bugs.python.org/issue10923
+        import google.auth.exceptions  # noqa
+        import google.auth.transport.requests  # noqa
+
         self._try_refresh(credentials)
         with self.watch_list_updated:
-            self.watch_list.append(credentials)
+            if not self._launched and self.running:
+                self._launched = True
+                self.start()
+                atexit.register(self.stop)
+
+            entry = self._entries.get(id(credentials))
+            if entry is not None:
+                entry.refs += 1
+                return
+
+            entry = self._entries[id(credentials)] = _Entry(credentials)
+            self._schedule_entry(entry, 0)
             self.watch_list_updated.notify()
 
     def unwatch(self, credentials):
         with self.watch_list_updated:
-            self.watch_list.remove(credentials)
-            self.watch_list_updated.notify()
+            entry = self._entries.get(id(credentials))
+            if entry is None:
+                return
+
+            entry.refs -= 1
+            if entry.refs == 0:
+                self._remove(entry)
+
+    def refresh(self, credentials, request=None, token=None):
+        """Refresh the given credentials.  If they're already being
+        refreshed by another thread, wait for that refresh instead.
+
+        Parameters:
+          credentials(google.auth.credentials.Credentials)
+          request(google.auth.transport.Request): The transport to
+            refresh with.
+          token(str): The token the caller had rejected, if any.  If
+            the credentials no longer hold this token, they've already
+            been refreshed and aren't refreshed again.
+
+        Raises:
+          RefreshError: If the refresh fails.
+
+        Returns:
+          bool: False if the credentials had already been refreshed
+          since `token` was rejected, True otherwise.
+        """
+        with self._refreshes_lock:
+            if token is not None and credentials.token != token:
+                return False
+
+            future = self._refreshes.get(id(credentials))
+            if future is not None:
+                owner = False
+            else:
+                owner, future = True, Future()
+                self._refreshes[id(credentials)] = future
+
+        if not owner:
+            self.logger.debug("Waiting on in-flight refresh of credentials %r...", credentials)
+            future.result()
+            return True
+
+        if request is None:
+            from google.auth.transport.requests import Request as AuthRequest
+            request = AuthRequest()
+
+        try:
+            self._refresh_through_cache(credentials, request)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            with self._refreshes_lock:
+                del self._refreshes[id(credentials)]
+        return True
+
+    def _refresh_through_cache(self, credentials, request):
+        token_cache = self.token_cache
+        if token_cache is None or not token_cache.enabled:
+            self.logger.debug("Refreshing credentials %r...", credentials)
+            return credentials.refresh(request)
+
+        # The lock is held across the refresh so that processes
+        # waiting on it pick up the new token rather than fetch one.
+        with token_cache.lock():
+            if token_cache.load(credentials):
+                return
+
+            self.logger.debug("Refreshing credentials %r...", credentials)
+            credentials.refresh(request)
+            token_cache.store(credentials)
+
+    def _refresh(self, entry):
+        credentials = entry.credentials
+        try:
+            # Refresh tokens proactively once they come due, unless
+            # somebody else has refreshed them in the mean time.
+            due = entry.expiry is not None and credentials.expiry == entry.expiry
+            if (self._force_refresh(credentials) if due else self._try_refresh(credentials)) \
+               and credentials.valid:
+                entry.failures = 0
+                entry.expiry = credentials.expiry
+                delay = self._compute_delay(credentials)
+            else:
+                entry.failures += 1
+                delay = min(2 ** (entry.failures - 1), MAX_RETRY_WAIT_TIME)
+        except Exception:
+            self.logger.exception("Unexpected error processing credentials %r.", credentials)
+            with self.watch_list_updated:
+                self._remove(entry)
+            return
+
+        with self.watch_list_updated:
+            if self._entries.get(id(credentials)) is entry:
+                self._schedule_entry(entry, delay)
+                self.watch_list_updated.notify()
+
+    def _compute_delay(self, credentials):
+        if not credentials.expiry:
+            return MAX_WAIT_TIME
+
+        # The remaining lifetime stands in for the whole lifetime, which
+        # isn't known.  The two are close since tokens are rescheduled
+        # right after they're refreshed.
+        delta = (credentials.expiry - datetime.utcnow()).total_seconds()
+        fraction = self.refresh_fraction - random.uniform(0, self.refresh_jitter)
+        return min(max(delta * fraction, 0), MAX_WAIT_TIME)
+
+    def _schedule_entry(self, entry, delay):
+        entry.scheduled_at = time.time() + delay
+        heapq.heappush(self._schedule, (entry.scheduled_at, next(self._counter), entry))
+
+    def _remove(self, entry):
+        if self._entries.get(id(entry.credentials)) is not entry:
+            return
+
+        del self._entries[id(entry.credentials)]
+        entry.scheduled_at = None
+
+        # Removed entries are skipped lazily when they come due, so the
+        # schedule is only compacted once it's mostly stale.
+        if len(self._schedule) > 2 * len(self._entries) + 16:
+            self._schedule = [item for item in self._schedule if self._is_current(item[2], item[0])]
+            heapq.heapify(self._schedule)
+
+    def _is_current(self, entry, scheduled_at):
+        return self._entries.get(id(entry.credentials)) is entry and entry.scheduled_at == scheduled_at
+
+    def _reinit_after_fork(self):
+        # Only the thread that forked survives in the child, so the
+        # watcher and worker threads are gone along with any refreshes
+        # they had in flight and any locks they were holding.  Thread
+        # objects can't be restarted so this one gets reinitialized.
+        launched = self._launched
+        super(CredentialsWatcher, self).__init__()
+        self.daemon = True
+        self.watch_list_updated = Condition()
+        self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+        self._refreshes_lock = Lock()
+        self._refreshes = {}
+        self._launched = False
+
+        for entry in self._entries.values():
+            if entry.scheduled_at is None:
+                self._schedule_entry(entry, 0)
+
+        if launched and self.running:
+            self._launched = True
+            self.start()
 
     def _try_refresh(self, credentials):
         if not credentials.valid:
-            try:
-                self.logger.debug("Refreshing credentials %r...", credentials)
-                credentials.refresh(AuthRequest())
-            except RefreshError:
-                self.logger.warning("Failed to refresh credentials...", exc_info=True)
+            return self._force_refresh(credentials)
+        return True
+
+    def _force_refresh(self, credentials):
+        from google.auth.exceptions import RefreshError
+
+        try:
+            self.refresh(credentials)
+        except RefreshError:
+            self.logger.warning("Failed to refresh credentials...", exc_info=True)
+            return False
+        return True
+
+
+def _reinit_after_fork():
+    for watcher in list(_watchers):
+        watcher._reinit_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
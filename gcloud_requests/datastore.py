@@ -1,6 +1,8 @@
 from threading import local
 
+from .lookups import LookupBatcher, build_response, replace_content
 from .proxy import RequestsProxy
+from .queries import QueryPrefetcher
 
 _state = local()
 
@@ -33,6 +35,9 @@ class DatastoreRequestsProxy(RequestsProxy):
 
     SCOPE = ("https://www.googleapis.com/auth/datastore",)
 
+    #: The base URL of the Datastore API.
+    API_URL = "https://datastore.googleapis.com"
+
     # A mapping from Datastore error states that can be retried to the
     # maximum number of times each one should be retried.
     _MAX_RETRIES = {
@@ -43,6 +48,176 @@ class DatastoreRequestsProxy(RequestsProxy):
         "DEADLINE_EXCEEDED": 5,
     }
 
+    #: The max number of seconds to hold concurrent lookups for so
+    #: that they can be coalesced into a single RPC.  Lookup batching
+    #: is disabled when this is None.  Requires google-cloud-datastore.
+    LOOKUP_BATCH_WINDOW = None
+
+    #: The max number of keys to send in a single coalesced lookup.
+    LOOKUP_BATCH_MAX_KEYS = 1000
+
+    #: An :class:`.EntityCache` used to answer lookups without making
+    #: RPCs.  Keys are invalidated whenever they're committed and
+    #: lookups made inside transactions always bypass the cache.
+    #: Lookups that overlap a commit of the same keys from this
+    #: process don't cache them, but commits made by other processes
+    #: are only seen once the entries expire.
+    #: Requires google-cloud-datastore.
+    ENTITY_CACHE = None
+
+    #: The max number of query result pages to fetch ahead of the
+    #: caller while it pages through a query.  Prefetching is disabled
+    #: when this is None.  Requires google-cloud-datastore.
+    QUERY_PREFETCH_DEPTH = None
+
+    #: The max number of seconds to keep prefetched pages that the
+    #: caller hasn't asked for yet.
+    QUERY_PREFETCH_TIMEOUT = 30
+
+    def __init__(self, credentials=None, logger=None):
+        super(DatastoreRequestsProxy, self).__init__(credentials, logger)
+        self._lookup_batcher = None
+        if self.LOOKUP_BATCH_WINDOW is not None:
+            self._lookup_batcher = LookupBatcher(
+                super(DatastoreRequestsProxy, self).request,
+                window=self.LOOKUP_BATCH_WINDOW,
+                max_keys=self.LOOKUP_BATCH_MAX_KEYS,
+                logger=self.logger,
+            )
+
+        self._query_prefetcher = None
+        if self.QUERY_PREFETCH_DEPTH is not None:
+            self._query_prefetcher = QueryPrefetcher(
+                super(DatastoreRequestsProxy, self).request,
+                depth=self.QUERY_PREFETCH_DEPTH,
+                timeout=self.QUERY_PREFETCH_TIMEOUT,
+                logger=self.logger,
+            )
+
+        self._datastore_pb2 = None
+        if self._lookup_batcher is not None or self._query_prefetcher is not None or \
+           self.ENTITY_CACHE is not None:
+            # The Datastore protos are only available when
+            # google-cloud-datastore is installed.
+            from google.cloud.datastore_v1.proto import datastore_pb2
+            self._datastore_pb2 = datastore_pb2
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        if self._datastore_pb2 is not None and method == "POST" and not kwargs:
+            if url.endswith(":lookup") and get_transactions() == 0:
+                lookup_request = self._parse_request(self._datastore_pb2.LookupRequest, data)
+                if lookup_request is not None and not lookup_request.read_options.transaction:
+                    return self._lookup(url, lookup_request, headers)
+
+            elif url.endswith(":commit") and self.ENTITY_CACHE is not None:
+                commit_request = self._parse_request(self._datastore_pb2.CommitRequest, data)
+                if commit_request is not None:
+                    return self._commit(url, commit_request, data, headers)
+
+            elif url.endswith(":runQuery") and self._query_prefetcher is not None and get_transactions() == 0:
+                query_request = self._parse_request(self._datastore_pb2.RunQueryRequest, data)
+                if query_request is not None and self._query_prefetcher.can_prefetch(query_request):
+                    return self._query_prefetcher.run_query(url, query_request, headers)
+
+        return super(DatastoreRequestsProxy, self).request(method, url, data=data, headers=headers, **kwargs)
+
+    def _lookup(self, url, request, headers):
+        cache, cached = self.ENTITY_CACHE, {}
+        if cache is not None:
+            cache_keys = [self._cache_key(request.project_id, key) for key in request.keys]
+            cached = cache.get_many(cache_keys)
+            if cached:
+                remaining = [
+                    key for key, cache_key in zip(request.keys, cache_keys)
+                    if cache_key not in cached
+                ]
+                if not remaining:
+                    data = self._datastore_pb2.LookupResponse()
+                    self._add_cached_results(data, cached)
+                    return build_response(url, data.SerializeToString())
+
+                request = self._datastore_pb2.LookupRequest(
+                    project_id=request.project_id,
+                    read_options=request.read_options,
+                    keys=remaining,
+                )
+
+        if cache is None:
+            return self._send_lookup(url, request, headers)
+
+        version = cache.begin_read()
+        try:
+            response = self._send_lookup(url, request, headers)
+            if response.status_code != 200:
+                return response
+
+            data = self._datastore_pb2.LookupResponse.FromString(response.content)
+            cache.set_many({
+                self._cache_key(request.project_id, result.entity.key): result.SerializeToString()
+                for result in data.found
+            }, version=version)
+        finally:
+            cache.end_read(version)
+
+        if not cached:
+            return response
+
+        self._add_cached_results(data, cached)
+        return replace_content(response, data.SerializeToString())
+
+    def _send_lookup(self, url, request, headers):
+        if self._lookup_batcher is not None and self._lookup_batcher.can_batch(request):
+            return self._lookup_batcher.lookup(url, request, headers)
+
+        return super(DatastoreRequestsProxy, self).request(
+            "POST", url, data=request.SerializeToString(), headers=headers
+        )
+
+    def _add_cached_results(self, data, cached):
+        for value in cached.values():
+            data.found.add().ParseFromString(value)
+
+    def _commit(self, url, request, data, headers):
+        keys = []
+        for mutation in request.mutations:
+            operation = mutation.WhichOneof("operation")
+            if operation == "delete":
+                keys.append(self._cache_key(request.project_id, mutation.delete))
+            elif operation is not None:
+                keys.append(self._cache_key(request.project_id, getattr(mutation, operation).key))
+
+        # Keys are invalidated before the commit so that nothing reads
+        # them from the cache while it's in flight, and again after it
+        # so that lookups that were in flight alongside it, and may
+        # have read the old entities, don't cache them.
+        self.ENTITY_CACHE.delete_many(keys)
+        try:
+            return super(DatastoreRequestsProxy, self).request("POST", url, data=data, headers=headers)
+        finally:
+            self.ENTITY_CACHE.delete_many(keys)
+
+    def _cache_key(self, project_id, key):
+        # Datastore fills in the project id on returned keys so we
+        # normalize it before serializing.
+        key_copy = type(key)()
+        key_copy.CopyFrom(key)
+        key_copy.partition_id.project_id = project_id
+        return key_copy.SerializeToString(deterministic=True)
+
+    def _parse_request(self, message_class, data):
+        try:
+            return message_class.FromString(data)
+        except Exception:
+            self.logger.debug("Failed to parse %s.", message_class.__name__, exc_info=True)
+            return None
+
+    def _is_hedgeable(self, method, url):
+        # Lookups and queries are reads, but reads inside transactions
+        # take locks so they're never hedged.
+        if method == "POST" and url.endswith((":lookup", ":runQuery")):
+            return get_transactions() == 0
+        return super(DatastoreRequestsProxy, self)._is_hedgeable(method, url)
+
     def _convert_response_to_error(self, response):
         content_type = response.headers.get("content-type", "")
         if response.status_code == 502 and content_type.startswith("text/html"):
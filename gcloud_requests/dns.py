@@ -0,0 +1,99 @@
+"""Host name resolution for new connections.
+
+Every new connection normally looks its host up again, which is slow
+when the resolver is and leaves connections to the same host all
+pointing at whichever address the resolver happened to put first.
+"""
+import itertools
+import logging
+import socket
+import time
+
+from requests.packages.urllib3.util.connection import allowed_gai_family
+from requests.packages.urllib3.util.ssl_ import is_ipaddress
+from threading import Lock
+
+
+class _Entry(object):
+    __slots__ = ["addresses", "expires_at", "counter"]
+
+    def __init__(self, addresses, expires_at):
+        self.addresses = addresses
+        self.expires_at = expires_at
+        self.counter = itertools.count()
+
+
+class DNSCache(object):
+    """Caches the addresses host names resolve to for `ttl` seconds.
+    New connections to a host are spread across all of its addresses
+    in turn.
+
+    Set it on the :class:`.ConnectionPoolManager` to have new
+    connections resolve their hosts through it::
+
+      get_pool_manager().dns_cache = DNSCache(ttl=60)
+
+    When a lookup fails, the addresses from the last successful lookup
+    are used for up to `max_stale` more seconds.
+
+    Parameters:
+      ttl(float): The number of seconds to cache addresses for.
+      max_stale(float): The max number of seconds past their TTL that
+        addresses may be used for when lookups fail.
+    """
+
+    def __init__(self, ttl=60, max_stale=300, logger=None):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.logger = logger or logging.getLogger("gcloud_requests.DNSCache")
+        self._lock = Lock()
+        self._entries = {}
+
+    def resolve(self, host, port):
+        """Get an address to connect to for the given host.
+
+        Parameters:
+          host(str)
+          port(int)
+
+        Returns:
+          str: An IP address or, if the host couldn't be resolved, the
+          host itself so that connecting fails as it normally would.
+        """
+        if is_ipaddress(host):
+            return host
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((host, port))
+
+        if entry is None or entry.expires_at <= now:
+            try:
+                addresses = self._lookup(host, port)
+            except socket.error:
+                if entry is None or entry.expires_at + self.max_stale <= now:
+                    return host
+
+                self.logger.warning("Failed to resolve %r. Using stale addresses.", host, exc_info=True)
+            else:
+                entry = _Entry(addresses, now + self.ttl)
+                with self._lock:
+                    self._entries[(host, port)] = entry
+
+        return entry.addresses[next(entry.counter) % len(entry.addresses)]
+
+    def clear(self):
+        """Forget every cached address.
+        """
+        with self._lock:
+            self._entries = {}
+
+    def _lookup(self, host, port):
+        addresses = []
+        for _, _, _, _, sockaddr in socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM):
+            if sockaddr[0] not in addresses:
+                addresses.append(sockaddr[0])
+
+        if not addresses:
+            raise socket.gaierror("No addresses found for {!r}.".format(host))
+        return addresses
@@ -0,0 +1,188 @@
+import logging
+import time
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+
+from .pools import Cancellation
+
+
+class _Endpoint(object):
+    def __init__(self, max_samples):
+        self.samples = deque(maxlen=max_samples)
+        self.delay = None
+        self.stale = 0
+
+
+class _Race(object):
+    """The copies of a hedged request, whichever finishes first.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.winner = None
+        self.primary = Cancellation()
+        self.primary_done = Event()
+        self.hedge = Cancellation()
+
+    def claim(self, copy):
+        with self.lock:
+            if self.winner is None:
+                self.winner = copy
+            return self.winner is copy
+
+
+class HedgingPolicy(object):
+    """Sends a second copy of idempotent requests that are taking
+    longer than usual and uses whichever copy finishes first.
+
+    Requests are hedged once they've been in flight for longer than
+    the `percentile` latency of recent requests to the same endpoint.
+    At most `max_hedge_ratio` of requests are hedged.  The first copy
+    is sent from the calling thread and hedges from a pool of
+    `max_workers` threads.  As soon as one copy succeeds, the other is
+    cancelled, which closes its connection.
+
+    Parameters:
+      percentile(float): The latency percentile after which requests
+        are hedged.
+      max_hedge_ratio(float): The max ratio of requests to hedge.
+      min_samples(int): The min number of latency samples an endpoint
+        needs before its requests get hedged.
+      max_samples(int): The number of latency samples kept per endpoint.
+      max_workers(int): The max number of requests that may be waiting
+        to be hedged or hedging at once.
+    """
+
+    # The number of new samples after which an endpoint's hedge
+    # delay gets recomputed.
+    _RECOMPUTE_INTERVAL = 50
+
+    def __init__(self, percentile=95, max_hedge_ratio=0.05, min_samples=100, max_samples=1000, max_workers=64,
+                 logger=None):
+        self.percentile = percentile
+        self.max_hedge_ratio = max_hedge_ratio
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.max_workers = max_workers
+        self.logger = logger or logging.getLogger("gcloud_requests.HedgingPolicy")
+
+        self._lock = Lock()
+        self._endpoints = {}
+        self._tokens = 0.0
+        self._requests = 0
+        self._hedges = 0
+        self._executor = None
+
+    def send(self, endpoint, send):
+        """Call `send`, hedging it if it takes too long.
+
+        Parameters:
+          endpoint(tuple): The endpoint the request is being sent to.
+          send(callable): A function that sends the request so that
+            it can be cancelled through the :class:`.Cancellation` it's
+            given, and returns a :class:`requests.Response`.
+
+        Returns:
+          requests.Response
+        """
+        with self._lock:
+            self._requests += 1
+            self._tokens = min(self._tokens + self.max_hedge_ratio, 1 + self.max_hedge_ratio)
+            delay = self._get_endpoint(endpoint).delay
+
+        if delay is None:
+            return self._timed(endpoint, send, Cancellation())
+
+        race = _Race()
+        hedge = self._get_executor().submit(self._hedge, endpoint, send, delay, race)
+        try:
+            response = self._timed(endpoint, send, race.primary)
+        except Exception:
+            # The primary fails when it's cancelled by a hedge that
+            # succeeded, but a hedge that's in flight may yet succeed.
+            race.primary_done.set()
+            if hedge.cancel() or hedge.result() is None:
+                raise
+            return hedge.result()
+
+        race.primary_done.set()
+        if race.claim(race.primary):
+            if not hedge.cancel():
+                race.hedge.cancel()
+            return response
+
+        response.close()
+        return hedge.result()
+
+    def stats(self):
+        """Get hedging statistics.
+
+        Returns:
+          dict: The number of `requests` and `hedges` sent so far and
+          the current hedge `delays` per endpoint.
+        """
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "hedges": self._hedges,
+                "delays": {endpoint: state.delay for endpoint, state in self._endpoints.items()},
+            }
+
+    def _acquire(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            self._hedges += 1
+            return True
+
+    def _hedge(self, endpoint, send, delay, race):
+        if race.primary_done.wait(delay) or not self._acquire():
+            return None
+
+        self.logger.debug("Hedging request to %r after %.3f seconds.", endpoint, delay)
+        try:
+            response = self._timed(endpoint, send, race.hedge)
+        except Exception:
+            self.logger.debug("Hedged request to %r failed.", endpoint, exc_info=True)
+            return None
+
+        if race.claim(race.hedge):
+            race.primary.cancel()
+            return response
+
+        response.close()
+        return None
+
+    def _timed(self, endpoint, send, cancellation):
+        start = time.time()
+        response = send(cancellation)
+        self._record(endpoint, time.time() - start)
+        return response
+
+    def _record(self, endpoint, latency):
+        with self._lock:
+            state = self._get_endpoint(endpoint)
+            state.samples.append(latency)
+            state.stale += 1
+            if len(state.samples) >= self.min_samples and \
+               (state.delay is None or state.stale >= self._RECOMPUTE_INTERVAL):
+                samples = sorted(state.samples)
+                index = min(int(len(samples) * self.percentile / 100.0), len(samples) - 1)
+                state.delay, state.stale = samples[index], 0
+
+    def _get_endpoint(self, endpoint):
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = self._endpoints[endpoint] = _Endpoint(self.max_samples)
+        return state
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
@@ -0,0 +1,227 @@
+"""An HTTP/2 transport adapter for requests Sessions.
+
+This adapter requires httpx with HTTP/2 support.  Install it with::
+
+  pip install gcloud_requests[http2]
+"""
+import os
+import ssl
+import time
+
+import httpx
+import requests
+
+from requests.adapters import BaseAdapter
+from requests.packages.urllib3.util.timeout import Timeout
+from requests.structures import CaseInsensitiveDict
+from requests.utils import DEFAULT_CA_BUNDLE_PATH, get_encoding_from_headers, select_proxy
+from threading import Lock
+
+from .retries import full_jitter
+
+
+class HTTP2Adapter(BaseAdapter):
+    """A requests transport adapter that multiplexes concurrent
+    requests over a small number of HTTP/2 connections.
+
+    The `verify`, `cert` and `proxies` settings of each request are
+    honored.  Requests that use different settings are sent over
+    different connections.
+
+    Parameters:
+      max_retries(Retry): Only the `connect` count is honored.
+        Requests that fail to connect are retried that many times,
+        with the same backoff the proxies use between retries.
+      pool_maxsize(int): The max number of connections to keep open
+        across all hosts, per combination of settings.
+      prior_knowledge(bool): Whether or not to speak HTTP/2 to
+        plaintext servers without negotiating it first.  This is
+        useful against local emulators.
+    """
+
+    def __init__(self, max_retries=None, pool_maxsize=10, prior_knowledge=False):
+        super(HTTP2Adapter, self).__init__()
+        self.max_retries = max_retries
+        self.pool_maxsize = pool_maxsize
+        self.prior_knowledge = prior_knowledge
+        self._lock = Lock()
+        self._clients = {}
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        client = self.get_client(verify, cert, select_proxy(request.url, proxies))
+        response = self.build_response(request, self._send(client, request, timeout))
+        if not stream:
+            # Bodies are read within the adapter so that errors reading
+            # them are converted like errors sending the request.
+            try:
+                response.content
+            except httpx.TimeoutException as e:
+                raise requests.exceptions.ReadTimeout(e, request=request)
+            except httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(e, request=request)
+        return response
+
+    def _send(self, client, request, timeout):
+        connect_retries = self.max_retries.connect if self.max_retries else 0
+        expires_at = getattr(timeout, "expires_at", None)
+        retries = 0
+        while True:
+            # Timeouts are recomputed on every attempt so that retries
+            # stay within the request's deadline.
+            attempt_timeout = timeout
+            if expires_at is not None:
+                attempt_timeout = timeout.cap(time.time())
+
+            http_request = client.build_request(
+                request.method, request.url,
+                headers=dict(request.headers),
+                content=request.body,
+                timeout=self._convert_timeout(attempt_timeout),
+            )
+
+            try:
+                return client.send(http_request, stream=True)
+            except httpx.ConnectTimeout as e:
+                error = requests.exceptions.ConnectTimeout(e, request=request)
+            except httpx.ConnectError as e:
+                error = requests.exceptions.ConnectionError(e, request=request)
+            except httpx.TimeoutException as e:
+                raise requests.exceptions.ReadTimeout(e, request=request)
+            except httpx.TransportError as e:
+                raise requests.exceptions.ConnectionError(e, request=request)
+
+            backoff = full_jitter(retries)
+            if retries >= connect_retries or (expires_at is not None and time.time() + backoff >= expires_at):
+                raise error
+
+            time.sleep(backoff)
+            retries += 1
+
+    def build_response(self, request, http_response):
+        response = requests.Response()
+        response.status_code = http_response.status_code
+        response.reason = http_response.reason_phrase
+        response.headers = CaseInsensitiveDict(http_response.headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = _HTTP2Body(http_response)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def get_client(self, verify=True, cert=None, proxy=None):
+        """Get the client that sends requests with the given settings.
+
+        Parameters:
+          verify(bool or str): Whether or not to verify certificates
+            or the path to a CA bundle to verify them against.
+          cert(str or tuple): The client certificate to send, if any.
+          proxy(str): The URL of the proxy to send requests through.
+
+        Returns:
+          httpx.Client
+        """
+        if isinstance(cert, list):
+            cert = tuple(cert)
+
+        key = verify, cert, proxy
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                # Settings from the environment have already been
+                # merged into the request by its Session.
+                transport = httpx.HTTPTransport(
+                    verify=self._make_ssl_context(verify, cert),
+                    http1=not self.prior_knowledge,
+                    http2=True,
+                    limits=httpx.Limits(
+                        max_connections=self.pool_maxsize,
+                        max_keepalive_connections=self.pool_maxsize,
+                    ),
+                    proxy=httpx.Proxy(proxy) if proxy else None,
+                )
+                client = self._clients[key] = httpx.Client(transport=transport, trust_env=False)
+            return client
+
+    def close(self):
+        with self._lock:
+            clients, self._clients = self._clients, {}
+
+        for client in clients.values():
+            client.close()
+
+    def _make_ssl_context(self, verify, cert):
+        if verify is False:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif verify is True:
+            context = ssl.create_default_context(cafile=DEFAULT_CA_BUNDLE_PATH)
+        elif os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify)
+
+        if isinstance(cert, tuple):
+            context.load_cert_chain(*cert)
+        elif cert is not None:
+            context.load_cert_chain(cert)
+        return context
+
+    def _convert_timeout(self, timeout):
+        if isinstance(timeout, Timeout):
+            return httpx.Timeout(timeout.read_timeout, connect=timeout.connect_timeout)
+        if isinstance(timeout, tuple):
+            connect_timeout, read_timeout = timeout
+            return httpx.Timeout(read_timeout, connect=connect_timeout)
+        return httpx.Timeout(timeout)
+
+
+class _HTTP2Body(object):
+    """Exposes the parts of urllib3's HTTPResponse interface that
+    requests uses to consume response bodies.
+    """
+
+    def __init__(self, http_response):
+        self._response = http_response
+        self._chunks = None
+        self._buffer = b""
+
+    def stream(self, chunk_size=None, decode_content=True):
+        try:
+            if self._buffer:
+                yield self._buffer
+                self._buffer = b""
+
+            for chunk in self._iter_chunks(chunk_size, decode_content):
+                yield chunk
+        finally:
+            self.release_conn()
+
+    def read(self, amt=None, decode_content=True):
+        for chunk in self._iter_chunks(decode_content=decode_content):
+            self._buffer += chunk
+            if amt is not None and len(self._buffer) >= amt:
+                break
+        else:
+            self.release_conn()
+
+        if amt is None:
+            data, self._buffer = self._buffer, b""
+        else:
+            data, self._buffer = self._buffer[:amt], self._buffer[amt:]
+        return data
+
+    def release_conn(self):
+        self._response.close()
+
+    close = release_conn
+
+    def _iter_chunks(self, chunk_size=None, decode_content=True):
+        # Bodies can be read either decoded or raw, but not both.
+        if self._chunks is None:
+            if decode_content:
+                self._chunks = self._response.iter_bytes(chunk_size)
+            else:
+                self._chunks = self._response.iter_raw(chunk_size)
+        return self._chunks
@@ -0,0 +1,155 @@
+import time
+
+from six import text_type
+
+
+class RequestCall(object):
+    """Describes a single call to :meth:`.RequestsProxy.request`
+    across all of its attempts.
+
+    Attributes:
+      proxy(RequestsProxy): The proxy that's making the call.
+      method(str): The HTTP method.
+      url(str): The URL.
+      service(str): The service being called, eg. ``datastore``.
+      rpc_method(str): The RPC method being called, eg. ``lookup``,
+        or the HTTP method for plain REST endpoints.
+      start(float): The time at which the call started.
+      attempts(int): The number of attempts made so far.
+      retries(int): The number of times the call was retried.
+      refreshes(int): The number of credential refreshes made.
+      bytes_out(int): The size of the request body.
+      state(dict): Scratch space for instrumentation to keep
+        per-call state in.
+    """
+
+    def __init__(self, proxy, method, url, data):
+        self.proxy = proxy
+        self.method = method
+        self.url = url
+        self.service = proxy._get_service(url)
+        self.rpc_method = proxy._get_rpc_method(method, url)
+        self.start = time.time()
+        self.attempts = 0
+        self.retries = 0
+        self.refreshes = 0
+        self.bytes_out = _get_body_size(data)
+        self.state = {}
+
+
+def _get_body_size(data):
+    if isinstance(data, text_type):
+        # http.client sends text bodies encoded as latin-1.
+        try:
+            return len(data.encode("iso-8859-1"))
+        except UnicodeEncodeError:
+            return len(data.encode("utf-8"))
+
+    # Buffers such as the memoryviews that uploads send chunks as.
+    try:
+        return memoryview(data).nbytes
+    except TypeError:
+        return 0
+
+
+class Instrumentation(object):
+    """Base class for request instrumentation.  Every hook is a no-op
+    so subclasses need only implement the ones they care about.
+
+    Hooks are called on the thread making the request and must not
+    raise.  Set an instance on a proxy class's `INSTRUMENTATION`
+    attribute to enable it.
+    """
+
+    def before_request(self, call):
+        """Called before the first attempt of a call.
+
+        Parameters:
+          call(RequestCall)
+        """
+
+    def before_attempt(self, call, headers):
+        """Called before every attempt.
+
+        Parameters:
+          call(RequestCall)
+          headers(dict): The attempt's headers.  Hooks may add to them.
+        """
+
+    def after_attempt(self, call, response=None, error=None, latency=0, pool_wait=0, connect_time=0):
+        """Called after every attempt.
+
+        Parameters:
+          call(RequestCall)
+          response(requests.Response): The response, if there was one.
+          error(Exception): The error that was raised, if any.
+          latency(float): The number of seconds the attempt took.
+          pool_wait(float): The number of seconds spent waiting for a
+            pooled connection.
+          connect_time(float): The number of seconds spent opening a
+            new connection, including the TLS handshake, or 0 if an
+            open connection was reused.
+        """
+
+    def on_retry(self, call, reason, backoff):
+        """Called before backing off to retry a failed attempt.
+
+        Parameters:
+          call(RequestCall)
+          reason(str): The error status that caused the retry.
+          backoff(float): The number of seconds to back off for.
+        """
+
+    def on_refresh(self, call, latency, error=None):
+        """Called after credentials are refreshed, either because they
+        had expired or due to an authentication error.
+
+        Parameters:
+          call(RequestCall)
+          latency(float): The number of seconds the refresh took.
+          error(Exception): The error that was raised, if any.
+        """
+
+    def after_request(self, call, response=None, error=None):
+        """Called once a call is done.
+
+        Parameters:
+          call(RequestCall)
+          response(requests.Response): The final response, if any.
+          error(Exception): The error that was raised, if any.
+        """
+
+
+class CompositeInstrumentation(Instrumentation):
+    r"""Fans every hook out to multiple instrumentations, in order.
+
+    Parameters:
+      \*instrumentations(Instrumentation)
+    """
+
+    def __init__(self, *instrumentations):
+        self.instrumentations = instrumentations
+
+    def before_request(self, call):
+        for instrumentation in self.instrumentations:
+            instrumentation.before_request(call)
+
+    def before_attempt(self, call, headers):
+        for instrumentation in self.instrumentations:
+            instrumentation.before_attempt(call, headers)
+
+    def after_attempt(self, call, response=None, error=None, latency=0, pool_wait=0, connect_time=0):
+        for instrumentation in self.instrumentations:
+            instrumentation.after_attempt(call, response, error, latency, pool_wait, connect_time)
+
+    def on_retry(self, call, reason, backoff):
+        for instrumentation in self.instrumentations:
+            instrumentation.on_retry(call, reason, backoff)
+
+    def on_refresh(self, call, latency, error=None):
+        for instrumentation in self.instrumentations:
+            instrumentation.on_refresh(call, latency, error)
+
+    def after_request(self, call, response=None, error=None):
+        for instrumentation in self.instrumentations:
+            instrumentation.after_request(call, response, error)
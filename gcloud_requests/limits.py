@@ -0,0 +1,146 @@
+import logging
+import time
+
+from threading import Condition
+
+
+class ConcurrencyLimitExceeded(Exception):
+    """Raised when a request waits for a slot under a
+    :class:`.ConcurrencyLimiter` for longer than its timeout.
+    """
+
+
+class ConcurrencyLimiter(object):
+    """Adaptively limits the number of requests in flight.
+
+    The limit grows additively while requests succeed and the limit
+    is being used, and shrinks multiplicatively when a request is
+    throttled or when recent latency rises well above its long-term
+    average.  Decreases happen at most once per recent round-trip
+    time so that a burst of throttled responses to requests that were
+    sent together only counts once.  Callers over the limit wait for a
+    slot for up to `timeout` seconds.
+
+    Parameters:
+      initial_limit(int): The number of requests allowed in flight at
+        first.
+      min_limit(int): The lowest the limit may go.
+      max_limit(int): The highest the limit may go.
+      decrease_ratio(float): The ratio the limit is multiplied by
+        whenever it shrinks.
+      latency_tolerance(float): The ratio of recent latency to
+        long-term latency above which the limit shrinks.
+      timeout(float): The max number of seconds to wait for a slot.
+    """
+
+    # The weights given to new samples by the recent and long-term
+    # latency averages.
+    _RECENT_WEIGHT = 0.1
+    _LONG_TERM_WEIGHT = 0.005
+
+    def __init__(self, initial_limit=20, min_limit=1, max_limit=500, decrease_ratio=0.9,
+                 latency_tolerance=2.0, timeout=30, logger=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_ratio = decrease_ratio
+        self.latency_tolerance = latency_tolerance
+        self.timeout = timeout
+        self.logger = logger or logging.getLogger("gcloud_requests.ConcurrencyLimiter")
+
+        self._updated = Condition()
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiting = 0
+        self._recent_latency = None
+        self._long_term_latency = None
+        self._decreased_at = 0
+
+    @property
+    def limit(self):
+        """int: The number of requests currently allowed in flight.
+        """
+        return int(self._limit)
+
+    def acquire(self, timeout=None):
+        """Wait for a slot.
+
+        Parameters:
+          timeout(float): The max number of seconds to wait, if it's
+            lower than the limiter's own `timeout`.
+
+        Raises:
+          ConcurrencyLimitExceeded: When no slot became available in time.
+        """
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+
+        deadline = time.time() + timeout
+        with self._updated:
+            self._waiting += 1
+            try:
+                while self._in_flight >= int(self._limit):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ConcurrencyLimitExceeded(
+                            "Timed out waiting for one of {} slots.".format(int(self._limit))
+                        )
+
+                    self._updated.wait(remaining)
+
+                self._in_flight += 1
+            finally:
+                self._waiting -= 1
+
+    def release(self, latency=None, throttled=False):
+        """Give a slot back and adjust the limit.
+
+        Parameters:
+          latency(float): The number of seconds the request took, or
+            None if it failed without a response.
+          throttled(bool): Whether or not the request was throttled.
+        """
+        with self._updated:
+            in_flight = self._in_flight
+            self._in_flight -= 1
+            if throttled or self._record_latency(latency):
+                self._decrease(throttled)
+            elif latency is not None and in_flight * 2 >= self._limit:
+                # Only grow while at least half the limit is in use,
+                # otherwise the limit drifts up without being tested.
+                self._limit = min(self._limit + 1 / self._limit, self.max_limit)
+
+            self._updated.notify_all()
+
+    def stats(self):
+        """Get the limiter's current state.
+
+        Returns:
+          dict: The current `limit`, the number of requests `in_flight`
+          and the number of callers `waiting` for a slot.
+        """
+        with self._updated:
+            return {"limit": int(self._limit), "in_flight": self._in_flight, "waiting": self._waiting}
+
+    def _record_latency(self, latency):
+        if latency is None:
+            return False
+
+        if self._recent_latency is None:
+            self._recent_latency = self._long_term_latency = latency
+            return False
+
+        self._recent_latency += (latency - self._recent_latency) * self._RECENT_WEIGHT
+        self._long_term_latency += (latency - self._long_term_latency) * self._LONG_TERM_WEIGHT
+        return self._recent_latency > self._long_term_latency * self.latency_tolerance
+
+    def _decrease(self, throttled):
+        now = time.time()
+        if now - self._decreased_at < (self._recent_latency or 0):
+            return
+
+        self._decreased_at = now
+        self._limit = max(self._limit * self.decrease_ratio, self.min_limit)
+        self.logger.debug(
+            "Decreased concurrency limit to %d due to %s.",
+            self._limit, "throttling" if throttled else "rising latency",
+        )
@@ -0,0 +1,200 @@
+import logging
+import requests
+
+from requests.structures import CaseInsensitiveDict
+from threading import Event, Lock
+
+
+def _key_id(key):
+    # Keys are matched by namespace and path only because Datastore
+    # fills in the project id on the keys it returns.
+    path = tuple((element.kind, element.id, element.name) for element in key.path)
+    return (key.partition_id.namespace_id, path)
+
+
+def build_response(url, content):
+    """Build a successful protobuf response for a request that was
+    answered locally.
+    """
+    response = requests.Response()
+    response.status_code = 200
+    response.reason = "OK"
+    response.url = url
+    response.headers = CaseInsensitiveDict({
+        "content-type": "application/x-protobuf",
+        "content-length": str(len(content)),
+    })
+    response._content = content
+    return response
+
+
+def replace_content(response, content):
+    """Copy a response, replacing its content.
+    """
+    new_response = type(response)()
+    new_response.__dict__.update(response.__dict__)
+    new_response.headers = response.headers.copy()
+    new_response.headers["content-length"] = str(len(content))
+    new_response._content = content
+    return new_response
+
+
+class _PendingLookup(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.done = Event()
+        self.response = None
+        self.error = None
+
+
+class _Batch(object):
+    def __init__(self, url, request, headers):
+        self.url = url
+        self.request = request
+        self.headers = headers
+        self.ready = Event()
+        self.pending = []
+        self.size = 0
+
+    def add(self, pending):
+        self.pending.append(pending)
+        self.size += len(pending.keys)
+
+
+class LookupBatcher(object):
+    """Coalesces concurrent Datastore lookups for the same project
+    and read options into a single lookup RPC.
+
+    The first thread to look up a set of keys becomes the batch's
+    leader.  It waits up to `window` seconds for other lookups to
+    join the batch, or until the batch holds `max_keys` keys, then
+    sends a single combined request, re-requests any deferred keys
+    and splits the results back out to every caller.
+
+    Parameters:
+      send(callable): The function used to send combined lookups.
+        It's called with the same arguments as :meth:`.RequestsProxy.request`.
+      window(float): The max number of seconds to hold lookups for.
+      max_keys(int): The max number of keys per combined lookup.
+    """
+
+    def __init__(self, send, window, max_keys, logger=None):
+        # The Datastore protos are only available when
+        # google-cloud-datastore is installed.
+        from google.cloud.datastore_v1.proto import datastore_pb2
+
+        self.datastore_pb2 = datastore_pb2
+        self.send = send
+        self.window = window
+        self.max_keys = max_keys
+        self.logger = logger or logging.getLogger("gcloud_requests.LookupBatcher")
+        self._lock = Lock()
+        self._batches = {}
+
+    def can_batch(self, request):
+        """Determine whether or not a lookup request can be batched.
+
+        Parameters:
+          request(LookupRequest)
+
+        Returns:
+          bool
+        """
+        # Reads inside transactions must stay in their own RPC.
+        return not request.read_options.transaction and len(request.keys) < self.max_keys
+
+    def lookup(self, url, request, headers):
+        """Look up the keys in the given request as part of a batch.
+
+        Parameters:
+          url(str): The lookup URL.
+          request(LookupRequest): A request accepted by :meth:`can_batch`.
+          headers(dict): The request headers.
+
+        Returns:
+          requests.Response: A response containing only the results
+          for this request's keys.
+        """
+        batch_key = (url, request.read_options.SerializeToString())
+        pending = _PendingLookup(request.keys)
+        with self._lock:
+            batch = self._batches.get(batch_key)
+            if batch is not None and batch.size + len(pending.keys) > self.max_keys:
+                self._detach(batch_key)
+                batch = None
+
+            leader = batch is None
+            if leader:
+                batch = self._batches[batch_key] = _Batch(url, request, headers)
+
+            batch.add(pending)
+            if batch.size >= self.max_keys:
+                self._detach(batch_key)
+
+        if leader:
+            batch.ready.wait(self.window)
+            with self._lock:
+                if self._batches.get(batch_key) is batch:
+                    self._detach(batch_key)
+
+            self._flush(batch)
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.response
+
+    def _detach(self, batch_key):
+        self._batches.pop(batch_key).ready.set()
+
+    def _flush(self, batch):
+        self.logger.debug("Flushing %d lookups with %d keys.", len(batch.pending), batch.size)
+        try:
+            response, results = self._send_lookups(batch)
+        except Exception as e:
+            for pending in batch.pending:
+                pending.error = e
+                pending.done.set()
+            return
+
+        for pending in batch.pending:
+            if results is None:
+                pending.response = response
+            else:
+                pending.response = self._split_response(response, results, pending.keys)
+            pending.done.set()
+
+    def _send_lookups(self, batch):
+        keys = list({_key_id(key): key for pending in batch.pending for key in pending.keys}.values())
+        found, missing = {}, {}
+        while keys:
+            request = self.datastore_pb2.LookupRequest(
+                project_id=batch.request.project_id,
+                read_options=batch.request.read_options,
+                keys=keys,
+            )
+
+            response = self.send("POST", batch.url, data=request.SerializeToString(), headers=batch.headers)
+            if response.status_code != 200:
+                return response, None
+
+            data = self.datastore_pb2.LookupResponse.FromString(response.content)
+            found.update((_key_id(result.entity.key), result) for result in data.found)
+            missing.update((_key_id(result.entity.key), result) for result in data.missing)
+            keys = list(data.deferred)
+            if keys:
+                self.logger.debug("Re-requesting %d deferred keys.", len(keys))
+
+        return response, (found, missing)
+
+    def _split_response(self, response, results, keys):
+        found, missing = results
+        data = self.datastore_pb2.LookupResponse()
+        for key in keys:
+            key_id = _key_id(key)
+            if key_id in found:
+                data.found.add().CopyFrom(found[key_id])
+            elif key_id in missing:
+                data.missing.add().CopyFrom(missing[key_id])
+
+        return replace_content(response, data.SerializeToString())
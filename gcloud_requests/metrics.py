@@ -0,0 +1,262 @@
+import bisect
+import time
+
+from threading import Lock, Thread
+
+from .instrumentation import Instrumentation
+
+#: The default upper bounds of latency histogram buckets in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    """A fixed-bucket histogram.
+
+    Parameters:
+      buckets(tuple): The sorted upper bounds of every bucket.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsAggregator(Instrumentation):
+    """Aggregates request metrics in memory.
+
+    Metrics are labelled by service (eg. ``datastore``) and RPC method
+    (eg. ``lookup``).  Use :meth:`snapshot` to read them or a
+    :class:`.PrometheusExporter` to expose them.
+
+    Parameters:
+      buckets(tuple): The upper bounds of latency histogram buckets.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget every metric recorded so far.
+        """
+        with self._lock:
+            self._request_latency = {}
+            self._attempt_latency = {}
+            self._pool_wait = {}
+            self._connect_time = {}
+            self._refresh_latency = Histogram(self.buckets)
+            self._refresh_failures = 0
+            self._responses = {}
+            self._retries = {}
+            self._bytes_out = {}
+            self._bytes_in = {}
+
+    def after_attempt(self, call, response=None, error=None, latency=0, pool_wait=0, connect_time=0):
+        labels = call.service, call.rpc_method
+        status = str(response.status_code) if response is not None else type(error).__name__
+        with self._lock:
+            self._observe(self._attempt_latency, labels, latency)
+            self._observe(self._pool_wait, (call.service,), pool_wait)
+            if connect_time:
+                self._observe(self._connect_time, (call.service,), connect_time)
+            self._increment(self._responses, labels + (status,))
+            self._increment(self._bytes_out, labels, call.bytes_out)
+            if response is not None:
+                self._increment(self._bytes_in, labels, _get_response_size(response))
+
+    def on_retry(self, call, reason, backoff):
+        with self._lock:
+            self._increment(self._retries, (call.service, call.rpc_method, reason))
+
+    def on_refresh(self, call, latency, error=None):
+        with self._lock:
+            self._refresh_latency.observe(latency)
+            if error is not None:
+                self._refresh_failures += 1
+
+    def after_request(self, call, response=None, error=None):
+        with self._lock:
+            self._observe(self._request_latency, (call.service, call.rpc_method), time.time() - call.start)
+
+    def snapshot(self):
+        """Get a copy of every metric.
+
+        Returns:
+          dict: A mapping from metric names to mappings from label
+          tuples to values.  Histograms are dicts with `buckets`,
+          `counts`, `count` and `sum` keys.
+        """
+        def histograms(metrics):
+            return {labels: _histogram_to_dict(histogram) for labels, histogram in metrics.items()}
+
+        with self._lock:
+            return {
+                "request_latency": histograms(self._request_latency),
+                "attempt_latency": histograms(self._attempt_latency),
+                "pool_wait": histograms(self._pool_wait),
+                "connect_time": histograms(self._connect_time),
+                "refresh_latency": _histogram_to_dict(self._refresh_latency),
+                "refresh_failures": self._refresh_failures,
+                "responses": dict(self._responses),
+                "retries": dict(self._retries),
+                "bytes_out": dict(self._bytes_out),
+                "bytes_in": dict(self._bytes_in),
+            }
+
+    def _observe(self, metrics, labels, value):
+        histogram = metrics.get(labels)
+        if histogram is None:
+            histogram = metrics[labels] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def _increment(self, metrics, labels, value=1):
+        metrics[labels] = metrics.get(labels, 0) + value
+
+
+class PrometheusExporter(object):
+    """Renders the metrics of a :class:`.MetricsAggregator` in the
+    Prometheus text exposition format.
+
+    Parameters:
+      aggregator(MetricsAggregator)
+      prefix(str): The prefix of every metric name.
+    """
+
+    _HISTOGRAMS = (
+        ("request_latency", "request_duration_seconds", ("service", "method"),
+         "Latency of proxied requests across all of their attempts."),
+        ("attempt_latency", "attempt_duration_seconds", ("service", "method"),
+         "Latency of individual request attempts."),
+        ("pool_wait", "pool_wait_seconds", ("service",),
+         "Time spent waiting for pooled connections."),
+        ("connect_time", "connect_duration_seconds", ("service",),
+         "Time spent opening new connections, including TLS handshakes."),
+    )
+
+    _COUNTERS = (
+        ("responses", "responses_total", ("service", "method", "status"),
+         "Attempts by response status."),
+        ("retries", "retries_total", ("service", "method", "reason"),
+         "Retries by error status."),
+        ("bytes_out", "sent_bytes_total", ("service", "method"),
+         "Bytes sent in request bodies."),
+        ("bytes_in", "received_bytes_total", ("service", "method"),
+         "Bytes received in response bodies."),
+    )
+
+    def __init__(self, aggregator, prefix="gcloud_requests_"):
+        self.aggregator = aggregator
+        self.prefix = prefix
+
+    def render(self):
+        """Render every metric.
+
+        Returns:
+          str
+        """
+        snapshot = self.aggregator.snapshot()
+        lines = []
+        for key, name, label_names, description in self._HISTOGRAMS:
+            self._render_header(lines, name, "histogram", description)
+            for labels, histogram in sorted(snapshot[key].items()):
+                self._render_histogram(lines, name, zip(label_names, labels), histogram)
+
+        for key, name, label_names, description in self._COUNTERS:
+            self._render_header(lines, name, "counter", description)
+            for labels, value in sorted(snapshot[key].items()):
+                lines.append(self._format(name, zip(label_names, labels), value))
+
+        self._render_header(lines, "credentials_refresh_duration_seconds", "histogram",
+                            "Latency of credentials refreshes.")
+        self._render_histogram(lines, "credentials_refresh_duration_seconds", (), snapshot["refresh_latency"])
+        self._render_header(lines, "credentials_refresh_failures_total", "counter",
+                            "Failed credentials refreshes.")
+        lines.append(self._format("credentials_refresh_failures_total", (), snapshot["refresh_failures"]))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve the metrics over HTTP on a background thread.
+
+        Parameters:
+          port(int): The port to listen on.  Pass 0 to pick any port.
+          host(str): The interface to listen on.  Only local clients
+            can connect by default.  Pass ``""`` to listen on every
+            interface.
+
+        Returns:
+          The HTTP server.  Call ``shutdown()`` on it to stop it.
+        """
+        from six.moves import BaseHTTPServer, socketserver
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = exporter.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("content-type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = Server((host, port), Handler)
+        thread = Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+    def _render_header(self, lines, name, kind, description):
+        lines.append("# HELP {}{} {}".format(self.prefix, name, description))
+        lines.append("# TYPE {}{} {}".format(self.prefix, name, kind))
+
+    def _render_histogram(self, lines, name, labels, histogram):
+        labels = list(labels)
+        cumulative = 0
+        bounds = [repr(float(bound)) for bound in histogram["buckets"]] + ["+Inf"]
+        for bound, count in zip(bounds, histogram["counts"]):
+            cumulative += count
+            lines.append(self._format(name + "_bucket", labels + [("le", bound)], cumulative))
+        lines.append(self._format(name + "_sum", labels, histogram["sum"]))
+        lines.append(self._format(name + "_count", labels, histogram["count"]))
+
+    def _format(self, name, labels, value):
+        labels = ",".join('{}="{}"'.format(label, _escape(label_value)) for label, label_value in labels)
+        if labels:
+            return "{}{}{{{}}} {}".format(self.prefix, name, labels, value)
+        return "{}{} {}".format(self.prefix, name, value)
+
+
+def _get_response_size(response):
+    content_length = response.headers.get("content-length")
+    if content_length is not None and content_length.isdigit():
+        return int(content_length)
+    if response._content_consumed and isinstance(response._content, bytes):
+        return len(response._content)
+    return 0
+
+
+def _histogram_to_dict(histogram):
+    return {
+        "buckets": histogram.buckets,
+        "counts": list(histogram.counts),
+        "count": histogram.count,
+        "sum": histogram.sum,
+    }
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
@@ -0,0 +1,644 @@
+import logging
+import os
+import socket
+import time
+import weakref
+
+import requests
+
+from requests.packages.urllib3.connection import HTTPConnection, HTTPSConnection
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import EmptyPoolError, MaxRetryError, ProtocolError
+from requests.packages.urllib3.poolmanager import PoolManager
+from requests.packages.urllib3.util.retry import Retry
+from requests.packages.urllib3.util.timeout import Timeout
+from contextlib import contextmanager
+from threading import Condition, Lock, Thread, local
+
+# Every manager in the process, so that their pools can be dropped in
+# forked children.
+_managers = weakref.WeakSet()
+
+
+class DeadlineTimeout(Timeout):
+    """Attempt timeouts that also carry the time by which the whole
+    request has to be done.  Pools cap the timeouts of every retry
+    they make on their own at the time left and stop retrying once
+    it's run out.
+
+    Parameters:
+      connect(float): The connect timeout.
+      read(float): The read timeout.
+      expires_at(float): The time by which the request must be done.
+    """
+
+    def __init__(self, connect, read, expires_at):
+        super(DeadlineTimeout, self).__init__(connect=connect, read=read)
+        self.expires_at = expires_at
+
+    def cap(self, now):
+        """Get a copy of these timeouts capped at the time left.
+        """
+        remaining = max(self.expires_at - now, 0.001)
+        return DeadlineTimeout(
+            min(self.connect_timeout, remaining),
+            min(self.read_timeout, remaining),
+            self.expires_at,
+        )
+
+
+class Cancellation(object):
+    """Lets requests that are in flight on one thread be cancelled
+    from another.  Cancelling shuts down the socket of the connection
+    a request is using, so it fails with a ConnectionError right away
+    instead of waiting on the server, and stops it from being retried.
+
+    Requests are only cancellable while they're being sent through
+    :meth:`.ConnectionPoolManager.cancellable`.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._conn = None
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel the request.
+        """
+        with self._lock:
+            self.cancelled, conn = True, self._conn
+
+        if conn is not None:
+            _shutdown(conn)
+
+    def _bind(self, conn):
+        with self._lock:
+            self._conn, cancelled = conn, self.cancelled
+
+        conn._cancellation = self
+        if cancelled:
+            _shutdown(conn)
+
+    def _unbind(self, conn):
+        with self._lock:
+            if self._conn is conn:
+                self._conn = None
+
+        conn._cancellation = None
+
+
+def _shutdown(conn):
+    sock = conn.sock
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class _TrackedConnectionMixin(object):
+    """Times connection setup and resolves host names through the
+    owning manager's DNS cache, if it has one.
+    """
+
+    _manager = None
+
+    #: When the connection was last handed back to its pool.
+    idle_since = None
+
+    #: The Cancellation of the request using the connection, if any.
+    _cancellation = None
+
+    def connect(self):
+        start = time.time()
+        try:
+            super(_TrackedConnectionMixin, self).connect()
+        finally:
+            state = self._manager._state
+            state.connect_time = getattr(state, "connect_time", 0) + time.time() - start
+
+        # Requests cancelled while connecting had no socket to shut down.
+        if self._cancellation is not None and self._cancellation.cancelled:
+            self.close()
+            raise socket.error("The request was cancelled.")
+
+    def _new_conn(self):
+        dns_cache = self._manager.dns_cache
+        if dns_cache is None:
+            return super(_TrackedConnectionMixin, self)._new_conn()
+
+        # Only the address that's connected to changes.  TLS still
+        # verifies the original host name.
+        host = self._dns_host
+        self._dns_host = dns_cache.resolve(host, self.port)
+        try:
+            return super(_TrackedConnectionMixin, self)._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class _TrackedHTTPConnection(_TrackedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TrackedHTTPSConnection(_TrackedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TrackedPoolMixin(object):
+    """Keeps track of the connections that are checked out of a pool
+    and enforces the owning manager's global connection cap.
+    """
+
+    _manager = None
+
+    @property
+    def _in_use(self):
+        return len(self._checked_out)
+
+    def _get_conn(self, timeout=None):
+        start, manager = time.time(), self._manager
+        if timeout is None:
+            timeout = manager.pool_timeout
+
+        # urlopen hands back None in place of connections it's had to
+        # discard, so the thread's last checkout is what gets released
+        # when it does.  Failed checkouts leave nothing to release.
+        state = manager._state
+        state.checkout = None
+        manager._acquire(self, timeout)
+        try:
+            if timeout is not None:
+                timeout = max(timeout - (time.time() - start), 0)
+            conn = super(_TrackedPoolMixin, self)._get_conn(timeout=timeout)
+        except Exception:
+            manager._release()
+            raise
+
+        with manager._lock:
+            self._checked_out[id(conn)] = conn
+
+        state.checkout = (self, conn)
+        state.pool_wait = getattr(state, "pool_wait", 0) + time.time() - start
+
+        # Connections that have been idle for long enough that the
+        # server may have dropped them are reopened before they're used.
+        if manager._is_stale(conn, time.time()):
+            conn.close()
+            manager._count_reaped(1)
+
+        conn.idle_since = None
+        cancellation = getattr(state, "cancellation", None)
+        if cancellation is not None:
+            cancellation._bind(conn)
+        return conn
+
+    def urlopen(self, method, url, body=None, headers=None, retries=None, *args, **kwargs):
+        # urlopen calls itself to retry failed requests, with the same
+        # timeouts every time.
+        if self._manager.is_cancelled():
+            raise MaxRetryError(self, url, ProtocolError("The request was cancelled."))
+
+        timeout = kwargs.get("timeout")
+        if isinstance(timeout, DeadlineTimeout):
+            now = time.time()
+            if now >= timeout.expires_at and isinstance(retries, Retry) and retries.history:
+                raise MaxRetryError(self, url, retries.history[-1].error)
+            kwargs["timeout"] = timeout.cap(now)
+
+        return super(_TrackedPoolMixin, self).urlopen(method, url, body, headers, retries, *args, **kwargs)
+
+    def _new_conn(self):
+        conn = super(_TrackedPoolMixin, self)._new_conn()
+        conn._manager = self._manager
+        return conn
+
+    def _put_conn(self, conn):
+        manager = self._manager
+        state = manager._state
+        checkout = getattr(state, "checkout", None)
+        released = conn
+        if conn is None and checkout is not None and checkout[0] is self:
+            released = checkout[1]
+        if checkout is not None and checkout[1] is released:
+            state.checkout = None
+
+        if released is not None:
+            if released._cancellation is not None:
+                released._cancellation._unbind(released)
+
+            with manager._lock:
+                checked_out = self._checked_out.pop(id(released), None) is not None
+            if checked_out:
+                manager._release()
+
+        if conn is not None:
+            conn.idle_since = time.time()
+        return super(_TrackedPoolMixin, self)._put_conn(conn)
+
+
+class _TrackedHTTPConnectionPool(_TrackedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _TrackedHTTPConnection
+
+
+class _TrackedHTTPSConnectionPool(_TrackedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _TrackedHTTPSConnection
+
+
+class _TrackedPoolManager(PoolManager):
+    def __init__(self, manager, *args, **kwargs):
+        super(_TrackedPoolManager, self).__init__(*args, **kwargs)
+        self.pool_classes_by_scheme = {
+            "http": _TrackedHTTPConnectionPool,
+            "https": _TrackedHTTPSConnectionPool,
+        }
+        self.manager = manager
+
+    def _new_pool(self, *args, **kwargs):
+        pool = super(_TrackedPoolManager, self)._new_pool(*args, **kwargs)
+        pool._manager = self.manager
+        pool._checked_out = {}
+        return pool
+
+
+class _TrackedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, manager, *args, **kwargs):
+        self.manager = manager
+        super(_TrackedHTTPAdapter, self).__init__(*args, **kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = _TrackedPoolManager(
+            self.manager,
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            **pool_kwargs
+        )
+
+
+class ConnectionPoolManager(object):
+    """Hands out connection-pooling Sessions that are shared across
+    threads.
+
+    One Session is created per proxy class and connection settings,
+    so each proxy type gets its own `RETRY_CONFIG` and pool sizes.
+    Every host gets at most `CONNECTION_POOL_SIZE` connections per
+    Session and, optionally, the total number of connections checked
+    out across all Sessions can be capped via `max_connections`.
+    Sessions of proxies that set `HTTP2` use an :class:`.HTTP2Adapter`
+    instead and aren't subject to the global cap.
+
+    Connections that have been idle for longer than `max_idle_time`
+    are closed and reopened the next time they're checked out, rather
+    than risk being reset by a load balancer that's already dropped
+    them.  Call :meth:`reap` to close them ahead of time.
+
+    Forked child processes start out with no Sessions since the
+    connections they'd inherit are shared with the parent.  Use
+    :meth:`warm_after_fork` to have children open connections to the
+    hosts they're going to use as soon as they start.
+
+    Requests that can't get a connection within `pool_timeout` seconds,
+    because their host's pool or the global cap is exhausted, fail with
+    an :class:`~urllib3.exceptions.EmptyPoolError`.
+
+    Parameters:
+      max_connections(int): The max number of connections that may be
+        in use at once across all the sessions, or None for no limit.
+      pool_timeout(float): The max number of seconds to wait for a
+        connection, or None to wait forever.
+      max_idle_time(float): The max number of seconds a connection may
+        sit idle before it's reopened, or None for no limit.
+      dns_cache(DNSCache): An optional cache to resolve host names
+        through when opening connections.
+    """
+
+    def __init__(self, max_connections=None, max_idle_time=None, dns_cache=None, pool_timeout=30):
+        self._lock = Lock()
+        self._state = local()
+        self._slots = Condition(Lock())
+        self._sessions = {}
+        self._active = 0
+        self._max_connections = max_connections
+        self._reaped = 0
+        self.pool_timeout = pool_timeout
+        self.max_idle_time = max_idle_time
+        self.dns_cache = dns_cache
+        self._warm_targets = []
+        self.logger = logging.getLogger("gcloud_requests.ConnectionPoolManager")
+        _managers.add(self)
+
+    @property
+    def max_connections(self):
+        return self._max_connections
+
+    @max_connections.setter
+    def max_connections(self, max_connections):
+        with self._slots:
+            self._max_connections = max_connections
+            self._slots.notify_all()
+
+    def get_session(self, proxy):
+        """Get the Session for the given proxy, creating it if necessary.
+
+        Parameters:
+          proxy(RequestsProxy)
+
+        Returns:
+          requests.Session
+        """
+        return self._get_session(type(proxy))
+
+    def _get_session(self, proxy_class):
+        key = (proxy_class, proxy_class.RETRY_CONFIG, proxy_class.CONNECTION_POOL_SIZE, proxy_class.HTTP2)
+        session = self._sessions.get(key)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                # Make use of requests' internal retry mechanism.  It
+                # will safely retry any requests that failed due to
+                # DNS lookup, socket errors, etc.
+                session = requests.Session()
+                adapter = self._make_adapter(proxy_class)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[key] = session
+            return session
+
+    def _make_adapter(self, proxy_class):
+        if proxy_class.HTTP2:
+            # HTTP/2 support is optional so we import it lazily.
+            from .http2 import HTTP2Adapter
+
+            return HTTP2Adapter(
+                max_retries=proxy_class.RETRY_CONFIG,
+                pool_maxsize=proxy_class.CONNECTION_POOL_SIZE,
+                prior_knowledge=proxy_class.HTTP2 == "prior_knowledge",
+            )
+
+        return _TrackedHTTPAdapter(
+            self,
+            max_retries=proxy_class.RETRY_CONFIG,
+            pool_connections=proxy_class.CONNECTION_POOL_SIZE,
+            pool_maxsize=proxy_class.CONNECTION_POOL_SIZE,
+            pool_block=True,
+        )
+
+    def clear(self):
+        """Close and forget every Session.  Connections that are in
+        use are closed when they're handed back.
+        """
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+
+        for session in sessions.values():
+            session.close()
+
+    def warm(self, proxy_class, url, connections=1):
+        """Open connections to the given URL's host ahead of time so
+        that the first requests made through them don't have to pay
+        for TCP and TLS handshakes.
+
+        Parameters:
+          proxy_class(type): The type of proxy whose Session the
+            connections should be added to.
+          url(str): A URL on the host to connect to.
+          connections(int): The number of connections to open.  This
+            is capped at the proxy's `CONNECTION_POOL_SIZE` and at
+            `max_connections`.
+
+        Returns:
+          int: The number of connections that are open and idle.
+        """
+        session = self._get_session(proxy_class)
+        adapter = session.get_adapter(url)
+        if getattr(adapter, "poolmanager", None) is None:
+            # HTTP/2 connections are managed by httpx.
+            return 0
+
+        # Pools are keyed by their TLS settings too, so they have to be
+        # looked up the same way requests looks them up.
+        settings = session.merge_environment_settings(url, {}, None, None, None)
+        if hasattr(adapter, "get_connection_with_tls_context"):
+            request = requests.Request("GET", url).prepare()
+            pool = adapter.get_connection_with_tls_context(
+                request, settings["verify"], proxies=settings["proxies"], cert=settings["cert"]
+            )
+        else:  # pragma: no cover
+            pool = adapter.get_connection(url, settings["proxies"])
+
+        connections = min(connections, proxy_class.CONNECTION_POOL_SIZE, self.max_connections or connections)
+        conns = []
+        try:
+            for _ in range(connections):
+                try:
+                    conn = pool._get_conn(timeout=0)
+                except EmptyPoolError:
+                    # Every other connection is in use, so it's warm.
+                    break
+
+                conns.append(conn)
+                if conn.sock is None:
+                    conn.timeout = proxy_class.TIMEOUT_CONFIG[0]
+                    conn.connect()
+        finally:
+            for conn in conns:
+                pool._put_conn(conn)
+
+        return sum(1 for conn in conns if conn.sock is not None)
+
+    def warm_after_fork(self, proxy_class, url, connections=1):
+        """Have forked child processes :meth:`warm` connections to the
+        given URL's host in the background as soon as they start.
+
+        Parameters:
+          proxy_class(type): The type of proxy whose Session the
+            connections should be added to.
+          url(str): A URL on the host to connect to.
+          connections(int): The number of connections to open.
+        """
+        self._warm_targets.append((proxy_class, url, connections))
+
+    @contextmanager
+    def cancellable(self, cancellation):
+        """Make the requests sent by the current thread within this
+        context cancellable through `cancellation`.  HTTP/2 requests
+        can't be cancelled.
+
+        Parameters:
+          cancellation(Cancellation)
+        """
+        self._state.cancellation = cancellation
+        try:
+            yield
+        finally:
+            self._state.cancellation = None
+
+    def is_cancelled(self):
+        """Check whether the requests the current thread is sending
+        have been cancelled.
+
+        Returns:
+          bool
+        """
+        cancellation = getattr(self._state, "cancellation", None)
+        return cancellation is not None and cancellation.cancelled
+
+    def reap(self):
+        """Close every idle connection that's been idle for longer
+        than `max_idle_time`.  Nothing calls this automatically, so
+        schedule it yourself if stale connections should be closed
+        while no requests are being made.
+
+        Returns:
+          int: The number of connections that were closed.
+        """
+        if self.max_idle_time is None:
+            return 0
+
+        reaped, now = 0, time.time()
+        for _, _, pool in self._iter_pools():
+            # Stale connections are swapped for empty slots while the
+            # pool is locked so that they can't be checked out while
+            # they're being closed.
+            with pool.pool.mutex:
+                conns = pool.pool.queue
+                for i, conn in enumerate(conns):
+                    if conn is not None and self._is_stale(conn, now):
+                        conns[i] = None
+                        conn.close()
+                        reaped += 1
+
+        self._count_reaped(reaped)
+        return reaped
+
+    def pop_pool_wait(self):
+        """Get and reset the number of seconds the current thread has
+        spent waiting for connections since the last call.
+
+        Returns:
+          float
+        """
+        pool_wait, self._state.pool_wait = getattr(self._state, "pool_wait", 0), 0
+        return pool_wait
+
+    def pop_connect_time(self):
+        """Get and reset the number of seconds the current thread has
+        spent opening connections since the last call.
+
+        Returns:
+          float
+        """
+        connect_time, self._state.connect_time = getattr(self._state, "connect_time", 0), 0
+        return connect_time
+
+    def stats(self):
+        """Get the number of connections that are in use and idle.
+
+        Returns:
+          dict: A dictionary containing overall `in_use` and `idle`
+          counts, the number of stale connections that were `reaped`
+          and a list of per-host `pools`.
+        """
+        pools, idle = [], 0
+        for proxy_class, pool_size, pool in self._iter_pools():
+            with pool.pool.mutex:
+                pool_idle = sum(1 for conn in pool.pool.queue if conn is not None and conn.sock is not None)
+
+            idle += pool_idle
+            pools.append({
+                "proxy": proxy_class.__name__,
+                "scheme": pool.scheme,
+                "host": pool.host,
+                "port": pool.port,
+                "max_size": pool_size,
+                "in_use": pool._in_use,
+                "idle": pool_idle,
+            })
+
+        return {
+            "in_use": self._active,
+            "idle": idle,
+            "reaped": self._reaped,
+            "max_connections": self.max_connections,
+            "pools": pools,
+        }
+
+    def _iter_pools(self):
+        with self._lock:
+            sessions = list(self._sessions.items())
+
+        for (proxy_class, _, pool_size, _), session in sessions:
+            poolmanager = getattr(session.get_adapter("https://"), "poolmanager", None)
+            if poolmanager is None:
+                # HTTP/2 connections are managed by httpx.
+                continue
+
+            for key in list(poolmanager.pools.keys()):
+                pool = poolmanager.pools.get(key)
+                if pool is not None and pool.pool is not None:
+                    yield proxy_class, pool_size, pool
+
+    def _is_stale(self, conn, now):
+        max_idle_time = self.max_idle_time
+        return max_idle_time is not None and conn.sock is not None and \
+            conn.idle_since is not None and now - conn.idle_since > max_idle_time
+
+    def _count_reaped(self, reaped):
+        if reaped:
+            with self._lock:
+                self._reaped += reaped
+
+    def _reinit_after_fork(self):
+        # Inherited connections share their sockets with the parent so
+        # they're dropped rather than closed, which could interfere
+        # with the parent's use of them.  Locks may have been held by
+        # threads that don't exist in the child so they're replaced.
+        self._lock = Lock()
+        self._state = local()
+        self._slots = Condition(Lock())
+        self._sessions = {}
+        self._active = 0
+        self._reaped = 0
+
+        if self._warm_targets:
+            thread = Thread(target=self._warm_targets_after_fork, name="gcloud_requests-warmup")
+            thread.daemon = True
+            thread.start()
+
+    def _warm_targets_after_fork(self):
+        for proxy_class, url, connections in self._warm_targets:
+            try:
+                self.warm(proxy_class, url, connections)
+            except Exception:
+                self.logger.warning("Failed to warm connections to %r.", url, exc_info=True)
+
+    def _acquire(self, pool, timeout=None):
+        expires_at = time.time() + timeout if timeout is not None else None
+        with self._slots:
+            while self._max_connections and self._active >= self._max_connections:
+                remaining = expires_at - time.time() if expires_at is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise EmptyPoolError(pool, "Too many connections are in use across all pools.")
+                self._slots.wait(remaining)
+            self._active += 1
+
+    def _release(self):
+        with self._slots:
+            self._active -= 1
+            self._slots.notify()
+
+
+def _reinit_after_fork():
+    for manager in list(_managers):
+        manager._reinit_after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reinit_after_fork)
@@ -1,25 +1,33 @@
-import atexit
 import logging
-import requests
 import time
 
-import google.auth
-
-from functools import partial
-from google.rpc import status_pb2
-from google.auth.credentials import with_scopes_if_required
-from google.auth.exceptions import RefreshError
-from google.auth.transport.requests import Request as AuthRequest
 from requests.packages.urllib3.util.retry import Retry
-from threading import local
+from six.moves.urllib.parse import urlparse
+from threading import Lock
 
+from .breakers import CircuitOpen
 from .credentials_watcher import CredentialsWatcher
+from .instrumentation import RequestCall
+from .pools import ConnectionPoolManager, DeadlineTimeout
+from .retries import RetryBudget, full_jitter
 
-_state = local()
 _refresh_status_codes = (401,)
 _max_refresh_attempts = 5
 _credentials_watcher = CredentialsWatcher()
-atexit.register(_credentials_watcher.stop)
+_default_credentials_lock = Lock()
+_pool_manager = ConnectionPoolManager()
+
+
+def get_credentials_watcher():
+    """Get the :class:`.CredentialsWatcher` shared by all proxies.
+    """
+    return _credentials_watcher
+
+
+def get_pool_manager():
+    """Get the :class:`.ConnectionPoolManager` shared by all proxies.
+    """
+    return _pool_manager
 
 
 class RequestsProxy(object):
@@ -39,9 +47,48 @@ class RequestsProxy(object):
         method_whitelist=Retry.DEFAULT_METHOD_WHITELIST | frozenset(["POST"])
     )
 
-    #: The number of connections to pool per Session.
+    #: The retry budget shared by every proxy in the process.  Set
+    #: this to None to retry failed requests regardless of how many
+    #: other requests are being retried.
+    RETRY_BUDGET = RetryBudget()
+
+    #: The default max number of seconds a call to :meth:`.request`
+    #: may take across all of its attempts, or None for no limit.
+    DEADLINE = None
+
+    #: An optional :class:`.CircuitBreaker` that fails requests to
+    #: unhealthy endpoints fast.  Endpoints are identified by
+    #: :meth:`_get_endpoint`.
+    CIRCUIT_BREAKER = None
+
+    #: An optional :class:`.HedgingPolicy` used to hedge idempotent
+    #: requests (see :meth:`_is_hedgeable`) that are slow to finish.
+    HEDGING_POLICY = None
+
+    #: An optional :class:`.ConcurrencyLimiter` that adapts the number
+    #: of requests in flight to throttling and latency.  Share one
+    #: limiter between proxy classes that count against the same quota.
+    CONCURRENCY_LIMITER = None
+
+    #: An optional :class:`.Instrumentation` whose hooks get called
+    #: around every request, attempt, retry and credentials refresh.
+    INSTRUMENTATION = None
+
+    #: The max number of connections to each host that proxies of
+    #: this type may open.  Connections are shared across threads.
     CONNECTION_POOL_SIZE = 32
 
+    #: An optional mapping from URLs to the number of connections to
+    #: open to their hosts whenever a proxy of this type is created,
+    #: so that the first requests don't have to wait on handshakes.
+    WARM_CONNECTIONS = None
+
+    #: Whether or not to multiplex requests over HTTP/2 connections.
+    #: Requires ``gcloud_requests[http2]``.  Set this to
+    #: ``"prior_knowledge"`` to speak HTTP/2 to plaintext endpoints
+    #: such as local emulators.
+    HTTP2 = False
+
     # A mapping from numeric Google RPC error codes to known error
     # code strings.
     _PB_ERROR_CODES = {
@@ -53,118 +100,410 @@ class RequestsProxy(object):
     }
 
     def __init__(self, credentials=None, logger=None):
-        if credentials is None:
-            credentials = google.auth.default()[0]
-            credentials = with_scopes_if_required(credentials, self.SCOPE)
-
         self.logger = logger or logging.getLogger(type(self).__name__)
-        self.credentials = credentials
-        _credentials_watcher.watch(credentials)
+        self._credentials = credentials
+        if credentials is not None:
+            _credentials_watcher.watch(credentials)
+
+        if self.WARM_CONNECTIONS:
+            self._warm_connections()
+
+    @property
+    def credentials(self):
+        """google.auth.credentials.Credentials: The credentials used to
+        authorize requests.  When none were given, the application
+        default credentials are looked up the first time they're needed.
+        """
+        if self._credentials is None:
+            with _default_credentials_lock:
+                if self._credentials is None:
+                    import google.auth
+
+                    from google.auth.credentials import with_scopes_if_required
+
+                    credentials = google.auth.default()[0]
+                    credentials = with_scopes_if_required(credentials, self.SCOPE)
+                    _credentials_watcher.watch(credentials)
+                    self._credentials = credentials
+        return self._credentials
 
     def __del__(self):
+        credentials = getattr(self, "_credentials", None)
+        if credentials is None:
+            return
+
         try:
-            _credentials_watcher.unwatch(self.credentials)
+            _credentials_watcher.unwatch(credentials)
         except TypeError:
             # This can happen when the daemon thread shuts down and
             # __del__() is implicitly ran. Crops up most commonly
             # in test suites as 'NoneType' object is not callable.
             pass
 
-    def request(self, method, url, data=None, headers=None, retries=0, refresh_attempts=0, **kwargs):
+    def request(self, method, url, data=None, headers=None, deadline=None, **kwargs):
+        r"""Make a request, refreshing credentials and retrying failed
+        requests as needed.
+
+        Parameters:
+          method(str)
+          url(str)
+          data(bytes)
+          headers(dict)
+          deadline(float): The max number of seconds all attempts may
+            take.  Defaults to :attr:`.DEADLINE`.
+          \**kwargs: Passed on to :meth:`requests.Session.request`.
+
+        Returns:
+          requests.Response
+        """
+        instrumentation = self.INSTRUMENTATION
+        if instrumentation is None:
+            return self._request(method, url, data, headers, deadline, None, **kwargs)
+
+        call = RequestCall(self, method, url, data)
+        instrumentation.before_request(call)
+        try:
+            response = self._request(method, url, data, headers, deadline, call, **kwargs)
+        except Exception as e:
+            instrumentation.after_request(call, error=e)
+            raise
+
+        instrumentation.after_request(call, response=response)
+        return response
+
+    def _request(self, method, url, data, headers, deadline, call, **kwargs):
+        from google.auth.exceptions import RefreshError
+        from google.auth.transport.requests import Request as AuthRequest
+
         session = self._get_session()
         headers = headers.copy() if headers is not None else {}
         auth_request = AuthRequest(session=session)
-        retry_auth = partial(
-            self.request,
-            url=url, method=method,
-            data=data, headers=headers,
-            refresh_attempts=refresh_attempts + 1,
-            retries=0,  # Retries intentionally get reset to 0.
-            **kwargs
-        )
+        expires_at = self._compute_expiry(deadline)
+        if self.RETRY_BUDGET is not None:
+            self.RETRY_BUDGET.deposit()
 
+        retries, refresh_attempts = 0, 0
+        while True:
+            try:
+                token = self._before_request(auth_request, method, url, headers, call)
+            except RefreshError:
+                if refresh_attempts < _max_refresh_attempts and not self._is_expired(expires_at):
+                    retries, refresh_attempts = 0, refresh_attempts + 1
+                    continue
+                raise
+
+            # Do not allow multiple timeout kwargs.
+            kwargs["timeout"] = self._compute_timeout(expires_at)
+            if expires_at is not None:
+                # The adapter's own retries stop at the deadline too.
+                kwargs["timeout"] = DeadlineTimeout(*kwargs["timeout"], expires_at=expires_at)
+
+            if call is None:
+                response = self._send_attempt(session, method, url, data=data, headers=headers, **kwargs)
+            else:
+                response = self._send_instrumented(
+                    call, session, method, url, data=data, headers=headers, **kwargs
+                )
+
+            if response.status_code in _refresh_status_codes and \
+               refresh_attempts < _max_refresh_attempts and not self._is_expired(expires_at):
+                self.logger.info(
+                    "Refreshing credentials due to a %s response. Attempt %s/%s.",
+                    response.status_code, refresh_attempts + 1, _max_refresh_attempts
+                )
+
+                # Release the connection in case the response was streamed.
+                response.close()
+                self._refresh_rejected_token(auth_request, call, token)
+
+                # Retries intentionally get reset to 0.
+                retries, refresh_attempts = 0, refresh_attempts + 1
+                continue
+
+            elif response.status_code >= 400:
+                backoff = self._compute_retry_backoff(response, retries, expires_at)
+                if backoff is not None:
+                    if call is not None:
+                        call.retries += 1
+                        self.INSTRUMENTATION.on_retry(call, self._get_retry_reason(response), backoff)
+
+                    response.close()
+                    time.sleep(backoff)
+                    retries += 1
+                    continue
+
+            return response
+
+    def _before_request(self, auth_request, method, url, headers, call):
+        # Expired credentials are refreshed through the watcher so
+        # that concurrent requests share a single refresh.
+        if not self.credentials.valid:
+            self._refresh(auth_request, call)
+
+        self.credentials.before_request(auth_request, method, url, headers)
+        return self.credentials.token
+
+    def _refresh_rejected_token(self, auth_request, call, token):
+        from google.auth.exceptions import RefreshError
+
+        # Failed refreshes are left for the next attempt's
+        # before_request to retry.
         try:
-            self.credentials.before_request(auth_request, method, url, headers)
+            self._refresh(auth_request, call, token)
         except RefreshError:
-            if refresh_attempts < _max_refresh_attempts:
-                return retry_auth()
+            pass
+
+    def _refresh(self, auth_request, call, token=None):
+        from google.auth.exceptions import RefreshError
+
+        start = time.time()
+        try:
+            refreshed = _credentials_watcher.refresh(self.credentials, auth_request, token)
+        except RefreshError as e:
+            if call is not None:
+                call.refreshes += 1
+                self.INSTRUMENTATION.on_refresh(call, time.time() - start, error=e)
             raise
 
-        # Do not allow multiple timeout kwargs.
-        kwargs["timeout"] = self.TIMEOUT_CONFIG
+        if refreshed and call is not None:
+            call.refreshes += 1
+            self.INSTRUMENTATION.on_refresh(call, time.time() - start)
+
+    def _send_instrumented(self, call, session, method, url, **kwargs):
+        instrumentation = self.INSTRUMENTATION
+        call.attempts += 1
+        instrumentation.before_attempt(call, kwargs["headers"])
 
-        response = session.request(method, url, data=data, headers=headers, **kwargs)
-        if response.status_code in _refresh_status_codes and refresh_attempts < _max_refresh_attempts:
-            self.logger.info(
-                "Refreshing credentials due to a %s response. Attempt %s/%s.",
-                response.status_code, refresh_attempts + 1, _max_refresh_attempts
+        _pool_manager.pop_pool_wait()
+        _pool_manager.pop_connect_time()
+        start = time.time()
+        try:
+            response = self._send_attempt(session, method, url, **kwargs)
+        except Exception as e:
+            instrumentation.after_attempt(
+                call, error=e, latency=time.time() - start,
+                pool_wait=_pool_manager.pop_pool_wait(),
+                connect_time=_pool_manager.pop_connect_time(),
             )
+            raise
 
+        instrumentation.after_attempt(
+            call, response=response, latency=time.time() - start,
+            pool_wait=_pool_manager.pop_pool_wait(),
+            connect_time=_pool_manager.pop_connect_time(),
+        )
+        return response
+
+    def _get_session(self):
+        # Ensure we use one connection-pooling session per proxy type,
+        # shared between all threads.
+        return _pool_manager.get_session(self)
+
+    def _warm_connections(self):
+        for url, connections in self.WARM_CONNECTIONS.items():
             try:
-                self.credentials.refresh(auth_request)
-            except RefreshError:
-                pass
+                _pool_manager.warm(type(self), url, connections)
+            except Exception:
+                self.logger.warning("Failed to warm connections to %r.", url, exc_info=True)
+
+    def _send_attempt(self, session, method, url, **kwargs):
+        policy = self.HEDGING_POLICY
+        if policy is None or not self._is_hedgeable(method, url):
+            return self._send_limited(session, method, url, **kwargs)
+
+        def send(cancellation):
+            with _pool_manager.cancellable(cancellation):
+                return self._send_limited(session, method, url, **kwargs)
+
+        return policy.send(self._get_endpoint(method, url), send)
+
+    def _send_limited(self, session, method, url, **kwargs):
+        # Requests that time out waiting for a slot never reach the
+        # endpoint, so the limiter wraps the circuit breaker rather
+        # than count against it.
+        limiter = self.CONCURRENCY_LIMITER
+        if limiter is None:
+            return self._send_guarded(session, method, url, **kwargs)
+
+        expires_at = getattr(kwargs.get("timeout"), "expires_at", None)
+        limiter.acquire(max(expires_at - time.time(), 0) if expires_at is not None else None)
+        start = time.time()
+        try:
+            response = self._send_guarded(session, method, url, **kwargs)
+        except Exception:
+            # Failures, including cancelled copies of hedged requests,
+            # give their slot back without adjusting the limit.
+            limiter.release()
+            raise
+
+        limiter.release(time.time() - start, self._is_throttled(response))
+        return response
 
-            return retry_auth()
+    def _send_guarded(self, session, method, url, **kwargs):
+        breaker = self.CIRCUIT_BREAKER
+        if breaker is None:
+            return session.request(method, url, **kwargs)
 
-        elif response.status_code >= 400:
-            response = self._handle_response_error(
-                response, retries,
-                url=url, method=method,
-                data=data, headers=headers,
-                **kwargs
-            )
+        endpoint = self._get_endpoint(method, url)
+        if not breaker.allow(endpoint):
+            raise CircuitOpen(endpoint)
+
+        try:
+            response = session.request(method, url, **kwargs)
+        except Exception:
+            # Copies of hedged requests that lose the race fail because
+            # they're cancelled, which says nothing about the endpoint.
+            breaker.record(endpoint, None if _pool_manager.is_cancelled() else False)
+            raise
 
+        breaker.record(endpoint, not self._is_endpoint_failure(response))
         return response
 
-    def _get_session(self):
-        # Ensure we use one connection-pooling session per thread and
-        # make use of requests' internal retry mechanism. It will
-        # safely retry any requests that failed due to DNS lookup,
-        # socket errors, etc.
-        session = getattr(_state, "session", None)
-        if session is None:
-            session = _state.session = requests.Session()
-            adapter = _state.adapter = requests.adapters.HTTPAdapter(
-                max_retries=self.RETRY_CONFIG,
-                pool_connections=self.CONNECTION_POOL_SIZE,
-                pool_maxsize=self.CONNECTION_POOL_SIZE,
-            )
-            session.mount("http://", adapter)
-            session.mount("https://", adapter)
-        return session
+    def _get_endpoint(self, method, url):
+        """Subclasses may override this method in order to influence
+        how requests are grouped into circuits.
+
+        Parameters:
+          method(str): The request's HTTP method.
+          url(str): The request's URL.
+
+        Returns:
+          tuple: The host and the RPC method (eg. ``lookup``) or, for
+          plain REST endpoints, the HTTP method.
+        """
+        return urlparse(url).netloc, self._get_rpc_method(method, url)
+
+    def _get_service(self, url):
+        """Get the name of the service a URL belongs to, eg.
+        ``datastore`` for Datastore API URLs.
+
+        Returns:
+          str
+        """
+        parts = urlparse(url)
+        hostname = parts.hostname or ""
+        if hostname.endswith(".googleapis.com"):
+            return hostname[:-len(".googleapis.com")]
+        return parts.netloc
+
+    def _get_rpc_method(self, method, url):
+        """Get the RPC method a request calls, eg. ``lookup``, or its
+        HTTP method for plain REST endpoints.
+
+        Returns:
+          str
+        """
+        path, _, rpc_method = urlparse(url).path.rpartition(":")
+        return rpc_method if path else method
 
-    def _handle_response_error(self, response, retries, **kwargs):
-        r"""Provides a way for each connection wrapper to handle error
-        responses.
+    def _is_hedgeable(self, method, url):
+        """Subclasses may override this method in order to influence
+        which requests may be hedged.  Only idempotent requests should
+        ever be hedged.
 
         Parameters:
-          response(Response): An instance of :class:`.requests.Response`.
-          retries(int): The number of times :meth:`.request` has been
-            called so far.
-          \**kwargs: The parameters with which :meth:`.request` was
-            called.  The `retries` parameter is excluded from `kwargs`
-            intentionally.
+          method(str): The request's HTTP method.
+          url(str): The request's URL.
 
         Returns:
-          requests.Response
+          bool
         """
-        error = self._convert_response_to_error(response)
-        if error is None:
-            return response
+        return method in ("GET", "HEAD")
+
+    def _is_throttled(self, response):
+        """Subclasses may override this method in order to influence
+        which responses shrink the :attr:`.CONCURRENCY_LIMITER`'s limit.
+
+        Returns:
+          bool
+        """
+        # Quota errors, including RESOURCE_EXHAUSTED, are always 429s.
+        return response.status_code == 429
+
+    def _is_endpoint_failure(self, response):
+        """Subclasses may override this method in order to influence
+        which responses count against an endpoint's circuit.
+
+        Returns:
+          bool
+        """
+        return response.status_code >= 500
+
+    def _compute_retry_backoff(self, response, retries, expires_at):
+        """Decides whether or not an error response should be retried.
 
-        max_retries = self._max_retries_for_error(error)
+        Parameters:
+          response(Response): An instance of :class:`.requests.Response`.
+          retries(int): The number of times the request has been
+            retried so far.
+          expires_at(float): The time by which the request must be
+            done, or None.
+
+        Returns:
+          float or None: The number of seconds to sleep for before
+          retrying or None if the request shouldn't be retried.
+        """
+        max_retries = self._max_retries_for_response(response)
         if max_retries is None or retries >= max_retries:
-            return response
+            return None
+
+        backoff = self._compute_backoff(retries)
+        if expires_at is not None and time.time() + backoff >= expires_at:
+            self.logger.warning("Not retrying failed request because its deadline would be exceeded.")
+            return None
 
-        backoff = min(0.0625 * 2 ** retries, 1.0)
-        self.logger.warning("Sleeping for %r before retrying failed request...", backoff)
-        time.sleep(backoff)
+        if self.RETRY_BUDGET is not None and not self.RETRY_BUDGET.acquire():
+            self.logger.warning("Not retrying failed request because the retry budget is exhausted.")
+            return None
 
-        retries += 1
-        self.logger.warning("Retrying failed request. Attempt %d/%d.", retries, max_retries)
+        self.logger.warning(
+            "Retrying failed request in %.3f seconds. Attempt %d/%d.",
+            backoff, retries + 1, max_retries
+        )
+        return backoff
+
+    def _compute_backoff(self, retries):
+        """Computes the number of seconds to sleep for before retrying
+        a failed request.  See :func:`.full_jitter`.
+
+        Parameters:
+          retries(int): The number of times the request has been
+            retried so far.
+
+        Returns:
+          float
+        """
+        return full_jitter(retries)
+
+    def _compute_expiry(self, deadline):
+        if deadline is None:
+            deadline = self.DEADLINE
+        if deadline is None:
+            return None
+        return time.time() + deadline
 
-        return self.request(retries=retries, **kwargs)
+    def _compute_timeout(self, expires_at):
+        # Caps each attempt's timeouts at the time left until the
+        # deadline.
+        if expires_at is None:
+            return self.TIMEOUT_CONFIG
+
+        remaining = max(expires_at - time.time(), 0.001)
+        connect_timeout, read_timeout = self.TIMEOUT_CONFIG
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+    def _is_expired(self, expires_at):
+        return expires_at is not None and time.time() >= expires_at
+
+    def _get_retry_reason(self, response):
+        error = self._convert_response_to_error(response) or {}
+        return str(error.get("status") or error.get("code") or response.status_code)
+
+    def _max_retries_for_response(self, response):
+        error = self._convert_response_to_error(response)
+        if error is None:
+            return None
+        return self._max_retries_for_error(error)
 
     def _convert_response_to_error(self, response):
         """Subclasses may override this method in order to influence
@@ -179,6 +518,10 @@ class RequestsProxy(object):
         """
         content_type = response.headers.get("content-type", "")
         if "application/x-protobuf" in content_type:
+            # Protobuf errors are rare enough that their decoder is only
+            # loaded once one shows up.
+            from google.rpc import status_pb2
+
             self.logger.debug("Decoding protobuf response.")
             data = status_pb2.Status.FromString(response.content)
             status = self._PB_ERROR_CODES.get(data.code)
@@ -0,0 +1,175 @@
+import base64
+import json
+import logging
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Thread
+
+
+class _Batch(object):
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.messages = []
+        self.futures = []
+        self.size = 0
+
+
+class PubSubPublisher(object):
+    """Buffers messages per topic and publishes them in batches
+    through a :class:`.PubSubRequestsProxy`.
+
+    A topic's batch is flushed once it holds `max_messages` messages
+    or `max_bytes` bytes, or `max_latency` seconds after its first
+    message was added, whichever comes first.  Flushes run on a pool
+    of `max_workers` threads and are retried by the proxy according to
+    its `_MAX_RETRIES` table.  When more than `max_outstanding_bytes`
+    bytes have been published but not yet acknowledged by the server,
+    :meth:`publish` blocks until some of them are.
+
+    Parameters:
+      proxy(PubSubRequestsProxy): The proxy to publish through.
+      max_messages(int): The max number of messages per batch.
+      max_bytes(int): The max size of a batch's message data in bytes.
+      max_latency(float): The max number of seconds a message may be
+        buffered for.
+      max_workers(int): The max number of batches to publish at once.
+      max_outstanding_bytes(int): The max number of bytes that may be
+        waiting to be published before publishing blocks.
+    """
+
+    def __init__(self, proxy, max_messages=100, max_bytes=1024 * 1024, max_latency=0.01,
+                 max_workers=4, max_outstanding_bytes=64 * 1024 * 1024, logger=None):
+        self.proxy = proxy
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.max_outstanding_bytes = max_outstanding_bytes
+        self.logger = logger or logging.getLogger("gcloud_requests.PubSubPublisher")
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._updated = Condition()
+        self._batches = {}
+        self._outstanding_bytes = 0
+        self._running = True
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def publish(self, topic, data, **attributes):
+        """Publish a message.
+
+        Parameters:
+          topic(str): The full name of the topic, eg.
+            ``projects/example/topics/example``.
+          data(bytes): The message data.
+          \\**attributes: The message's attributes.
+
+        Returns:
+          Future: A future that resolves to the message's id.
+          Cancelling it before its batch is sent drops the message.
+        """
+        message = {"data": base64.b64encode(data).decode("ascii")}
+        if attributes:
+            message["attributes"] = attributes
+
+        size = len(data) + sum(len(key) + len(value) for key, value in attributes.items())
+        future = Future()
+        with self._updated:
+            if not self._running:
+                raise RuntimeError("Cannot publish after the publisher has been stopped.")
+
+            # Apply backpressure when too many bytes are in flight.
+            # A single message is always allowed through.
+            while self._outstanding_bytes and self._outstanding_bytes + size > self.max_outstanding_bytes:
+                self._updated.wait()
+
+            batch = self._batches.get(topic)
+            if batch is not None and (len(batch.messages) >= self.max_messages or
+                                      batch.size + size > self.max_bytes):
+                self._flush(topic)
+                batch = None
+
+            if batch is None:
+                batch = self._batches[topic] = _Batch(time.time() + self.max_latency)
+                self._updated.notify_all()
+
+            batch.messages.append(message)
+            batch.futures.append(future)
+            batch.size += size
+            self._outstanding_bytes += size
+            if len(batch.messages) >= self.max_messages or batch.size >= self.max_bytes:
+                self._flush(topic)
+
+        return future
+
+    def flush(self):
+        """Publish every buffered message right away.
+        """
+        with self._updated:
+            for topic in list(self._batches):
+                self._flush(topic)
+
+    def stop(self):
+        """Publish every buffered message and wait for all of them to
+        be published.
+        """
+        with self._updated:
+            self._running = False
+            for topic in list(self._batches):
+                self._flush(topic)
+            self._updated.notify_all()
+
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+    def _run(self):
+        with self._updated:
+            while self._running:
+                now = time.time()
+                for topic, batch in list(self._batches.items()):
+                    if batch.deadline <= now:
+                        self._flush(topic)
+
+                deadlines = [batch.deadline for batch in self._batches.values()]
+                self._updated.wait(timeout=min(deadlines) - now if deadlines else None)
+
+    def _flush(self, topic):
+        batch = self._batches.pop(topic)
+        self._executor.submit(self._publish, topic, batch)
+
+    def _publish(self, topic, batch):
+        # Messages whose futures were cancelled are dropped and the
+        # rest can no longer be cancelled once they're being published.
+        futures, messages = [], []
+        for future, message in zip(batch.futures, batch.messages):
+            if future.set_running_or_notify_cancel():
+                futures.append(future)
+                messages.append(message)
+
+        try:
+            if messages:
+                self._publish_messages(topic, futures, messages)
+        finally:
+            with self._updated:
+                self._outstanding_bytes -= batch.size
+                self._updated.notify_all()
+
+    def _publish_messages(self, topic, futures, messages):
+        self.logger.debug("Publishing %d messages to %r.", len(messages), topic)
+        try:
+            response = self.proxy.request(
+                "POST", "{}/v1/{}:publish".format(self.proxy.API_URL, topic),
+                data=json.dumps({"messages": messages}),
+                headers={"content-type": "application/json"},
+            )
+            response.raise_for_status()
+            message_ids = response.json()["messageIds"]
+        except Exception as e:
+            self.logger.warning("Failed to publish %d messages to %r.", len(messages), topic, exc_info=True)
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, message_id in zip(futures, message_ids):
+            future.set_result(message_id)
@@ -14,6 +14,9 @@ class PubSubRequestsProxy(RequestsProxy):
         "https://www.googleapis.com/auth/cloud-platform",
     )
 
+    #: The base URL of the PubSub API.
+    API_URL = "https://pubsub.googleapis.com"
+
     # A mapping from PubSub error states that can be retried to the
     # maximum number of times each one should be retried.
     _MAX_RETRIES = {
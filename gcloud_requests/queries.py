@@ -0,0 +1,197 @@
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Lock
+
+
+class _Query(object):
+    """The pages of a single query that have been handed to the
+    caller or fetched on its behalf.
+    """
+
+    def __init__(self):
+        self.claimed = 0
+        self.claimed_at = time.time()
+        self.tail = None
+        self.cancelled = False
+
+
+class _Page(object):
+    def __init__(self, query, index, url, request, headers):
+        self.query = query
+        self.index = index
+        self.url = url
+        self.request = request
+        self.headers = headers
+        self.done = Event()
+        self.future = None
+        self.response = None
+        self.next_request = None
+
+
+class QueryPrefetcher(object):
+    """Fetches the next pages of Datastore queries while the caller
+    is still processing the current ones.
+
+    Clients page through query results by re-running the query from
+    the end cursor of the previous batch.  Whenever a batch says there
+    are more results, the request for the next page is predicted and
+    sent in the background.  When the caller then asks for exactly
+    that page, it gets the prefetched response instead of waiting on
+    another round trip.  At most `depth` pages are fetched ahead of the
+    last page the caller asked for.
+
+    Callers that stop paging never ask for the pages that were fetched
+    for them so, once a query's pages have gone unclaimed for `timeout`
+    seconds, they're dropped and any that haven't been sent yet are
+    cancelled.
+
+    Parameters:
+      send(callable): The function used to send queries.  It's called
+        with the same arguments as :meth:`.RequestsProxy.request`.
+      depth(int): The max number of pages to fetch ahead.
+      timeout(float): The max number of seconds to keep unclaimed
+        pages around for.
+      max_workers(int): The max number of pages to fetch at once.
+    """
+
+    def __init__(self, send, depth, timeout=30, max_workers=8, logger=None):
+        # The Datastore protos are only available when
+        # google-cloud-datastore is installed.
+        from google.cloud.datastore_v1.proto import datastore_pb2, query_pb2
+
+        self.datastore_pb2 = datastore_pb2
+        self.query_pb2 = query_pb2
+        self.send = send
+        self.depth = depth
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.logger = logger or logging.getLogger("gcloud_requests.QueryPrefetcher")
+        self._lock = Lock()
+        self._pages = {}
+        self._executor = None
+
+    def can_prefetch(self, request):
+        """Determine whether or not the pages of a query can be
+        prefetched.
+
+        Parameters:
+          request(RunQueryRequest)
+
+        Returns:
+          bool
+        """
+        # GQL queries can't be continued from a cursor without
+        # rewriting them, and reads inside transactions must stay in
+        # the caller's thread.
+        return request.HasField("query") and not request.read_options.transaction
+
+    def run_query(self, url, request, headers):
+        """Run a query, using a prefetched response if there is one
+        and prefetching the pages that follow it.
+
+        Parameters:
+          url(str): The runQuery URL.
+          request(RunQueryRequest): A request accepted by :meth:`can_prefetch`.
+          headers(dict): The request headers.
+
+        Returns:
+          requests.Response
+        """
+        with self._lock:
+            self._expire(time.time())
+            page = self._pages.pop(self._key(url, request), None)
+
+        if page is not None:
+            page.done.wait()
+            if page.response is not None and page.response.status_code == 200:
+                self.logger.debug("Using prefetched page %d of query.", page.index)
+                with self._lock:
+                    query = page.query
+                    query.claimed, query.claimed_at = page.index, time.time()
+                    self._advance(query)
+                return page.response
+
+            # Failed prefetches are retried in the caller's thread so
+            # that it sees their errors first-hand.
+            with self._lock:
+                self._cancel(page.query)
+
+        response = self.send("POST", url, data=request.SerializeToString(), headers=headers)
+        if response.status_code == 200:
+            page = _Page(_Query(), 0, url, request, headers)
+            page.response = response
+            page.next_request = self._next_request(request, response)
+            page.done.set()
+            with self._lock:
+                page.query.tail = page
+                self._advance(page.query)
+        return response
+
+    def _advance(self, query):
+        # Must be called while holding the lock.
+        tail = query.tail
+        if query.cancelled or not tail.done.is_set() or tail.next_request is None or \
+           tail.index >= query.claimed + self.depth:
+            return
+
+        page = _Page(query, tail.index + 1, tail.url, tail.next_request, tail.headers)
+        self._pages[self._key(page.url, page.request)] = query.tail = page
+        page.future = self._get_executor().submit(self._fetch, page)
+
+    def _fetch(self, page):
+        try:
+            data = page.request.SerializeToString()
+            page.response = self.send("POST", page.url, data=data, headers=page.headers)
+            if page.response.status_code == 200:
+                page.next_request = self._next_request(page.request, page.response)
+        except Exception:
+            self.logger.warning("Failed to prefetch page %d of query.", page.index, exc_info=True)
+        finally:
+            page.done.set()
+
+        with self._lock:
+            self._advance(page.query)
+
+    def _next_request(self, request, response):
+        batch = self.datastore_pb2.RunQueryResponse.FromString(response.content).batch
+        if batch.more_results != self.query_pb2.QueryResultBatch.NOT_FINISHED:
+            return None
+
+        # Mirror the way clients continue queries: from the end cursor,
+        # less whatever the previous batch returned or skipped.
+        next_request = self.datastore_pb2.RunQueryRequest()
+        next_request.CopyFrom(request)
+        query = next_request.query
+        query.start_cursor = batch.end_cursor
+        query.offset = max(query.offset - batch.skipped_results, 0)
+        if query.HasField("limit"):
+            query.limit.value -= len(batch.entity_results)
+            if query.limit.value <= 0:
+                return None
+        return next_request
+
+    def _expire(self, now):
+        # Must be called while holding the lock.
+        for page in list(self._pages.values()):
+            if now - page.query.claimed_at > self.timeout:
+                self._cancel(page.query)
+
+    def _cancel(self, query):
+        # Must be called while holding the lock.
+        query.cancelled = True
+        for key, page in list(self._pages.items()):
+            if page.query is query:
+                del self._pages[key]
+                if page.future is not None and page.future.cancel():
+                    page.done.set()
+
+    def _key(self, url, request):
+        return url, request.SerializeToString(deterministic=True)
+
+    def _get_executor(self):
+        # Must be called while holding the lock.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
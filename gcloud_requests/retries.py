@@ -0,0 +1,80 @@
+import random
+import time
+
+from threading import Lock
+
+
+def full_jitter(retries):
+    """Computes the number of seconds to sleep for before retrying
+    a failed request.  Uses "full jitter" so that clients that fail at
+    the same time don't retry in lockstep.
+
+    Parameters:
+      retries(int): The number of times the request has been retried
+        so far.
+
+    Returns:
+      float
+    """
+    return random.uniform(0, min(0.0625 * 2 ** retries, 1.0))
+
+
+class RetryBudget(object):
+    """A token bucket that limits how often failed requests may be
+    retried across every proxy that shares it.
+
+    Every retry withdraws one token.  Tokens are added back at a fixed
+    rate and every request deposits a fraction of a token, so the
+    number of retries scales with traffic but can't multiply the load
+    on a backend that is already failing.
+
+    Parameters:
+      max_tokens(float): The max number of tokens the bucket can hold.
+      tokens_per_second(float): The rate at which tokens are added back.
+      tokens_per_request(float): The number of tokens every request
+        deposits.
+    """
+
+    def __init__(self, max_tokens=100, tokens_per_second=10, tokens_per_request=0.1):
+        self.max_tokens = max_tokens
+        self.tokens_per_second = tokens_per_second
+        self.tokens_per_request = tokens_per_request
+
+        self._lock = Lock()
+        self._tokens = float(max_tokens)
+        self._updated_at = time.time()
+
+    @property
+    def tokens(self):
+        """float: The number of tokens currently in the bucket.
+        """
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def deposit(self):
+        """Record that a request is being made.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens + self.tokens_per_request, self.max_tokens)
+
+    def acquire(self):
+        """Attempt to withdraw a token for a retry.
+
+        Returns:
+          bool: Whether or not the retry may go ahead.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+
+            self._tokens -= 1
+            return True
+
+    def _refill(self):
+        now = time.time()
+        elapsed = max(now - self._updated_at, 0)
+        self._tokens = min(self._tokens + elapsed * self.tokens_per_second, self.max_tokens)
+        self._updated_at = now
@@ -0,0 +1,310 @@
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from six.moves import queue
+from threading import Event, Lock
+
+#: The number of scatter keys to sample per partition.
+KEYS_PER_SPLIT = 32
+
+# Marks the end of a partition's results.
+_DONE = object()
+
+
+def _key_order(key):
+    # Datastore orders keys by their path, with ids before names.
+    path = []
+    for element in key.path:
+        if element.WhichOneof("id_type") == "id":
+            path.append((element.kind, 0, element.id))
+        else:
+            path.append((element.kind, 1, element.name))
+    return tuple(path)
+
+
+class QuerySplitter(object):
+    """Splits Datastore queries into key-range partitions and runs
+    the partitions concurrently through a :class:`.DatastoreRequestsProxy`.
+
+    Split points are picked from a sample of keys ordered by the
+    ``__scatter__`` property, which Datastore sets on a random subset
+    of entities, the same way Datastore's own query splitter does.
+    Every partition pages through its key range on a pool of up to
+    `max_workers` threads per query and its requests are retried by
+    the proxy according to its `_MAX_RETRIES` table and limited by its
+    `CONCURRENCY_LIMITER`, if any.
+
+    Only queries over a single kind without inequality filters,
+    sort orders, limits or offsets can be split.
+
+    Splitters can be used as context managers, in which case they're
+    closed on exit.
+
+    Parameters:
+      proxy(DatastoreRequestsProxy): The proxy to run queries through.
+      max_workers(int): The max number of partitions of each query
+        to run at once.
+      max_buffered_batches(int): The max number of result batches
+        each partition may fetch ahead of the caller.
+    """
+
+    def __init__(self, proxy, max_workers=8, max_buffered_batches=4, logger=None):
+        # The Datastore protos are only available when
+        # google-cloud-datastore is installed.
+        from google.cloud.datastore_v1.proto import datastore_pb2, query_pb2
+
+        self.datastore_pb2 = datastore_pb2
+        self.query_pb2 = query_pb2
+        self.proxy = proxy
+        self.max_buffered_batches = max_buffered_batches
+        self.logger = logger or logging.getLogger("gcloud_requests.QuerySplitter")
+        self.max_workers = max_workers
+        self._lock = Lock()
+        self._running = {}
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Stop every running query and shut down the worker threads.
+        """
+        with self._lock:
+            self._closed = True
+            running = list(self._running.items())
+
+        for stop, executor in running:
+            stop.set()
+            executor.shutdown(wait=True)
+
+    def split(self, project_id, query, partitions, partition_id=None, read_options=None):
+        """Split a query into key-range partitions.
+
+        Parameters:
+          project_id(str): The project to query.
+          query(Query): The query to split.
+          partitions(int): The desired number of partitions.  Fewer
+            are returned when the kind has too few scatter entities.
+          partition_id(PartitionId): The namespace to query.
+          read_options(ReadOptions): The options to sample keys with.
+
+        Raises:
+          ValueError: If the query can't be split.
+          requests.HTTPError: If sampling keys fails.
+
+        Returns:
+          list[Query]: The partitions, in key order.
+        """
+        self._validate(query)
+        if partitions <= 1:
+            return [self._copy(query)]
+
+        keys = sorted(self._get_scatter_keys(project_id, query, partitions, partition_id, read_options),
+                      key=_key_order)
+        if len(keys) < partitions - 1:
+            partitions = len(keys) + 1
+
+        # Split points are spread evenly across the sampled keys.
+        split_keys = [keys[i * len(keys) // partitions] for i in range(1, partitions)]
+        return [
+            self._create_split(query, start_key, end_key)
+            for start_key, end_key in zip([None] + split_keys, split_keys + [None])
+        ]
+
+    def run(self, project_id, query, partitions, partition_id=None, read_options=None, ordered=True):
+        """Split a query and run its partitions concurrently.
+
+        The partitions start running when the first result is
+        requested from the returned iterator and they stop running when
+        it's exhausted, closed or garbage collected.
+
+        Parameters:
+          project_id(str): The project to query.
+          query(Query): The query to run.
+          partitions(int): The desired number of partitions.
+          partition_id(PartitionId): The namespace to query.
+          read_options(ReadOptions): The options to read with.
+          ordered(bool): Whether to return results in partition order,
+            which is key order, or as soon as they arrive.
+
+        Raises:
+          ValueError: If the query can't be split.
+          requests.HTTPError: If any of the partitions fails.
+
+        Returns:
+          iterator[EntityResult]
+        """
+        queries = self.split(project_id, query, partitions, partition_id, read_options)
+        requests = [self._make_request(project_id, q, partition_id, read_options) for q in queries]
+        return self._iter_results(requests, ordered)
+
+    def _iter_results(self, requests, ordered):
+        # Ordered results are read from each partition's queue in turn.
+        # Otherwise, every partition shares a single queue.
+        if ordered:
+            queues = [queue.Queue(self.max_buffered_batches) for _ in requests]
+        else:
+            queues = [queue.Queue(self.max_buffered_batches * len(requests))]
+
+        # Every query gets its own workers.  Partitions start in order
+        # so the one an ordered caller is waiting on always has one,
+        # which a pool shared with other queries can't guarantee.
+        stop, futures = Event(), []
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(requests)))
+        with self._lock:
+            if self._closed:
+                executor.shutdown(wait=False)
+                raise RuntimeError("The splitter is closed.")
+            self._running[stop] = executor
+
+        # The workers are tracked until every partition is done, so
+        # that closing the splitter waits for stopped ones to exit.
+        remaining = [len(requests)]
+
+        def partition_done(future):
+            with self._lock:
+                remaining[0] -= 1
+                if not remaining[0]:
+                    self._running.pop(stop, None)
+
+        try:
+            self.logger.debug("Running query in %d partitions.", len(requests))
+            for i, request in enumerate(requests):
+                partition_queue = queues[i % len(queues)]
+                futures.append(executor.submit(self._run_partition, request, partition_queue, stop))
+                futures[-1].add_done_callback(partition_done)
+
+            done = 0
+            while done < len(requests):
+                item = queues[done % len(queues)].get()
+                if item is _DONE:
+                    done += 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    for result in item:
+                        yield result
+        finally:
+            stop.set()
+
+            # Partitions that haven't started are cancelled and the
+            # ones that have notice the stop at their next batch.
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _run_partition(self, request, partition_queue, stop):
+        try:
+            while not stop.is_set():
+                batch = self._run_query(request)
+                self._put(partition_queue, list(batch.entity_results), stop)
+                if batch.more_results != self.query_pb2.QueryResultBatch.NOT_FINISHED:
+                    break
+
+                request.query.start_cursor = batch.end_cursor
+        except Exception as e:
+            self._put(partition_queue, e, stop)
+        finally:
+            self._put(partition_queue, _DONE, stop)
+
+    def _put(self, partition_queue, item, stop):
+        # Partitions that get ahead of the caller wait for it to catch
+        # up, unless it's stopped iterating.
+        while not stop.is_set():
+            try:
+                return partition_queue.put(item, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def _get_scatter_keys(self, project_id, query, partitions, partition_id, read_options):
+        # Each partition covers the keys up to its split point, except
+        # for the last one, so it doesn't need one.
+        scatter_query = self.query_pb2.Query(kind=query.kind)
+        scatter_query.order.add(property=self.query_pb2.PropertyReference(name="__scatter__"))
+        scatter_query.projection.add(property=self.query_pb2.PropertyReference(name="__key__"))
+        scatter_query.limit.value = (partitions - 1) * KEYS_PER_SPLIT
+
+        request = self._make_request(project_id, scatter_query, partition_id, read_options)
+        keys = []
+        while True:
+            batch = self._run_query(request)
+            keys.extend(result.entity.key for result in batch.entity_results)
+            if batch.more_results != self.query_pb2.QueryResultBatch.NOT_FINISHED:
+                return keys
+
+            request.query.start_cursor = batch.end_cursor
+            request.query.limit.value -= len(batch.entity_results)
+
+    def _run_query(self, request):
+        response = self.proxy.request(
+            "POST", "{}/v1/projects/{}:runQuery".format(self.proxy.API_URL, request.project_id),
+            data=request.SerializeToString(),
+            headers={"Content-Type": "application/x-protobuf"},
+        )
+        response.raise_for_status()
+        return self.datastore_pb2.RunQueryResponse.FromString(response.content).batch
+
+    def _validate(self, query):
+        if len(query.kind) != 1:
+            raise ValueError("Only queries over a single kind can be split.")
+        if query.HasField("limit") or query.offset:
+            raise ValueError("Queries with limits or offsets can't be split.")
+        if query.order:
+            raise ValueError("Queries with sort orders can't be split.")
+        if self._has_inequality_filter(query.filter):
+            raise ValueError("Queries with inequality filters can't be split.")
+
+    def _has_inequality_filter(self, query_filter):
+        filter_type = query_filter.WhichOneof("filter_type")
+        if filter_type == "composite_filter":
+            return any(self._has_inequality_filter(f) for f in query_filter.composite_filter.filters)
+        if filter_type == "property_filter":
+            return query_filter.property_filter.op not in (
+                self.query_pb2.PropertyFilter.EQUAL,
+                self.query_pb2.PropertyFilter.HAS_ANCESTOR,
+            )
+        return False
+
+    def _create_split(self, query, start_key, end_key):
+        filters = []
+        if query.filter.WhichOneof("filter_type") == "composite_filter":
+            filters.extend(query.filter.composite_filter.filters)
+        elif query.HasField("filter"):
+            filters.append(query.filter)
+        if start_key is not None:
+            filters.append(self._key_filter(self.query_pb2.PropertyFilter.GREATER_THAN_OR_EQUAL, start_key))
+        if end_key is not None:
+            filters.append(self._key_filter(self.query_pb2.PropertyFilter.LESS_THAN, end_key))
+
+        split_query = self._copy(query)
+        split_query.ClearField("filter")
+        if len(filters) == 1:
+            split_query.filter.CopyFrom(filters[0])
+        else:
+            split_query.filter.composite_filter.op = self.query_pb2.CompositeFilter.AND
+            split_query.filter.composite_filter.filters.extend(filters)
+        return split_query
+
+    def _key_filter(self, op, key):
+        property_filter = self.query_pb2.PropertyFilter(
+            property=self.query_pb2.PropertyReference(name="__key__"),
+            op=op,
+        )
+        property_filter.value.key_value.CopyFrom(key)
+        return self.query_pb2.Filter(property_filter=property_filter)
+
+    def _make_request(self, project_id, query, partition_id, read_options):
+        request = self.datastore_pb2.RunQueryRequest(project_id=project_id, query=query)
+        if partition_id is not None:
+            request.partition_id.CopyFrom(partition_id)
+        if read_options is not None:
+            request.read_options.CopyFrom(read_options)
+        return request
+
+    def _copy(self, query):
+        query_copy = self.query_pb2.Query()
+        query_copy.CopyFrom(query)
+        return query_copy
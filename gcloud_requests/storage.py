@@ -1,5 +1,49 @@
+import json
+import mmap
+import os
+import re
+import socket
+import uuid
+
+import requests
+import six
+
+from requests.packages.urllib3.exceptions import ProtocolError, ReadTimeoutError
+from six.moves.http_client import HTTPException
+
+from concurrent.futures import ThreadPoolExecutor
+from six.moves.urllib.parse import quote, urlparse
+
+from . import crc32c, streaming
 from .proxy import RequestsProxy
 
+# The errors that can interrupt a range's body part way through.
+_RANGE_READ_ERRORS = (
+    requests.ConnectionError, requests.exceptions.ChunkedEncodingError, requests.exceptions.ReadTimeout,
+    ProtocolError, ReadTimeoutError, HTTPException, socket.error,
+)
+
+
+class DataCorruption(Exception):
+    """Raised when the data that was transferred doesn't match its
+    expected size or checksum.
+    """
+
+
+class _RangeProgress(object):
+    """The offset up to which a byte range has been downloaded and the
+    checksum of the data so far.
+    """
+
+    def __init__(self, offset):
+        self.offset = offset
+        self.checksum = 0
+
+    def advance(self, data, validate):
+        if validate:
+            self.checksum = crc32c.extend(self.checksum, data)
+        self.offset += len(data)
+
 
 class CloudStorageRequestsProxy(RequestsProxy):
     """A GCS-specific RequestsProxy.
@@ -19,6 +63,37 @@ class CloudStorageRequestsProxy(RequestsProxy):
     #: by this proxy.
     TIMEOUT_CONFIG = (3.05, 30)
 
+    #: The base URL of the GCS JSON API.
+    API_URL = "https://storage.googleapis.com"
+
+    #: The size of each byte range fetched by :meth:`download`.
+    DOWNLOAD_CHUNK_SIZE = 32 * 1024 * 1024
+
+    #: The max number of byte ranges fetched at once by :meth:`download`.
+    DOWNLOAD_PARALLELISM = 8
+
+    #: The size of the buffer each range is streamed through.  Ranges
+    #: that fail part way through resume from the last full buffer.
+    DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+    #: The max number of times :meth:`download` resumes a range after
+    #: its body fails part way through.
+    DOWNLOAD_MAX_RESUMES = 5
+
+    #: The size of each chunk sent by :meth:`upload`.  Must be a
+    #: multiple of 256KiB.
+    UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+    #: The max number of parts uploaded at once by :meth:`upload`.
+    UPLOAD_PARALLELISM = 1
+
+    #: The max number of times :meth:`upload` resumes a resumable
+    #: upload after a chunk fails.
+    UPLOAD_MAX_RESUMES = 5
+
+    # The max number of source objects in a single compose call.
+    _MAX_COMPOSE_SOURCES = 32
+
     # A mapping from GCS error codes that can be retried to the
     # maximum number of times each one should be retried.
     _MAX_RETRIES = {
@@ -35,6 +110,12 @@ class CloudStorageRequestsProxy(RequestsProxy):
 
         return super(CloudStorageRequestsProxy, self)._convert_response_to_error(response)
 
+    def _get_endpoint(self, method, url):
+        # Individual buckets can degrade so they get their own circuits.
+        parts = urlparse(url)
+        match = re.search(r"/b/([^/]+)", parts.path)
+        return parts.netloc, match.group(1) if match else None, method
+
     def _max_retries_for_error(self, error):
         """Handles Datastore response errors according to their documentation.
 
@@ -50,3 +131,286 @@ class CloudStorageRequestsProxy(RequestsProxy):
         """
         status = error.get("code")
         return self._MAX_RETRIES.get(status)
+
+    def download(self, bucket, name, destination, chunk_size=None, parallelism=None, validate=True):
+        """Download an object by fetching byte ranges of it concurrently
+        and streaming each one in place, so the object is never held in
+        memory as a whole.
+
+        Each range is retried on its own according to `_MAX_RETRIES`,
+        and resumed from where it left off up to `DOWNLOAD_MAX_RESUMES`
+        times when its body fails part way through.
+
+        Parameters:
+          bucket(str): The name of the bucket.
+          name(str): The name of the object.
+          destination(str or buffer): A filename or a writable buffer
+            (eg. a bytearray or an mmap) at least as large as the object.
+          chunk_size(int): The size of each byte range.  Defaults to
+            `DOWNLOAD_CHUNK_SIZE`.
+          parallelism(int): The max number of ranges to fetch at once.
+            Defaults to `DOWNLOAD_PARALLELISM`.
+          validate(bool): Whether or not to validate the downloaded
+            data against the object's CRC32C checksum.
+
+        Raises:
+          requests.HTTPError: When a request fails.
+          DataCorruption: When the downloaded data is invalid.
+
+        Returns:
+          dict: The object's metadata.
+        """
+        chunk_size = chunk_size or self.DOWNLOAD_CHUNK_SIZE
+        object_url = self._object_url(bucket, name)
+        response = self.request("GET", object_url)
+        response.raise_for_status()
+        metadata = response.json()
+
+        # Pinning the generation ensures every range comes from the
+        # same version of the object.
+        size = int(metadata["size"])
+        media_url = "{}?alt=media&generation={}".format(object_url, metadata["generation"])
+        ranges = [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+        read_range = self._make_range_reader(destination, size, validate)
+
+        def fetch(byte_range):
+            start, end = byte_range
+            progress = _RangeProgress(start)
+            for resumes in range(self.DOWNLOAD_MAX_RESUMES + 1):
+                if resumes:
+                    self.logger.warning(
+                        "Resuming range at offset %d. Attempt %d/%d.",
+                        progress.offset, resumes, self.DOWNLOAD_MAX_RESUMES
+                    )
+
+                error = None
+                response = self.request(
+                    "GET", media_url,
+                    headers={"range": "bytes={}-{}".format(progress.offset, end - 1)},
+                    stream=True,
+                )
+                try:
+                    response.raise_for_status()
+                    self._check_range(response, progress.offset, end, size)
+                    read_range(response, progress, end)
+                except _RANGE_READ_ERRORS as e:
+                    error = e
+                finally:
+                    response.close()
+
+                if progress.offset == end:
+                    return progress.checksum
+
+            if error is not None:
+                raise error
+            raise DataCorruption("Expected %d bytes at offset %d but got %d." % (
+                end - start, start, progress.offset - start
+            ))
+
+        with ThreadPoolExecutor(max_workers=parallelism or self.DOWNLOAD_PARALLELISM) as pool:
+            checksums = list(pool.map(fetch, ranges))
+
+        if validate and "crc32c" in metadata:
+            checksum = 0
+            for (start, end), range_checksum in zip(ranges, checksums):
+                checksum = crc32c.combine(checksum, range_checksum, end - start)
+
+            if checksum != crc32c.decode(metadata["crc32c"]):
+                raise DataCorruption("Checksum mismatch for gs://%s/%s." % (bucket, name))
+
+        return metadata
+
+    def _check_range(self, response, start, end, size):
+        # Servers that ignore the range header send the whole object,
+        # which is only what was asked for when the range covers it.
+        if response.status_code == 200 and start == 0 and end == size:
+            return
+
+        content_range = response.headers.get("content-range", "")
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)$", content_range)
+        if response.status_code != 206 or not match or \
+           tuple(map(int, match.groups())) != (start, end - 1, size):
+            raise DataCorruption("Expected bytes %d-%d/%d but got a %d response with content range %r." % (
+                start, end - 1, size, response.status_code, content_range
+            ))
+
+    def _make_range_reader(self, destination, size, validate):
+        # Builds a function that streams a range response into its
+        # place in the destination, advancing the range's progress as
+        # it goes.
+        if isinstance(destination, six.string_types):
+            with open(destination, "wb") as f:
+                f.truncate(size)
+
+            def read_range(response, progress, end):
+                buf = bytearray(min(self.DOWNLOAD_BUFFER_SIZE, end - progress.offset))
+                with open(destination, "r+b") as f:
+                    f.seek(progress.offset)
+                    for chunk in streaming.iter_into(response, buf):
+                        chunk = chunk[:end - progress.offset]
+                        f.write(chunk)
+                        progress.advance(chunk, validate)
+
+        else:
+            view = memoryview(destination)
+            if len(view) < size:
+                raise ValueError("Destination buffer is smaller than the object (%d bytes)." % size)
+
+            def read_range(response, progress, end):
+                while progress.offset < end:
+                    target_end = min(progress.offset + self.DOWNLOAD_BUFFER_SIZE, end)
+                    target = view[progress.offset:target_end]
+                    try:
+                        read = streaming.readinto(response, target)
+                        progress.advance(target[:read], validate)
+                    finally:
+                        target.release()
+
+                    if progress.offset < target_end:
+                        break
+
+        return read_range
+
+    def upload(self, bucket, name, filename, content_type="application/octet-stream",
+               chunk_size=None, parallelism=None):
+        """Upload a file using chunked resumable uploads.
+
+        Failed chunks are resumed from the last offset the server
+        confirmed.  When `parallelism` is greater than 1, the file is
+        split into parts that are uploaded concurrently and then
+        joined together with a compose call.  The file is read via
+        mmap so its contents aren't copied into memory up front.
+
+        Parameters:
+          bucket(str): The name of the bucket.
+          name(str): The name of the object.
+          filename(str): The path to the file to upload.
+          content_type(str): The content type of the object.
+          chunk_size(int): The size of each chunk.  Must be a multiple
+            of 256KiB.  Defaults to `UPLOAD_CHUNK_SIZE`.
+          parallelism(int): The max number of parts to upload at once.
+            Defaults to `UPLOAD_PARALLELISM`.
+
+        Raises:
+          requests.HTTPError: When the upload fails.
+
+        Returns:
+          dict: The object's metadata.
+        """
+        chunk_size = chunk_size or self.UPLOAD_CHUNK_SIZE
+        parallelism = parallelism or self.UPLOAD_PARALLELISM
+        if chunk_size % (256 * 1024):
+            raise ValueError("chunk_size must be a multiple of 256KiB.")
+
+        size = os.path.getsize(filename)
+        with open(filename, "rb") as f:
+            if size == 0:
+                return self._upload_part(bucket, name, b"", content_type, chunk_size)
+
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(data)
+            try:
+                if parallelism <= 1 or size <= chunk_size:
+                    return self._upload_part(bucket, name, view, content_type, chunk_size)
+
+                return self._upload_composite(bucket, name, view, content_type, chunk_size, parallelism)
+            finally:
+                view.release()
+                data.close()
+
+    def _upload_composite(self, bucket, name, view, content_type, chunk_size, parallelism):
+        # Parts are aligned to chunk boundaries so that every chunk but
+        # the last one in each part is a full chunk.
+        size = len(view)
+        chunks = -(-size // chunk_size)
+        chunks_per_part = -(-chunks // min(chunks, self._MAX_COMPOSE_SOURCES))
+        part_size = chunks_per_part * chunk_size
+        token = uuid.uuid4().hex
+        parts = [
+            ("{}.{}.part{}".format(name, token, i), view[start:start + part_size])
+            for i, start in enumerate(range(0, size, part_size))
+        ]
+
+        def upload_part(part):
+            part_name, part_view = part
+            return self._upload_part(bucket, part_name, part_view, content_type, chunk_size)
+
+        try:
+            with ThreadPoolExecutor(max_workers=parallelism) as pool:
+                list(pool.map(upload_part, parts))
+
+            response = self.request(
+                "POST", self._object_url(bucket, name) + "/compose",
+                data=json.dumps({
+                    "sourceObjects": [{"name": part_name} for part_name, _ in parts],
+                    "destination": {"contentType": content_type},
+                }),
+                headers={"content-type": "application/json"},
+            )
+            response.raise_for_status()
+            return response.json()
+        finally:
+            for part_name, part_view in parts:
+                part_view.release()
+                try:
+                    self.request("DELETE", self._object_url(bucket, part_name))
+                except requests.RequestException:
+                    self.logger.warning("Failed to delete part %r.", part_name, exc_info=True)
+
+    def _upload_part(self, bucket, name, view, content_type, chunk_size):
+        response = self.request(
+            "POST", "{}/upload/storage/v1/b/{}/o?uploadType=resumable&name={}".format(
+                self.API_URL, quote(bucket, safe=""), quote(name, safe="")
+            ),
+            data=json.dumps({"name": name, "contentType": content_type}),
+            headers={"content-type": "application/json", "x-upload-content-type": content_type},
+        )
+        response.raise_for_status()
+        session_url = response.headers["location"]
+
+        size, offset, resumes = len(view), 0, 0
+        while True:
+            end = min(offset + chunk_size, size)
+            content_range = "bytes {}-{}/{}".format(offset, end - 1, size) if size else "bytes */0"
+            chunk = view[offset:end]
+            try:
+                response = self.request(
+                    "PUT", session_url, data=chunk, headers={"content-range": content_range}
+                )
+            except requests.ConnectionError:
+                self.logger.warning("Chunk at offset %d failed.", offset, exc_info=True)
+                response = None
+            finally:
+                # Release the chunk so that the file can be unmapped.
+                if isinstance(chunk, memoryview):
+                    chunk.release()
+
+            if response is not None and response.status_code < 400:
+                if response.status_code in (200, 201):
+                    return response.json()
+
+                offset = self._confirmed_offset(response)
+                continue
+
+            resumes += 1
+            if resumes > self.UPLOAD_MAX_RESUMES:
+                if response is None:
+                    raise requests.ConnectionError("Failed to upload chunk at offset %d." % offset)
+                response.raise_for_status()
+
+            # Ask the server how much of the upload it has persisted
+            # and resume from there.
+            self.logger.warning("Resuming upload. Attempt %d/%d.", resumes, self.UPLOAD_MAX_RESUMES)
+            response = self.request("PUT", session_url, headers={"content-range": "bytes */{}".format(size)})
+            if response.status_code in (200, 201):
+                return response.json()
+            elif response.status_code == 308:
+                offset = self._confirmed_offset(response)
+
+    def _confirmed_offset(self, response):
+        match = re.match(r"bytes=0-(\d+)", response.headers.get("range", ""))
+        return int(match.group(1)) + 1 if match else 0
+
+    def _object_url(self, bucket, name):
+        return "{}/storage/v1/b/{}/o/{}".format(self.API_URL, quote(bucket, safe=""), quote(name, safe=""))
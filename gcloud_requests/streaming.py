@@ -0,0 +1,97 @@
+"""Helpers for consuming response bodies made with ``stream=True``
+without buffering them in memory.
+"""
+import io
+
+#: The content encodings that can be read without decoding.
+_IDENTITY_ENCODINGS = ("", "identity")
+
+
+def readinto(response, buffer):
+    """Read a streamed response's body into a caller-provided buffer.
+
+    When the body isn't content-encoded, bytes are read from the
+    socket straight into the buffer without any intermediate copies.
+    The connection is handed back to the pool once the body has been
+    fully read.
+
+    Parameters:
+      response(requests.Response): A response returned by a request
+        made with ``stream=True``.
+      buffer: A writable bytes-like object, eg. a bytearray, a
+        memoryview or an mmap.
+
+    Returns:
+      int: The number of bytes read.  This is less than the size of
+      the buffer only when the body has been exhausted.
+    """
+    view = memoryview(buffer)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast("B")
+
+    fp = _get_raw_fp(response)
+    total = 0
+    try:
+        while total < len(view):
+            if fp is not None:
+                read = fp.readinto(view[total:])
+            else:
+                chunk = response.raw.read(len(view) - total, decode_content=True)
+                read = len(chunk)
+                view[total:total + read] = chunk
+
+            if not read:
+                _release(response)
+                break
+
+            total += read
+        return total
+    finally:
+        if view is not buffer:
+            view.release()
+
+
+def iter_into(response, buffer):
+    """Iterate over a streamed response's body, filling the same
+    caller-provided buffer on every iteration.
+
+    Each view that is yielded is only valid until the next iteration.
+
+    Parameters:
+      response(requests.Response): A response returned by a request
+        made with ``stream=True``.
+      buffer: A writable bytes-like object.
+
+    Yields:
+      memoryview: A view over the part of the buffer that was filled.
+    """
+    view = memoryview(buffer)
+    while True:
+        read = readinto(response, view)
+        if read:
+            yield view[:read]
+        if read < len(view):
+            break
+
+
+def _get_raw_fp(response):
+    # Bodies that were already read into memory (eg. because the
+    # request wasn't streamed) are copied out of the content.
+    if response._content_consumed and isinstance(response._content, bytes):
+        reader = getattr(response, "_content_reader", None)
+        if reader is None:
+            reader = response._content_reader = io.BytesIO(response._content)
+        return reader
+
+    # The zero-copy path reads from the http.client response under
+    # urllib3's, which is only safe when no decoding is required.
+    encoding = response.headers.get("content-encoding", "").lower()
+    if encoding not in _IDENTITY_ENCODINGS:
+        return None
+    return getattr(response.raw, "_fp", None)
+
+
+def _release(response):
+    release_conn = getattr(response.raw, "release_conn", None)
+    if release_conn is not None:
+        release_conn()
@@ -0,0 +1,263 @@
+import base64
+import json
+import logging
+import math
+import time
+
+from collections import deque
+from six.moves.queue import Empty
+from threading import Condition, Thread
+
+
+class Message(object):
+    """A message pulled by a :class:`.PubSubSubscriber`.
+
+    Every message must either be acked or nacked once it's been
+    processed.  Until then, the subscriber keeps extending its lease.
+    """
+
+    def __init__(self, subscriber, received_message, lease_deadline):
+        message = received_message["message"]
+        self.ack_id = received_message["ackId"]
+        self.message_id = message.get("messageId")
+        self.publish_time = message.get("publishTime")
+        self.attributes = message.get("attributes", {})
+        self.data = base64.b64decode(message.get("data", ""))
+        self.size = len(self.data)
+        self.received_at = time.time()
+
+        self._subscriber = subscriber
+        self._lease_deadline = lease_deadline
+
+    def ack(self):
+        """Acknowledge this message.
+        """
+        self._subscriber._release(self, ack=True)
+
+    def nack(self):
+        """Make this message available for redelivery.
+        """
+        self._subscriber._release(self, ack=False)
+
+
+class PubSubSubscriber(object):
+    """Pulls messages from a subscription ahead of consumption through
+    a :class:`.PubSubRequestsProxy`.
+
+    Pulled messages are kept in memory until they're acked or nacked.
+    Pulling pauses while `max_messages` messages or `max_bytes` bytes
+    are outstanding (the byte limit may be exceeded by up to one
+    pull).  Acks, nacks and lease extensions are sent in bulk every
+    `flush_interval` seconds.  Leases are extended by the 99th
+    percentile of the time it took to process recent messages.
+
+    Parameters:
+      proxy(PubSubRequestsProxy): The proxy to pull through.
+      subscription(str): The full name of the subscription, eg.
+        ``projects/example/subscriptions/example``.
+      max_messages(int): The max number of outstanding messages.
+      max_bytes(int): The max size of outstanding messages in bytes.
+      pull_size(int): The max number of messages to request per pull.
+      pullers(int): The number of pulls to keep in flight.
+      ack_deadline(int): The subscription's ack deadline in seconds.
+      flush_interval(float): The number of seconds between bulk acks
+        and lease extensions.
+    """
+
+    #: The shortest lease extension in seconds.
+    MIN_ACK_DEADLINE = 10
+
+    #: The longest lease extension in seconds.
+    MAX_ACK_DEADLINE = 600
+
+    # The max number of ack ids to send per request.
+    _MAX_ACK_IDS = 2500
+
+    # The number of processing times to base lease extensions on.
+    _MAX_DURATIONS = 1000
+
+    def __init__(self, proxy, subscription, max_messages=1000, max_bytes=100 * 1024 * 1024, pull_size=100,
+                 pullers=1, ack_deadline=10, flush_interval=0.1, logger=None):
+        self.proxy = proxy
+        self.subscription = subscription
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.pull_size = pull_size
+        self.ack_deadline = ack_deadline
+        self.flush_interval = flush_interval
+        self.logger = logger or logging.getLogger("gcloud_requests.PubSubSubscriber")
+
+        self._updated = Condition()
+        self._running = True
+        self._queue = deque()
+        self._leased = {}
+        self._leased_bytes = 0
+        self._acks = []
+        self._nacks = []
+        self._durations = deque(maxlen=self._MAX_DURATIONS)
+
+        self._threads = [Thread(target=self._pull) for _ in range(pullers)]
+        self._threads.append(Thread(target=self._lease))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except Empty:
+                return
+
+    def get(self, timeout=None):
+        """Get the next message.
+
+        Parameters:
+          timeout(float): The max number of seconds to wait for.
+
+        Raises:
+          queue.Empty: When no message was received in time or when
+            the subscriber has been stopped.
+
+        Returns:
+          Message
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._updated:
+            while not self._queue:
+                remaining = None if deadline is None else deadline - time.time()
+                if not self._running or (remaining is not None and remaining <= 0):
+                    raise Empty()
+
+                self._updated.wait(remaining)
+
+            return self._queue.popleft()
+
+    def stop(self):
+        """Stop pulling, nack every message that hasn't been handed
+        out and send any pending acks.  Messages that are acked after
+        the subscriber has been stopped get redelivered.
+        """
+        with self._updated:
+            self._running = False
+            while self._queue:
+                self._release_locked(self._queue.popleft(), ack=False)
+            self._updated.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+
+        # Pulls that were in flight may have added more nacks.
+        self._flush()
+
+    def _release(self, message, ack):
+        with self._updated:
+            self._release_locked(message, ack)
+            self._updated.notify_all()
+
+    def _release_locked(self, message, ack):
+        if self._leased.pop(message.ack_id, None) is None:
+            return
+
+        self._leased_bytes -= message.size
+        if ack:
+            self._acks.append(message.ack_id)
+            self._durations.append(time.time() - message.received_at)
+        else:
+            self._nacks.append(message.ack_id)
+
+    def _pull(self):
+        failures = 0
+        while True:
+            with self._updated:
+                while self._running and (len(self._leased) >= self.max_messages or
+                                         self._leased_bytes >= self.max_bytes):
+                    self._updated.wait()
+
+                if not self._running:
+                    return
+
+                count = min(self.pull_size, self.max_messages - len(self._leased))
+
+            try:
+                response = self._post("pull", {"maxMessages": count})
+                received_messages = response.json().get("receivedMessages", [])
+                failures = 0
+            except Exception:
+                self.logger.warning("Failed to pull messages from %r.", self.subscription, exc_info=True)
+                with self._updated:
+                    self._updated.wait(self.proxy._compute_backoff(failures))
+                failures += 1
+                continue
+
+            with self._updated:
+                lease_deadline = time.time() + self.ack_deadline
+                for received_message in received_messages:
+                    message = Message(self, received_message, lease_deadline)
+                    if not self._running:
+                        self._nacks.append(message.ack_id)
+                        continue
+
+                    self._leased[message.ack_id] = message
+                    self._leased_bytes += message.size
+                    self._queue.append(message)
+
+                self._updated.notify_all()
+
+    def _lease(self):
+        while True:
+            # The condition is notified on every ack so waits are
+            # repeated until the full interval has passed.
+            next_flush = time.time() + self.flush_interval
+            with self._updated:
+                while self._running and next_flush > time.time():
+                    self._updated.wait(next_flush - time.time())
+
+                if not self._running:
+                    return
+
+            self._flush()
+
+    def _flush(self):
+        with self._updated:
+            acks, self._acks = self._acks, []
+            nacks, self._nacks = self._nacks, []
+            deadline = self._compute_ack_deadline()
+            now = time.time()
+            margin = max(2 * self.flush_interval, deadline / 5.0)
+            extensions = []
+            for message in self._leased.values():
+                if message._lease_deadline - now < margin:
+                    message._lease_deadline = now + deadline
+                    extensions.append(message.ack_id)
+
+        self._send_ack_ids("acknowledge", acks, {})
+        self._send_ack_ids("modifyAckDeadline", nacks, {"ackDeadlineSeconds": 0})
+        self._send_ack_ids("modifyAckDeadline", extensions, {"ackDeadlineSeconds": int(math.ceil(deadline))})
+
+    def _compute_ack_deadline(self):
+        if not self._durations:
+            deadline = self.ack_deadline
+        else:
+            durations = sorted(self._durations)
+            deadline = durations[int(len(durations) * 0.99)]
+
+        return min(max(deadline, self.MIN_ACK_DEADLINE), self.MAX_ACK_DEADLINE)
+
+    def _send_ack_ids(self, method, ack_ids, params):
+        for start in range(0, len(ack_ids), self._MAX_ACK_IDS):
+            data = dict(params, ackIds=ack_ids[start:start + self._MAX_ACK_IDS])
+            try:
+                self._post(method, data)
+            except Exception:
+                # Messages whose acks are lost get redelivered.
+                self.logger.warning("Failed to %s %d messages.", method, len(data["ackIds"]), exc_info=True)
+
+    def _post(self, method, data):
+        response = self.proxy.request(
+            "POST", "{}/v1/{}:{}".format(self.proxy.API_URL, self.subscription, method),
+            data=json.dumps(data),
+            headers={"content-type": "application/json"},
+        )
+        response.raise_for_status()
+        return response
@@ -0,0 +1,233 @@
+"""An access token cache shared between processes on the same host.
+
+Pre-fork servers run many worker processes that would otherwise each
+fetch and refresh their own tokens.  With a shared cache, the first
+process to refresh a token publishes it and the others pick it up
+instead of calling the token endpoint.  Locking relies on ``fcntl`` so
+the cache does nothing on platforms that lack it.
+
+Tokens are credentials in their own right, so the cache only trusts
+files that are owned by the current user and that nobody else can
+read or write.
+"""
+import calendar
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+import six
+
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+
+def default_key(credentials):
+    """Derive a cache key from a credentials object's type, principal
+    and scopes.  The principal is the service account, along with the
+    user it acts as, if any, or, for user credentials, a hash of their
+    refresh token.
+
+    Returns:
+      str: The key or None if the credentials can't be told apart
+      from others of the same type, in which case they aren't cached.
+    """
+    principal = _get_principal(credentials)
+    if principal is None:
+        return None
+
+    return "{}:{}:{}".format(
+        type(credentials).__name__,
+        principal,
+        " ".join(sorted(getattr(credentials, "scopes", None) or [])),
+    )
+
+
+def _get_principal(credentials):
+    email = getattr(credentials, "service_account_email", None)
+    if email:
+        # Service accounts with domain-wide delegation act as a user.
+        subject = getattr(credentials, "_subject", None)
+        return "{}/{}".format(email, subject) if subject else email
+
+    # Refresh tokens are secrets so only their hashes are written out.
+    refresh_token = getattr(credentials, "refresh_token", None)
+    if refresh_token:
+        return "user:" + hashlib.sha256(refresh_token.encode("utf-8")).hexdigest()
+    return None
+
+
+class SharedTokenCache(object):
+    """A file-backed token cache guarded by an exclusive file lock.
+
+    Set it on the :class:`.CredentialsWatcher` to have every refresh go
+    through it::
+
+      get_credentials_watcher().token_cache = SharedTokenCache()
+
+    Cached tokens are only used when they expire later than the
+    credentials' current token and have at least `min_ttl` seconds
+    left.  Unreadable or corrupt cache files are ignored and replaced
+    on the next refresh, and any other failure of the cache itself
+    falls back to refreshing without it.
+
+    Parameters:
+      path(str): The path to the cache file.  Its directory should
+        only be writable by the current user.  Defaults to a file in
+        ``$XDG_RUNTIME_DIR`` or, when that isn't set, in a new private
+        temp directory, which is only shared with processes forked
+        after the cache is created.
+      min_ttl(float): The min number of seconds a cached token must
+        have left for it to be used.
+      key(callable): A function that maps credentials objects to
+        cache keys.  Credentials that share a key must be
+        interchangeable.  Credentials it maps to None bypass the
+        cache.
+    """
+
+    def __init__(self, path=None, min_ttl=60, key=default_key, logger=None):
+        if path is None:
+            path = os.path.join(_get_private_directory(), "gcloud_requests-tokens.json")
+
+        self.path = path
+        self.min_ttl = min_ttl
+        self.key = key
+        self.logger = logger or logging.getLogger("gcloud_requests.SharedTokenCache")
+
+    @property
+    def enabled(self):
+        """bool: Whether or not the platform supports the cache.
+        """
+        return fcntl is not None
+
+    @contextmanager
+    def lock(self):
+        """Hold the cache's exclusive lock, blocking until it's free.
+        If the lock can't be taken, this proceeds without it.
+        """
+        try:
+            fd = _open_private(self.path + ".lock", os.O_RDWR | os.O_CREAT)
+        except (IOError, OSError):
+            self.logger.warning("Failed to open token cache lock %r.", self.path, exc_info=True)
+            yield
+            return
+
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            except (IOError, OSError):
+                self.logger.warning("Failed to lock token cache %r.", self.path, exc_info=True)
+            yield
+        finally:
+            # Closing the file releases the lock.
+            os.close(fd)
+
+    def load(self, credentials):
+        """Update the given credentials with a cached token if there's
+        a usable one.  Must be called while holding :meth:`lock`.
+
+        Returns:
+          bool: True if the credentials were updated.
+        """
+        key = self.key(credentials)
+        if key is None:
+            return False
+
+        entry = self._read().get(key)
+        try:
+            token, expiry = entry["token"], _from_timestamp(entry["expiry"])
+        except (KeyError, TypeError, ValueError, OverflowError):
+            return False
+
+        if not isinstance(token, six.string_types):
+            return False
+
+        if (expiry - datetime.utcnow()).total_seconds() < self.min_ttl:
+            return False
+        if credentials.expiry is not None and expiry <= credentials.expiry:
+            return False
+
+        self.logger.debug("Loaded cached token for credentials %r.", credentials)
+        credentials.token, credentials.expiry = token, expiry
+        return True
+
+    def store(self, credentials):
+        """Publish the given credentials' token.  Must be called while
+        holding :meth:`lock`.
+        """
+        key = self.key(credentials)
+        if key is None or not credentials.token or credentials.expiry is None:
+            return
+
+        now = time.time()
+        data = {key: entry for key, entry in self._read().items()
+                if isinstance(entry, dict) and isinstance(entry.get("expiry"), (int, float))
+                and entry["expiry"] > now}
+        data[key] = {
+            "token": credentials.token,
+            "expiry": _to_timestamp(credentials.expiry),
+        }
+
+        # Write to a new temporary file and rename it over the cache
+        # so that readers never see a partially-written file.
+        directory, name = os.path.split(self.path)
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=directory or None)
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.rename(temp_path, self.path)
+        except (IOError, OSError):
+            self.logger.warning("Failed to write token cache %r.", self.path, exc_info=True)
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _read(self):
+        try:
+            with os.fdopen(_open_private(self.path, os.O_RDONLY)) as f:
+                data = json.load(f)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                self.logger.warning("Ignoring unreadable token cache %r.", self.path, exc_info=True)
+            return {}
+        except ValueError:
+            self.logger.warning("Ignoring corrupt token cache %r.", self.path)
+            return {}
+
+        if not isinstance(data, dict):
+            self.logger.warning("Ignoring corrupt token cache %r.", self.path)
+            return {}
+        return data
+
+
+def _get_private_directory():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return runtime_dir
+    return tempfile.mkdtemp(prefix="gcloud_requests-")
+
+
+def _open_private(path, flags):
+    # Symlinks and files planted by other users are never opened.
+    fd = os.open(path, flags | getattr(os, "O_NOFOLLOW", 0), 0o600)
+    st = os.fstat(fd)
+    if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o077):
+        os.close(fd)
+        raise OSError(errno.EPERM, "{!r} must only be accessible to the current user.".format(path))
+    return fd
+
+
+def _to_timestamp(expiry):
+    return calendar.timegm(expiry.utctimetuple()) + expiry.microsecond / 1e6
+
+
+def _from_timestamp(timestamp):
+    return datetime.utcfromtimestamp(timestamp)
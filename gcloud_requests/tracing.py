@@ -0,0 +1,133 @@
+"""Distributed tracing for proxy calls.
+
+Spans are created with the OpenTelemetry API when it's installed.
+Otherwise, :class:`TracingInstrumentation` does nothing.  The API is
+only imported once tracing is set up.
+"""
+import time
+
+from .instrumentation import Instrumentation
+
+propagate = trace = None
+
+
+def _import_opentelemetry():
+    global propagate, trace
+    if trace is None:
+        try:
+            from opentelemetry import propagate, trace
+        except ImportError:  # pragma: no cover
+            return False
+    return True
+
+
+class TracingInstrumentation(Instrumentation):
+    """Creates a client span for every call to a proxy's `request`
+    method, with a child span for every attempt and credentials
+    refresh and an event for every backoff before a retry.  Trace
+    context headers are injected into every attempt so that
+    server-side traces link up with the attempt that caused them.
+
+    Parameters:
+      tracer: An OpenTelemetry tracer.  Defaults to the global
+        tracer provider's ``gcloud_requests`` tracer.
+    """
+
+    def __init__(self, tracer=None):
+        if _import_opentelemetry() and tracer is None:
+            tracer = trace.get_tracer("gcloud_requests")
+
+        self.tracer = tracer
+
+    @property
+    def enabled(self):
+        """bool: Whether or not spans are being created.
+        """
+        return self.tracer is not None
+
+    def before_request(self, call):
+        if not self.enabled:
+            return
+
+        call.state["span"] = self.tracer.start_span(
+            "{}.{}".format(call.service, call.rpc_method),
+            kind=trace.SpanKind.CLIENT,
+            attributes={
+                "rpc.system": "gcloud",
+                "rpc.service": call.service,
+                "rpc.method": call.rpc_method,
+                "http.method": call.method,
+                "http.url": call.url,
+            },
+        )
+
+    def before_attempt(self, call, headers):
+        if not self.enabled:
+            return
+
+        span = self._start_child(call, "attempt", attributes={"gcloud_requests.attempt": call.attempts})
+        call.state["attempt_span"] = span
+        propagate.inject(headers, context=trace.set_span_in_context(span))
+
+    def after_attempt(self, call, response=None, error=None, latency=0, pool_wait=0, connect_time=0):
+        if not self.enabled:
+            return
+
+        span = call.state.pop("attempt_span")
+        span.set_attribute("gcloud_requests.pool_wait", pool_wait)
+        span.set_attribute("gcloud_requests.connect_time", connect_time)
+        self._finish(span, response, error)
+
+    def on_retry(self, call, reason, backoff):
+        if not self.enabled:
+            return
+
+        span = call.state["span"]
+        span.set_attribute("gcloud_requests.retry_reason", reason)
+        span.add_event("backoff", {
+            "gcloud_requests.retry_reason": reason,
+            "gcloud_requests.backoff": backoff,
+        })
+
+    def on_refresh(self, call, latency, error=None):
+        if not self.enabled:
+            return
+
+        # The refresh has already happened by the time this is
+        # called so the span is backdated to when it started.
+        end_time = _time_ns()
+        span = self._start_child(call, "credentials.refresh", start_time=end_time - int(latency * 1e9))
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+
+        span.end(end_time=end_time)
+
+    def after_request(self, call, response=None, error=None):
+        if not self.enabled:
+            return
+
+        span = call.state.pop("span")
+        span.set_attribute("gcloud_requests.attempts", call.attempts)
+        span.set_attribute("gcloud_requests.retries", call.retries)
+        self._finish(span, response, error)
+
+    def _start_child(self, call, name, **kwargs):
+        context = trace.set_span_in_context(call.state["span"])
+        return self.tracer.start_span(name, context=context, kind=trace.SpanKind.CLIENT, **kwargs)
+
+    def _finish(self, span, response, error):
+        if response is not None:
+            span.set_attribute("http.status_code", response.status_code)
+            if response.status_code >= 400:
+                span.set_status(trace.Status(trace.StatusCode.ERROR))
+
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(trace.Status(trace.StatusCode.ERROR, str(error)))
+
+        span.end()
+
+
+def _time_ns():
+    return int(time.time() * 1e9)
@@ -35,6 +35,12 @@ setup(
     license="MIT",
     packages=["gcloud_requests"],
     install_requires=dependencies,
+    extras_require={
+        "aio": ["aiohttp>=3.3"],
+        "crc32c": ["google-crc32c>=1.0"],
+        "http2": ["httpx[http2]>=0.18"],
+        "tracing": ["opentelemetry-api>=1.0"],
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Intended Audience :: Developers",
@@ -1,6 +1,46 @@
+import os
+import sys
+
 import pytest
 
+from datetime import datetime, timedelta
 from gcloud_requests import CloudStorageRequestsProxy, DatastoreRequestsProxy, PubSubRequestsProxy
+from gcloud_requests import RequestsProxy, RetryBudget
+from google.auth.credentials import Credentials
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    collect_ignore.append("test_aio_proxy.py")
+if sys.version_info < (3, 6):
+    collect_ignore.append("test_http2.py")
+
+
+class StubCredentials(Credentials):
+    """Credentials that never talk to a token endpoint.
+    """
+
+    def __init__(self):
+        super(StubCredentials, self).__init__()
+        self.refresh_calls = 0
+
+    def refresh(self, request):
+        self.refresh_calls += 1
+        self.token = "token-{}".format(self.refresh_calls)
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+
+
+@pytest.fixture(autouse=True)
+def retry_budget(monkeypatch):
+    # Every test gets a full retry budget so that retries made by
+    # earlier tests don't affect later ones.
+    budget = RetryBudget()
+    monkeypatch.setattr(RequestsProxy, "RETRY_BUDGET", budget)
+    return budget
+
+
+@pytest.fixture
+def stub_credentials():
+    return StubCredentials()
 
 
 @pytest.fixture(scope="session")
@@ -16,3 +56,34 @@ def pubsub_proxy():
 @pytest.fixture(scope="session")
 def storage_proxy():
     return CloudStorageRequestsProxy()
+
+
+@pytest.fixture
+def run_in_child():
+    """Run a function in a forked child process and return whatever
+    it returns, or the exception it raised, as a string.
+    """
+    if not hasattr(os, "fork"):
+        pytest.skip("requires os.fork")
+
+    def run(function):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # pragma: no cover
+            os.close(read_fd)
+            try:
+                result = repr(function())
+            except BaseException as e:
+                result = "error: {!r}".format(e)
+
+            os.write(write_fd, result.encode("utf-8"))
+            os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd, "rb") as f:
+            result = f.read().decode("utf-8")
+
+        os.waitpid(pid, 0)
+        return result
+
+    return run
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import time
+
+import aiohttp
+import pytest
+
+from aiohttp import web
+from gcloud_requests import HedgingPolicy, Instrumentation, LRUEntityCache
+from gcloud_requests.aio import (
+    AsyncCloudStorageRequestsProxy, AsyncDatastoreRequestsProxy, AsyncPubSubRequestsProxy
+)
+from requests.packages.urllib3.util.retry import Retry
+
+
+def run_against(handler, proxy_class, credentials, *requests):
+    async def main():
+        app = web.Application()
+        app.router.add_route("*", "/{tail:.*}", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        proxy = proxy_class(credentials=credentials)
+        try:
+            return await asyncio.gather(*[
+                proxy.request(method, "http://127.0.0.1:{}{}".format(port, path))
+                for method, path in requests
+            ])
+        finally:
+            await proxy.close()
+            await runner.cleanup()
+
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("error_data,expected_tries", [
+    ({"status": "SOME-UNHANDLED-STATUS"}, 1),
+    ({"status": "ABORTED"}, 6),
+    ({"status": "INTERNAL"}, 2),
+    ({"status": "UNAVAILABLE"}, 6),
+])
+def test_async_datastore_proxy_retries_retriable_json_errors(stub_credentials, error_data, expected_tries):
+    # Given that I have a call database
+    calls = []
+
+    # And a server that always fails with the given error
+    async def handler(request):
+        calls.append(1)
+        return web.json_response({"error": error_data}, status=500)
+
+    # If I make a request through an async Datastore proxy
+    response, = run_against(handler, AsyncDatastoreRequestsProxy, stub_credentials, ("GET", "/"))
+
+    # I expect to get back a 500
+    assert response.status_code == 500
+    # And the endpoint to have been called some number of times
+    assert sum(calls) == expected_tries
+
+
+def test_async_storage_proxy_retries_empty_503s(stub_credentials):
+    # Given that I have a call database
+    calls = []
+
+    # And a server that always 503s with an empty body
+    async def handler(request):
+        calls.append(1)
+        return web.Response(status=503, content_type="text/html")
+
+    # If I make a request through an async GCS proxy
+    response, = run_against(handler, AsyncCloudStorageRequestsProxy, stub_credentials, ("GET", "/"))
+
+    # I expect to get back a 503
+    assert response.status_code == 503
+    # And the endpoint to have been called a total of 6 times
+    assert sum(calls) == 6
+
+
+def test_async_proxy_refreshes_credentials_on_401(stub_credentials):
+    # Given that I have a server that 401s unless it sees a refreshed token
+    async def handler(request):
+        if request.headers["authorization"] == "Bearer token-1":
+            return web.Response(status=401)
+        return web.json_response({"token": request.headers["authorization"]})
+
+    # If I make a request through an async PubSub proxy
+    response, = run_against(handler, AsyncPubSubRequestsProxy, stub_credentials, ("GET", "/"))
+
+    # I expect it to succeed with the refreshed token
+    assert response.status_code == 200
+    assert json.loads(response.text) == {"token": "Bearer token-2"}
+
+
+def test_async_proxy_runs_requests_concurrently(stub_credentials):
+    # Given that I have a slow server
+    in_flight, peak = [0], [0]
+
+    async def handler(request):
+        in_flight[0] += 1
+        peak[0] = max(peak[0], in_flight[0])
+        await asyncio.sleep(0.1)
+        in_flight[0] -= 1
+        return web.json_response({})
+
+    # If I make many requests at once
+    responses = run_against(handler, AsyncDatastoreRequestsProxy, stub_credentials, *[("POST", "/")] * 16)
+
+    # I expect them all to succeed
+    assert all(response.status_code == 200 for response in responses)
+    # And to have been in flight at the same time
+    assert peak[0] == 16
+
+
+def test_async_proxy_stops_retrying_connection_errors_at_the_deadline(stub_credentials):
+    # Given that I have an async proxy that retries connection errors many times
+    class RetryingAsyncDatastoreRequestsProxy(AsyncDatastoreRequestsProxy):
+        RETRY_CONFIG = Retry(connect=10)
+
+        def _compute_backoff(self, retries):
+            return 1
+
+    proxy = RetryingAsyncDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I make a request with a deadline to a port nothing listens on
+    async def main():
+        try:
+            return await proxy.request("GET", "http://127.0.0.1:1", deadline=0.3)
+        finally:
+            await proxy.close()
+
+    start = time.time()
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(main())
+
+    # I expect it to have given up once the deadline passed
+    assert time.time() - start < 0.9
+
+
+@pytest.mark.parametrize("setting,value", [
+    ("HEDGING_POLICY", HedgingPolicy()),
+    ("INSTRUMENTATION", Instrumentation()),
+    ("LOOKUP_BATCH_WINDOW", 0.005),
+    ("ENTITY_CACHE", LRUEntityCache()),
+    ("QUERY_PREFETCH_DEPTH", 2),
+])
+def test_async_proxy_rejects_unsupported_settings(stub_credentials, setting, value):
+    # Given that I have an async Datastore proxy class with a threaded-only setting
+    proxy_class = type("UnsupportedAsyncProxy", (AsyncDatastoreRequestsProxy,), {setting: value})
+
+    # If I create an instance of it
+    # I expect it to fail instead of ignoring the setting
+    with pytest.raises(ValueError, match=setting):
+        proxy_class(credentials=stub_credentials)
+
+
+def test_async_storage_proxy_rejects_transfer_helpers(stub_credentials):
+    # Given that I have an async GCS proxy
+    proxy = AsyncCloudStorageRequestsProxy(credentials=stub_credentials)
+
+    # If I try to download or upload an object
+    # I expect it to fail and point me at the threaded proxy
+    with pytest.raises(NotImplementedError, match="CloudStorageRequestsProxy"):
+        proxy.download("bucket", "object", "/tmp/object")
+
+    with pytest.raises(NotImplementedError, match="CloudStorageRequestsProxy"):
+        proxy.upload("bucket", "object", "/tmp/object")
+
+
+def test_async_proxy_rejects_streamed_requests(stub_credentials):
+    # Given that I have an async proxy
+    proxy = AsyncCloudStorageRequestsProxy(credentials=stub_credentials)
+
+    # If I ask for a streamed response
+    # I expect it to fail
+    with pytest.raises(NotImplementedError):
+        asyncio.run(proxy.request("GET", "http://127.0.0.1:1", stream=True))
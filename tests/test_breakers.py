@@ -0,0 +1,147 @@
+import json
+import time
+
+import pytest
+
+from gcloud_requests import CircuitBreaker, CircuitOpen, CloudStorageRequestsProxy, DatastoreRequestsProxy
+from gcloud_requests.breakers import CLOSED, HALF_OPEN, OPEN
+from httmock import HTTMock, urlmatch
+
+ENDPOINT = ("example.com", "lookup")
+
+
+@pytest.fixture
+def transitions():
+    return []
+
+
+@pytest.fixture
+def breaker(transitions):
+    breaker = CircuitBreaker(failure_rate=0.5, min_requests=4, open_duration=0.1)
+    breaker.add_listener(lambda endpoint, previous_state, state: transitions.append((previous_state, state)))
+    return breaker
+
+
+def test_circuit_breaker_opens_once_the_failure_rate_is_reached(breaker, transitions):
+    # Given that I've made a couple of successful requests
+    for _ in range(2):
+        assert breaker.allow(ENDPOINT)
+        breaker.record(ENDPOINT, True)
+
+    # If half of all requests fail
+    for _ in range(2):
+        assert breaker.allow(ENDPOINT)
+        breaker.record(ENDPOINT, False)
+
+    # I expect the circuit to be open
+    assert not breaker.allow(ENDPOINT)
+    assert transitions == [(CLOSED, OPEN)]
+    assert breaker.stats()[ENDPOINT] == {"state": OPEN, "requests": 4, "failures": 2}
+
+
+def test_circuit_breaker_needs_a_minimum_number_of_requests(breaker):
+    # If a few requests fail
+    for _ in range(3):
+        breaker.record(ENDPOINT, False)
+
+    # I expect the circuit to stay closed
+    assert breaker.allow(ENDPOINT)
+
+
+def test_circuit_breaker_probes_endpoints_once_open_duration_passes(breaker, transitions):
+    # Given that the circuit is open
+    for _ in range(4):
+        breaker.record(ENDPOINT, False)
+
+    # If I wait for the open duration to pass
+    time.sleep(0.15)
+
+    # I expect a single probe to be let through
+    assert breaker.allow(ENDPOINT)
+    assert not breaker.allow(ENDPOINT)
+
+    # And the circuit to close once it succeeds
+    breaker.record(ENDPOINT, True)
+    assert breaker.allow(ENDPOINT)
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+
+
+def test_circuit_breaker_reopens_when_probes_fail(breaker, transitions):
+    # Given that the circuit is half-open
+    for _ in range(4):
+        breaker.record(ENDPOINT, False)
+    time.sleep(0.15)
+    assert breaker.allow(ENDPOINT)
+
+    # If the probe fails
+    breaker.record(ENDPOINT, False)
+
+    # I expect the circuit to be open again
+    assert not breaker.allow(ENDPOINT)
+    assert transitions[-1] == (HALF_OPEN, OPEN)
+
+
+def test_circuit_breaker_gives_back_probes_of_cancelled_requests(breaker, transitions):
+    # Given that the circuit is half open
+    for _ in range(4):
+        breaker.record(ENDPOINT, False)
+
+    time.sleep(0.15)
+    assert breaker.allow(ENDPOINT)
+
+    # If the probe gets cancelled
+    breaker.record(ENDPOINT, None)
+
+    # I expect the circuit to stay half open
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN)]
+    # And another probe to be let through
+    assert breaker.allow(ENDPOINT)
+
+
+def test_proxy_fails_fast_while_circuits_are_open(stub_credentials):
+    # Given that I have a proxy with a circuit breaker
+    class BreakingDatastoreRequestsProxy(DatastoreRequestsProxy):
+        CIRCUIT_BREAKER = CircuitBreaker(failure_rate=0.5, min_requests=4, open_duration=60)
+
+    proxy = BreakingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # And an endpoint that's unavailable
+    calls = []
+
+    @urlmatch(netloc=r"example\.com")
+    def handler(netloc, request):
+        calls.append(request.url)
+        return {
+            "status_code": 503,
+            "headers": {"content-type": "application/json"},
+            "content": json.dumps({"error": {"status": "UNAVAILABLE"}}),
+        }
+
+    with HTTMock(handler):
+        # If I make a request to it
+        # I expect the circuit to open and the request to fail fast
+        with pytest.raises(CircuitOpen) as e:
+            proxy.request("POST", "http://example.com/v1/projects/example:runQuery")
+
+        assert len(calls) == 4
+        assert e.value.endpoint == ("example.com", "runQuery")
+
+        # If I make another request
+        # I expect it not to hit the endpoint at all
+        with pytest.raises(CircuitOpen):
+            proxy.request("POST", "http://example.com/v1/projects/example:runQuery")
+
+        assert len(calls) == 4
+
+
+def test_storage_proxy_keys_circuits_by_bucket(stub_credentials):
+    # Given that I have a storage proxy
+    proxy = CloudStorageRequestsProxy(credentials=stub_credentials)
+
+    # If I get the endpoints of requests to different buckets
+    first = proxy._get_endpoint("GET", "https://storage.googleapis.com/storage/v1/b/first/o/example")
+    second = proxy._get_endpoint("GET", "https://storage.googleapis.com/upload/storage/v1/b/second/o")
+
+    # I expect them to be different
+    assert first == ("storage.googleapis.com", "first", "GET")
+    assert second == ("storage.googleapis.com", "second", "GET")
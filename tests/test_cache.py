@@ -0,0 +1,79 @@
+import time
+
+from gcloud_requests import LRUEntityCache
+
+
+def test_lru_entity_cache_counts_hits_and_misses():
+    # Given that I have a cache with a couple of entries
+    cache = LRUEntityCache()
+    cache.set_many({b"a": b"1", b"b": b"2"})
+
+    # If I look up some keys
+    values = cache.get_many([b"a", b"b", b"c"])
+
+    # I expect to get back the cached ones
+    assert values == {b"a": b"1", b"b": b"2"}
+    # And hits and misses to have been counted
+    assert cache.stats() == {"hits": 2, "misses": 1, "evictions": 0}
+
+
+def test_lru_entity_cache_expires_entries():
+    # Given that I have a cache whose entries expire quickly
+    cache = LRUEntityCache(ttl=0.1)
+    cache.set_many({b"a": b"1"})
+
+    # If I wait for the entry to expire
+    time.sleep(0.2)
+
+    # I expect it to be gone
+    assert cache.get_many([b"a"]) == {}
+    assert cache.stats()["evictions"] == 1
+    assert cache.size == 0
+
+
+def test_lru_entity_cache_evicts_least_recently_used_entries():
+    # Given that I have a cache that can hold three entries
+    cache = LRUEntityCache(max_bytes=6)
+    cache.set_many({b"a": b"1", b"b": b"2", b"c": b"3"})
+
+    # If I use the oldest entry and then add another
+    cache.get_many([b"a"])
+    cache.set_many({b"d": b"4"})
+
+    # I expect the least recently used entry to have been evicted
+    assert cache.get_many([b"a", b"b", b"c", b"d"]) == {b"a": b"1", b"c": b"3", b"d": b"4"}
+    assert cache.stats()["evictions"] == 1
+
+
+def test_lru_entity_cache_deletes_entries():
+    # Given that I have a cache with an entry
+    cache = LRUEntityCache()
+    cache.set_many({b"a": b"1"})
+
+    # If I delete it
+    cache.delete_many([b"a", b"b"])
+
+    # I expect it to be gone
+    assert cache.get_many([b"a"]) == {}
+    assert cache.size == 0
+
+
+def test_entity_cache_skips_keys_invalidated_during_reads():
+    # Given that I have an entity cache
+    cache = LRUEntityCache()
+
+    # If a key is invalidated while a read of it is in progress
+    version = cache.begin_read()
+    cache.delete_many([b"a"])
+    cache.set_many({b"a": b"1", b"b": b"2"}, version=version)
+    cache.end_read(version)
+
+    # I expect only the other key to have been cached
+    assert cache.get_many([b"a", b"b"]) == {b"b": b"2"}
+
+    # And reads that start afterwards to be cached as usual
+    version = cache.begin_read()
+    cache.set_many({b"a": b"1"}, version=version)
+    cache.end_read(version)
+    assert cache.get_many([b"a"]) == {b"a": b"1"}
+    assert not cache._invalidated
@@ -1,4 +1,5 @@
 import logging
+import threading
 import time
 
 from datetime import datetime, timedelta
@@ -14,9 +15,11 @@ class StubCredentials(object):
         self.refresh_calls = 0
         self.refresh_every = refresh_every
         self.expiry = None
+        self.token = None
 
     def refresh(self, request):
         self.refresh_calls += 1
+        self.token = "token-{}".format(self.refresh_calls)
         self.expiry = datetime.utcnow() + timedelta(seconds=self.refresh_every)
 
     @property
@@ -46,9 +49,15 @@ class BrokenCredentials(StubCredentials):
         raise RuntimeError("some coding error")
 
 
+def make_watcher():
+    # Refresh credentials only once they expire so that the number of
+    # refreshes in a given amount of time is predictable.
+    return CredentialsWatcher(refresh_fraction=1, refresh_jitter=0)
+
+
 def test_credentials_watcher_refresh_calls_credentials_every_tick():
     # Given that I have a credentials watcher
-    watcher = CredentialsWatcher()
+    watcher = make_watcher()
 
     # And a stub credentials object that needs to be refreshed every second
     credentials = StubCredentials(refresh_every=1)
@@ -65,7 +74,7 @@ def test_credentials_watcher_refresh_calls_credentials_every_tick():
 
 def test_credentials_watcher_refresh_calls_many_credentials_at_once():
     # Given that I have a credentials watcher
-    watcher = CredentialsWatcher()
+    watcher = make_watcher()
 
     # And a couple stub credentials objects at different refresh rates
     credentials_1 = StubCredentials(refresh_every=1)
@@ -86,7 +95,7 @@ def test_credentials_watcher_refresh_calls_many_credentials_at_once():
 
 def test_credentials_watcher_is_resilient_to_refresh_errors():
     # Given that I have a credentials watcher
-    watcher = CredentialsWatcher()
+    watcher = make_watcher()
 
     # And a couple of credentials objects
     # One that always refreshes successfully
@@ -109,7 +118,7 @@ def test_credentials_watcher_is_resilient_to_refresh_errors():
 
 def test_credentials_watcher_is_resilient_to_coding_errors():
     # Given that I have a credentials watcher
-    watcher = CredentialsWatcher()
+    watcher = make_watcher()
 
     # And a couple of credentials objects
     # One that always refreshes successfully
@@ -134,7 +143,7 @@ def test_credentials_watcher_is_resilient_to_coding_errors():
 
 def test_credentials_watcher_can_be_stopped():
     # Given that I have a credentials watcher
-    watcher = CredentialsWatcher()
+    watcher = make_watcher()
 
     # And a stub credentials object that needs to be refreshed once an hour
     credentials = StubCredentials(refresh_every=3600)
@@ -147,3 +156,189 @@ def test_credentials_watcher_can_be_stopped():
 
     # I expect it to stop
     assert not watcher.running
+
+
+class SlowCredentials(StubCredentials):
+    def __init__(self, refresh_every=3600, delay=3):
+        super(SlowCredentials, self).__init__(refresh_every)
+        self.delay = delay
+
+    def refresh(self, request):
+        time.sleep(self.delay)
+        super(SlowCredentials, self).refresh(request)
+
+
+def test_credentials_watcher_deduplicates_shared_credentials():
+    # Given that I have a credentials watcher
+    watcher = make_watcher()
+
+    # And a stub credentials object that needs to be refreshed every second
+    credentials = StubCredentials(refresh_every=1)
+
+    # If I watch that object from many places
+    for _ in range(10):
+        watcher.watch(credentials)
+
+    # And sleep for 3 seconds
+    time.sleep(3)
+
+    # I expect it to have been refreshed as if it were watched once
+    assert credentials.refresh_calls in (3, 4)
+    assert watcher.watch_list == [credentials]
+
+
+def test_credentials_watcher_counts_references_to_shared_credentials():
+    # Given that I have a credentials watcher
+    watcher = make_watcher()
+
+    # And a credentials object that's been watched twice
+    credentials = StubCredentials()
+    watcher.watch(credentials)
+    watcher.watch(credentials)
+
+    # If I unwatch it once
+    watcher.unwatch(credentials)
+
+    # I expect it to still be watched
+    assert watcher.watch_list == [credentials]
+
+    # If I unwatch it again
+    watcher.unwatch(credentials)
+
+    # I expect it to no longer be watched
+    assert watcher.watch_list == []
+
+    # And unwatching it once more to do nothing
+    watcher.unwatch(credentials)
+
+
+def test_credentials_watcher_refreshes_slow_credentials_in_the_background():
+    # Given that I have a credentials watcher
+    watcher = make_watcher()
+
+    # And a credentials object that's slow to refresh
+    slow_credentials = SlowCredentials(refresh_every=1)
+    slow_credentials.expiry = datetime.utcnow() + timedelta(seconds=0.5)
+    # And one that needs to be refreshed every second
+    credentials = StubCredentials(refresh_every=1)
+
+    # If I watch those objects
+    watcher.watch(slow_credentials)
+    watcher.watch(credentials)
+
+    # And sleep for 3 seconds
+    time.sleep(3)
+
+    # I expect the second one to have been refreshed on time
+    assert credentials.refresh_calls in (3, 4)
+    # And the first to still be refreshing
+    assert slow_credentials.refresh_calls == 0
+
+
+def test_credentials_watcher_refreshes_credentials_before_they_expire():
+    # Given that I have a credentials watcher that refreshes tokens half way through their lifetime
+    watcher = CredentialsWatcher(refresh_fraction=0.5, refresh_jitter=0)
+
+    # And a stub credentials object that expires every 2 seconds
+    credentials = StubCredentials(refresh_every=2)
+
+    # If I watch that object
+    watcher.watch(credentials)
+
+    # And sleep for 2.5 seconds
+    time.sleep(2.5)
+
+    # I expect it to have been refreshed every second
+    assert credentials.refresh_calls in (3, 4)
+    # And to never have expired
+    assert credentials.valid
+
+
+def test_credentials_watcher_refreshes_credentials_once_at_a_time():
+    # Given that I have a credentials watcher
+    watcher = CredentialsWatcher()
+
+    # And a credentials object that's slow to refresh
+    credentials = SlowCredentials(delay=0.5)
+
+    # If many threads refresh it at once
+    results = []
+
+    def refresh():
+        results.append(watcher.refresh(credentials))
+
+    threads = [threading.Thread(target=refresh) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # I expect it to have been refreshed once
+    assert credentials.refresh_calls == 1
+    # And every thread to have waited on that refresh
+    assert results == [True] * 10
+
+
+def test_credentials_watcher_skips_refreshes_of_already_replaced_tokens():
+    # Given that I have a credentials watcher
+    watcher = CredentialsWatcher()
+
+    # And a credentials object that's been refreshed since its first token was rejected
+    credentials = StubCredentials()
+    credentials.refresh(None)
+    credentials.refresh(None)
+
+    # If I try to refresh the rejected token
+    # I expect nothing to happen
+    assert not watcher.refresh(credentials, token="token-1")
+    assert credentials.refresh_calls == 2
+
+
+def test_credentials_watcher_propagates_refresh_errors_to_waiting_threads():
+    # Given that I have a credentials watcher
+    watcher = CredentialsWatcher()
+
+    # And a credentials object that fails to refresh slowly
+    class SlowFailingCredentials(SlowCredentials):
+        def refresh(self, request):
+            time.sleep(self.delay)
+            raise RefreshError("refresh failed")
+
+    credentials = SlowFailingCredentials(delay=0.5)
+
+    # If many threads refresh it at once
+    errors = []
+
+    def refresh():
+        try:
+            watcher.refresh(credentials)
+        except RefreshError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=refresh) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # I expect every one of them to see the error
+    assert len(errors) == 5
+
+
+def test_credentials_watcher_keeps_watching_in_forked_children(run_in_child):
+    # Given that I have a credentials watcher
+    watcher = make_watcher()
+
+    # And a stub credentials object that needs to be refreshed every second
+    credentials = StubCredentials(refresh_every=1)
+
+    # If I watch that object and fork
+    watcher.watch(credentials)
+
+    def check():
+        time.sleep(2.5)
+        return watcher.is_alive(), credentials.refresh_calls, credentials.valid
+
+    # I expect the child to have its own watcher thread that keeps refreshing the credentials
+    assert run_in_child(check) in ("(True, 3, True)", "(True, 4, True)")
+    watcher.stop()
@@ -0,0 +1,257 @@
+import threading
+
+import pytest
+
+from concurrent.futures import ThreadPoolExecutor
+from gcloud_requests import DatastoreRequestsProxy, LRUEntityCache, enter_transaction, exit_transaction
+from google.cloud.datastore_v1.proto import datastore_pb2, entity_pb2
+from httmock import HTTMock, urlmatch
+
+LOOKUP_URL = "https://datastore.googleapis.com/v1/projects/example:lookup"
+COMMIT_URL = "https://datastore.googleapis.com/v1/projects/example:commit"
+
+
+class BatchingDatastoreRequestsProxy(DatastoreRequestsProxy):
+    LOOKUP_BATCH_WINDOW = 0.2
+    LOOKUP_BATCH_MAX_KEYS = 10
+
+
+def make_key(name):
+    key = entity_pb2.Key()
+    key.partition_id.namespace_id = "ns"
+    element = key.path.add()
+    element.kind = "Form"
+    element.name = name
+    return key
+
+
+def lookup(proxy, *names):
+    request = datastore_pb2.LookupRequest(project_id="example", keys=[make_key(name) for name in names])
+    response = proxy.request(
+        "POST", LOOKUP_URL,
+        data=request.SerializeToString(),
+        headers={"Content-Type": "application/x-protobuf"},
+    )
+    return datastore_pb2.LookupResponse.FromString(response.content)
+
+
+def commit(proxy, *names):
+    request = datastore_pb2.CommitRequest(project_id="example")
+    for name in names:
+        request.mutations.add().upsert.key.CopyFrom(make_key(name))
+
+    return proxy.request(
+        "POST", COMMIT_URL,
+        data=request.SerializeToString(),
+        headers={"Content-Type": "application/x-protobuf"},
+    )
+
+
+def key_names(keys):
+    return sorted(key.path[0].name for key in keys)
+
+
+def names(results):
+    return key_names(result.entity.key for result in results)
+
+
+@pytest.fixture
+def datastore_server():
+    class server:
+        calls = []
+        commits = []
+        deferred = set()
+        missing = {"missing"}
+        during_lookup = None
+
+    @urlmatch(netloc=r"datastore\.googleapis\.com", path=r".*:commit$")
+    def commit_handler(netloc, request):
+        server.commits.append(datastore_pb2.CommitRequest.FromString(request.body))
+        return {
+            "status_code": 200,
+            "headers": {"content-type": "application/x-protobuf"},
+            "content": datastore_pb2.CommitResponse().SerializeToString(),
+        }
+
+    @urlmatch(netloc=r"datastore\.googleapis\.com", path=r".*:lookup$")
+    def handler(netloc, request):
+        lookup_request = datastore_pb2.LookupRequest.FromString(request.body)
+        server.calls.append(lookup_request)
+        if server.during_lookup is not None:
+            server.during_lookup()
+
+        response = datastore_pb2.LookupResponse()
+        for key in lookup_request.keys:
+            name = key.path[0].name
+            if name in server.deferred:
+                server.deferred.remove(name)
+                response.deferred.add().CopyFrom(key)
+            elif name in server.missing:
+                response.missing.add().entity.key.CopyFrom(key)
+            else:
+                response.found.add().entity.key.CopyFrom(key)
+
+        return {
+            "status_code": 200,
+            "headers": {"content-type": "application/x-protobuf"},
+            "content": response.SerializeToString(),
+        }
+
+    with HTTMock(handler, commit_handler):
+        yield server
+
+
+def test_datastore_proxy_coalesces_concurrent_lookups(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy with lookup batching enabled
+    proxy = BatchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I look up single keys from many threads at once
+    with ThreadPoolExecutor(max_workers=5) as e:
+        responses = list(e.map(lambda name: lookup(proxy, name), ["a", "b", "c", "d", "missing"]))
+
+    # I expect a single RPC to have been made
+    assert len(datastore_server.calls) == 1
+    assert len(datastore_server.calls[0].keys) == 5
+
+    # And each caller to only see the results for its own keys
+    assert [names(response.found) for response in responses[:4]] == [["a"], ["b"], ["c"], ["d"]]
+    assert names(responses[4].missing) == ["missing"]
+    assert not responses[4].found
+
+
+def test_datastore_proxy_splits_batches_at_max_keys(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy with lookup batching enabled
+    proxy = BatchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I look up more keys than fit in one batch
+    with ThreadPoolExecutor(max_workers=6) as e:
+        responses = list(e.map(lambda i: lookup(proxy, str(i), str(i) + "'"), range(6)))
+
+    # I expect more than one RPC to have been made, none over the limit
+    assert len(datastore_server.calls) > 1
+    assert all(len(call.keys) <= 10 for call in datastore_server.calls)
+    # And every key to have been found
+    assert [names(response.found) for response in responses] == [[str(i), str(i) + "'"] for i in range(6)]
+
+
+def test_datastore_proxy_re_requests_deferred_keys(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy with lookup batching enabled
+    proxy = BatchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # And a server that defers one of the keys
+    datastore_server.deferred.add("b")
+
+    # If I look up a couple of keys
+    response = lookup(proxy, "a", "b")
+
+    # I expect the deferred key to have been requested again
+    assert [len(call.keys) for call in datastore_server.calls] == [2, 1]
+    # And both keys to have been found
+    assert names(response.found) == ["a", "b"]
+    assert not response.deferred
+
+
+def test_datastore_proxy_does_not_batch_lookups_in_transactions(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy with lookup batching enabled
+    proxy = BatchingDatastoreRequestsProxy(credentials=stub_credentials)
+    barrier = threading.Barrier(2)
+
+    def lookup_in_transaction(name):
+        enter_transaction()
+        try:
+            barrier.wait()
+            return lookup(proxy, name)
+        finally:
+            exit_transaction()
+
+    # If I look up keys from inside transactions
+    with ThreadPoolExecutor(max_workers=2) as e:
+        list(e.map(lookup_in_transaction, ["a", "b"]))
+
+    # I expect each lookup to have been sent on its own
+    assert len(datastore_server.calls) == 2
+
+
+class CachingDatastoreRequestsProxy(DatastoreRequestsProxy):
+    ENTITY_CACHE = None
+
+
+@pytest.fixture
+def caching_proxy(stub_credentials):
+    CachingDatastoreRequestsProxy.ENTITY_CACHE = LRUEntityCache()
+    return CachingDatastoreRequestsProxy(credentials=stub_credentials)
+
+
+def test_datastore_proxy_answers_lookups_from_the_entity_cache(caching_proxy, datastore_server):
+    # Given that I've looked up a couple of keys through a caching proxy
+    lookup(caching_proxy, "a", "b")
+
+    # If I look them up again along with another key
+    response = lookup(caching_proxy, "a", "b", "c")
+
+    # I expect only the new key to have been requested
+    assert [len(call.keys) for call in datastore_server.calls] == [2, 1]
+    # And all the keys to have been found
+    assert names(response.found) == ["a", "b", "c"]
+
+    # And if I look the first keys up once more
+    response = lookup(caching_proxy, "a", "b")
+
+    # I expect no RPC to have been made
+    assert len(datastore_server.calls) == 2
+    assert names(response.found) == ["a", "b"]
+    # And the cache to have counted its hits and misses
+    assert caching_proxy.ENTITY_CACHE.stats() == {"hits": 4, "misses": 3, "evictions": 0}
+
+
+def test_datastore_proxy_invalidates_committed_keys(caching_proxy, datastore_server):
+    # Given that I've looked up a couple of keys through a caching proxy
+    lookup(caching_proxy, "a", "b")
+
+    # If I commit one of them
+    commit(caching_proxy, "a")
+
+    # Then look them up again
+    response = lookup(caching_proxy, "a", "b")
+
+    # I expect the commit to have been sent
+    assert len(datastore_server.commits) == 1
+    # And the committed key to have been requested again
+    assert [key_names(call.keys) for call in datastore_server.calls] == [["a", "b"], ["a"]]
+    assert names(response.found) == ["a", "b"]
+
+
+def test_datastore_proxy_doesnt_cache_lookups_that_overlap_commits(caching_proxy, datastore_server):
+    # Given that a key gets committed while it's being looked up
+    def commit_once():
+        datastore_server.during_lookup = None
+        commit(caching_proxy, "a")
+
+    datastore_server.during_lookup = commit_once
+
+    # If I look it up through a caching proxy, then look it up again
+    lookup(caching_proxy, "a")
+    lookup(caching_proxy, "a")
+
+    # I expect the result of the first lookup not to have been cached
+    assert len(datastore_server.commits) == 1
+    assert len(datastore_server.calls) == 2
+
+    # And the second lookup to have been cached
+    lookup(caching_proxy, "a")
+    assert len(datastore_server.calls) == 2
+
+
+def test_datastore_proxy_bypasses_the_entity_cache_in_transactions(caching_proxy, datastore_server):
+    # Given that I've looked up a key through a caching proxy
+    lookup(caching_proxy, "a")
+
+    # If I look it up again inside a transaction
+    enter_transaction()
+    try:
+        lookup(caching_proxy, "a")
+    finally:
+        exit_transaction()
+
+    # I expect the cache to have been bypassed
+    assert len(datastore_server.calls) == 2
@@ -0,0 +1,177 @@
+import threading
+import time
+
+import pytest
+
+from gcloud_requests import DatastoreRequestsProxy, enter_transaction, exit_transaction
+from google.cloud.datastore_v1.proto import datastore_pb2, query_pb2
+from httmock import HTTMock, urlmatch
+
+QUERY_URL = "https://datastore.googleapis.com/v1/projects/example:runQuery"
+
+
+class PrefetchingDatastoreRequestsProxy(DatastoreRequestsProxy):
+    QUERY_PREFETCH_DEPTH = 2
+    QUERY_PREFETCH_TIMEOUT = 0.5
+
+
+def make_request(limit=None):
+    request = datastore_pb2.RunQueryRequest(project_id="example")
+    request.query.kind.add().name = "Form"
+    if limit is not None:
+        request.query.limit.value = limit
+    return request
+
+
+def run_query(proxy, request):
+    response = proxy.request(
+        "POST", QUERY_URL,
+        data=request.SerializeToString(),
+        headers={"Content-Type": "application/x-protobuf"},
+    )
+    return datastore_pb2.RunQueryResponse.FromString(response.content).batch
+
+
+def page_through(proxy, request, pages=None):
+    # Continue the query the way google-cloud-datastore does.
+    names = []
+    while pages is None or pages > 0:
+        batch = run_query(proxy, request)
+        names.extend(result.entity.key.path[0].name for result in batch.entity_results)
+        if batch.more_results != query_pb2.QueryResultBatch.NOT_FINISHED:
+            break
+
+        request.query.start_cursor = batch.end_cursor
+        if request.query.HasField("limit"):
+            request.query.limit.value -= len(batch.entity_results)
+        if pages is not None:
+            pages -= 1
+    return names
+
+
+@pytest.fixture
+def datastore_server():
+    class server:
+        entities = 10
+        page_size = 3
+        calls = []
+        lock = threading.Lock()
+
+    @urlmatch(netloc=r"datastore\.googleapis\.com", path=r".*:runQuery$")
+    def handler(netloc, request):
+        query = datastore_pb2.RunQueryRequest.FromString(request.body).query
+        with server.lock:
+            server.calls.append(query)
+
+        start = int(query.start_cursor or b"0")
+        count = server.page_size
+        if query.HasField("limit"):
+            count = min(count, query.limit.value)
+        end = min(start + count, server.entities)
+
+        response = datastore_pb2.RunQueryResponse()
+        batch = response.batch
+        for i in range(start, end):
+            element = batch.entity_results.add().entity.key.path.add()
+            element.kind, element.name = "Form", "e{}".format(i)
+
+        batch.end_cursor = str(end).encode("ascii")
+        if end >= server.entities:
+            batch.more_results = query_pb2.QueryResultBatch.NO_MORE_RESULTS
+        elif query.HasField("limit") and end - start == query.limit.value:
+            batch.more_results = query_pb2.QueryResultBatch.MORE_RESULTS_AFTER_LIMIT
+        else:
+            batch.more_results = query_pb2.QueryResultBatch.NOT_FINISHED
+
+        return {
+            "status_code": 200,
+            "headers": {"content-type": "application/x-protobuf"},
+            "content": response.SerializeToString(),
+        }
+
+    with HTTMock(handler):
+        yield server
+
+
+def wait_for_calls(server, count, timeout=1):
+    deadline = time.time() + timeout
+    while len(server.calls) < count and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    return len(server.calls)
+
+
+def test_datastore_proxy_prefetches_query_pages(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy that prefetches 2 pages of queries
+    proxy = PrefetchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I run a query
+    run_query(proxy, make_request())
+
+    # I expect the next 2 pages to be fetched in the background, but no more
+    assert wait_for_calls(datastore_server, 3) == 3
+    assert [query.start_cursor for query in datastore_server.calls] == [b"", b"3", b"6"]
+
+
+def test_datastore_proxy_serves_prefetched_query_pages(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy that prefetches 2 pages of queries
+    proxy = PrefetchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I page through a query
+    names = page_through(proxy, make_request())
+
+    # I expect to see every result once
+    assert names == ["e{}".format(i) for i in range(10)]
+    # And every page to have been fetched once
+    assert sorted(query.start_cursor for query in datastore_server.calls) == [b"", b"3", b"6", b"9"]
+
+
+def test_datastore_proxy_prefetches_query_pages_within_limits(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy that prefetches 2 pages of queries
+    proxy = PrefetchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I page through a query with a limit
+    names = page_through(proxy, make_request(limit=5))
+
+    # I expect to see results up to the limit
+    assert names == ["e{}".format(i) for i in range(5)]
+    # And no pages past the limit to have been fetched
+    assert wait_for_calls(datastore_server, 3) == 2
+    assert datastore_server.calls[1].limit.value == 2
+
+
+def test_datastore_proxy_drops_unclaimed_query_pages(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy that prefetches 2 pages of queries
+    proxy = PrefetchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # And a much larger result set
+    datastore_server.entities = 100
+
+    # If I stop paging through a query after 2 pages
+    page_through(proxy, make_request(), pages=2)
+
+    # I expect at most 2 pages to have been fetched ahead
+    assert wait_for_calls(datastore_server, 5) == 4
+
+    # If I run another query once the prefetched pages have timed out
+    time.sleep(PrefetchingDatastoreRequestsProxy.QUERY_PREFETCH_TIMEOUT)
+    run_query(proxy, make_request(limit=1))
+
+    # I expect the abandoned pages to have been dropped
+    assert wait_for_calls(datastore_server, 6) == 5
+    assert list(proxy._query_prefetcher._pages) == []
+
+
+def test_datastore_proxy_does_not_prefetch_queries_in_transactions(stub_credentials, datastore_server):
+    # Given that I have a Datastore proxy that prefetches 2 pages of queries
+    proxy = PrefetchingDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I run a query inside a transaction
+    enter_transaction()
+    try:
+        run_query(proxy, make_request())
+    finally:
+        exit_transaction()
+
+    # I expect no pages to have been prefetched
+    assert wait_for_calls(datastore_server, 2) == 1
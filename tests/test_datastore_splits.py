@@ -0,0 +1,285 @@
+import json
+import threading
+
+import pytest
+import requests
+
+from gcloud_requests import DatastoreRequestsProxy, QuerySplitter
+from google.cloud.datastore_v1.proto import datastore_pb2, entity_pb2, query_pb2
+from httmock import HTTMock, urlmatch
+
+PropertyFilter = query_pb2.PropertyFilter
+
+
+def make_key(name):
+    key = entity_pb2.Key()
+    element = key.path.add()
+    element.kind, element.name = "Form", name
+    return key
+
+
+def make_query():
+    query = query_pb2.Query()
+    query.kind.add().name = "Form"
+    return query
+
+
+def key_range(query):
+    filters = [query.filter]
+    if query.filter.WhichOneof("filter_type") == "composite_filter":
+        filters = query.filter.composite_filter.filters
+
+    start = end = None
+    for query_filter in filters:
+        property_filter = query_filter.property_filter
+        if property_filter.property.name == "__key__":
+            name = property_filter.value.key_value.path[0].name
+            if property_filter.op == PropertyFilter.GREATER_THAN_OR_EQUAL:
+                start = name
+            elif property_filter.op == PropertyFilter.LESS_THAN:
+                end = name
+    return start, end
+
+
+@pytest.fixture
+def datastore_server():
+    class server:
+        names = ["e{:03d}".format(i) for i in range(100)]
+        # Every 5th entity has a scatter property, in no particular order.
+        scatter = sorted(names[::5], key=lambda name: name[::-1])
+        page_size = 7
+        queries = []
+        failures = {}
+        lock = threading.Lock()
+
+    @urlmatch(netloc=r"datastore\.googleapis\.com", path=r".*:runQuery$")
+    def handler(netloc, request):
+        query = datastore_pb2.RunQueryRequest.FromString(request.body).query
+        with server.lock:
+            server.queries.append(query)
+
+        if query.order and query.order[0].property.name == "__scatter__":
+            names = server.scatter[:query.limit.value]
+        else:
+            start, end = key_range(query)
+            if server.failures.get(start):
+                server.failures[start] -= 1
+                return {
+                    "status_code": 503,
+                    "headers": {"content-type": "application/json"},
+                    "content": json.dumps({"error": {"code": 503, "status": "UNAVAILABLE"}}),
+                }
+
+            names = [name for name in server.names if (start is None or name >= start) and
+                     (end is None or name < end)]
+
+        offset = int(query.start_cursor or b"0")
+        page = names[offset:offset + server.page_size]
+        response = datastore_pb2.RunQueryResponse()
+        for name in page:
+            response.batch.entity_results.add().entity.key.CopyFrom(make_key(name))
+
+        response.batch.end_cursor = str(offset + len(page)).encode("ascii")
+        if offset + len(page) < len(names):
+            response.batch.more_results = query_pb2.QueryResultBatch.NOT_FINISHED
+        else:
+            response.batch.more_results = query_pb2.QueryResultBatch.NO_MORE_RESULTS
+
+        return {
+            "status_code": 200,
+            "headers": {"content-type": "application/x-protobuf"},
+            "content": response.SerializeToString(),
+        }
+
+    with HTTMock(handler):
+        yield server
+
+
+@pytest.fixture
+def splitter(stub_credentials):
+    with QuerySplitter(DatastoreRequestsProxy(credentials=stub_credentials)) as splitter:
+        yield splitter
+
+
+def names(results):
+    return [result.entity.key.path[0].name for result in results]
+
+
+def test_query_splitter_splits_queries_at_scatter_keys(splitter, datastore_server):
+    # If I split a query into 4 partitions
+    queries = splitter.split("example", make_query(), 4)
+
+    # I expect the scatter keys to have been sampled in order
+    scatter_query = datastore_server.queries[0]
+    assert scatter_query.order[0].property.name == "__scatter__"
+    assert scatter_query.projection[0].property.name == "__key__"
+    assert scatter_query.limit.value == 96
+
+    # And the partitions to be contiguous key ranges split at evenly spaced scatter keys
+    assert [key_range(query) for query in queries] == [
+        (None, "e025"),
+        ("e025", "e050"),
+        ("e050", "e075"),
+        ("e075", None),
+    ]
+
+
+def test_query_splitter_keeps_existing_filters(splitter, datastore_server):
+    # Given that I have a query with an equality filter
+    query = make_query()
+    property_filter = query.filter.property_filter
+    property_filter.property.name = "status"
+    property_filter.op = PropertyFilter.EQUAL
+    property_filter.value.string_value = "active"
+
+    # If I split it
+    queries = splitter.split("example", query, 2)
+
+    # I expect every partition to keep the filter
+    for split_query in queries:
+        filters = split_query.filter.composite_filter.filters
+        assert filters[0].property_filter.property.name == "status"
+        assert len(filters) == 2
+
+
+def test_query_splitter_makes_fewer_partitions_when_there_are_few_scatter_keys(splitter, datastore_server):
+    # Given that only 2 entities have a scatter property
+    datastore_server.scatter = ["e020", "e060"]
+
+    # If I split a query into 8 partitions
+    queries = splitter.split("example", make_query(), 8)
+
+    # I expect 3 partitions
+    assert [key_range(query) for query in queries] == [(None, "e020"), ("e020", "e060"), ("e060", None)]
+
+
+@pytest.mark.parametrize("query_filter,message", [
+    ("limit", "limits or offsets"),
+    ("order", "sort orders"),
+    ("inequality", "inequality filters"),
+])
+def test_query_splitter_rejects_queries_that_cannot_be_split(splitter, query_filter, message):
+    # Given that I have a query that can't be split
+    query = make_query()
+    if query_filter == "limit":
+        query.limit.value = 10
+    elif query_filter == "order":
+        query.order.add().property.name = "created_at"
+    else:
+        query.filter.property_filter.property.name = "created_at"
+        query.filter.property_filter.op = PropertyFilter.GREATER_THAN
+
+    # If I try to split it
+    # I expect a ValueError to be raised
+    with pytest.raises(ValueError) as e:
+        splitter.split("example", query, 4)
+
+    assert message in str(e.value)
+
+
+def test_query_splitter_runs_partitions_in_order(splitter, datastore_server):
+    # If I run a query in 4 partitions
+    results = names(splitter.run("example", make_query(), 4))
+
+    # I expect every result in key order
+    assert results == datastore_server.names
+    # And each partition's 25 results to have been paged through 7 at a time
+    partition_queries = [query for query in datastore_server.queries if not query.order]
+    assert len(partition_queries) == 4 * 4
+
+
+def test_query_splitter_runs_partitions_unordered(splitter, datastore_server):
+    # If I run a query in 4 partitions without ordering
+    results = names(splitter.run("example", make_query(), 4, ordered=False))
+
+    # I expect every result exactly once
+    assert sorted(results) == datastore_server.names
+
+
+def test_query_splitter_retries_failed_partitions(splitter, datastore_server):
+    # Given that the second partition fails once
+    datastore_server.failures["e025"] = 1
+
+    # If I run a query in 4 partitions
+    results = names(splitter.run("example", make_query(), 4))
+
+    # I expect the partition to have been retried
+    assert results == datastore_server.names
+
+
+def test_query_splitter_raises_partition_errors(splitter, datastore_server):
+    # Given that the second partition keeps failing
+    datastore_server.failures["e025"] = 100
+
+    # If I run a query in 4 partitions
+    # I expect an HTTP error to be raised
+    with pytest.raises(requests.HTTPError):
+        list(splitter.run("example", make_query(), 4))
+
+
+def test_query_splitter_stops_partitions_when_iteration_stops(splitter, datastore_server):
+    # Given that I have a much larger result set
+    datastore_server.names = ["e{:05d}".format(i) for i in range(10000)]
+    datastore_server.scatter = datastore_server.names[::100]
+
+    # If I stop iterating after the first result
+    results = splitter.run("example", make_query(), 4)
+    next(results)
+    results.close()
+
+    # I expect the partitions to stop fetching pages soon after
+    splitter.close()
+    partition_queries = [query for query in datastore_server.queries if not query.order]
+    assert len(partition_queries) < 4 * 10
+
+
+def test_query_splitter_runs_partitions_once_iteration_starts(splitter, datastore_server):
+    # If I run a query in 4 partitions but never iterate over its results
+    splitter.run("example", make_query(), 4)
+    splitter.close()
+
+    # I expect no partitions to have been run
+    assert [query for query in datastore_server.queries if not query.order] == []
+
+
+def test_query_splitter_stops_partitions_when_closed(splitter, datastore_server):
+    # Given that I have a much larger result set
+    datastore_server.names = ["e{:05d}".format(i) for i in range(10000)]
+    datastore_server.scatter = datastore_server.names[::100]
+
+    # And that I've started iterating over a query's results
+    results = splitter.run("example", make_query(), 4)
+    next(results)
+
+    # If I close the splitter while the iterator is still open
+    closer = threading.Thread(target=splitter.close)
+    closer.start()
+    closer.join(5)
+
+    # I expect it to have stopped the partitions and shut down
+    assert not closer.is_alive()
+    partition_queries = [query for query in datastore_server.queries if not query.order]
+    assert len(partition_queries) < 4 * 10
+
+
+def test_query_splitter_runs_interleaved_queries_without_deadlocking(stub_credentials, datastore_server):
+    # Given that I have a splitter with few workers and small buffers
+    datastore_server.names = ["e{:04d}".format(i) for i in range(1000)]
+    datastore_server.scatter = datastore_server.names[::50]
+    proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+    with QuerySplitter(proxy, max_workers=4, max_buffered_batches=1) as splitter:
+        # If I consume two ordered queries in lockstep
+        results = []
+
+        def consume():
+            pairs = zip(splitter.run("example", make_query(), 4), splitter.run("example", make_query(), 4))
+            results.extend(pairs)
+
+        consumer = threading.Thread(target=consume)
+        consumer.daemon = True
+        consumer.start()
+        consumer.join(30)
+
+        # I expect both to have run to completion
+        assert not consumer.is_alive()
+        assert len(results) == 1000
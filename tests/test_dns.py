@@ -0,0 +1,76 @@
+import socket
+import time
+
+import pytest
+
+from gcloud_requests import DNSCache
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    lookups = []
+
+    def getaddrinfo(host, port, family=0, type=0, *args):
+        lookups.append(host)
+        if host == "unknown.example.com":
+            raise socket.gaierror("not found")
+        return [
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", port)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.2", port)),
+            (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.1", port)),
+        ]
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+    return lookups
+
+
+def test_dns_cache_caches_lookups(lookups):
+    # Given that I have a DNS cache
+    cache = DNSCache(ttl=60)
+
+    # If I resolve a host many times
+    addresses = [cache.resolve("example.com", 443) for _ in range(4)]
+
+    # I expect it to have been looked up once
+    assert lookups == ["example.com"]
+    # And its addresses to have been used in turn
+    assert addresses == ["10.0.0.1", "10.0.0.2", "10.0.0.1", "10.0.0.2"]
+
+
+def test_dns_cache_expires_lookups(lookups):
+    # Given that I have a DNS cache with a short TTL
+    cache = DNSCache(ttl=0.1)
+
+    # If I resolve a host before and after its TTL is up
+    cache.resolve("example.com", 443)
+    time.sleep(0.2)
+    cache.resolve("example.com", 443)
+
+    # I expect it to have been looked up twice
+    assert lookups == ["example.com", "example.com"]
+
+
+def test_dns_cache_uses_stale_addresses_when_lookups_fail(lookups, monkeypatch):
+    # Given that I have a DNS cache with an expired entry
+    cache = DNSCache(ttl=0)
+    cache.resolve("example.com", 443)
+
+    # If lookups start failing
+    def getaddrinfo(*args):
+        raise socket.gaierror("resolver unavailable")
+
+    monkeypatch.setattr(socket, "getaddrinfo", getaddrinfo)
+
+    # I expect the stale addresses to be used
+    assert cache.resolve("example.com", 443) == "10.0.0.2"
+
+
+def test_dns_cache_passes_through_unresolvable_hosts_and_addresses(lookups):
+    # Given that I have a DNS cache
+    cache = DNSCache()
+
+    # If I resolve a host that doesn't exist and an IP address
+    # I expect them to be returned as-is
+    assert cache.resolve("unknown.example.com", 443) == "unknown.example.com"
+    assert cache.resolve("127.0.0.1", 443) == "127.0.0.1"
+    assert lookups == ["unknown.example.com"]
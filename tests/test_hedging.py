@@ -0,0 +1,176 @@
+import threading
+import time
+
+import pytest
+
+from gcloud_requests import CircuitBreaker, DatastoreRequestsProxy, HedgingPolicy, RequestsProxy
+from gcloud_requests import enter_transaction, exit_transaction, get_pool_manager
+from six.moves import BaseHTTPServer, socketserver
+
+
+class DelayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        with self.server.lock:
+            delay = self.server.delays.pop(0) if self.server.delays else 0
+            self.server.calls += 1
+
+        time.sleep(delay)
+        body = str(delay).encode("ascii")
+        self.send_response(200)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DelayServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = DelayServer(("127.0.0.1", 0), DelayHandler)
+    server.lock = threading.Lock()
+    server.delays = []
+    server.calls = 0
+    server.url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_proxy(credentials, breaker=None, **options):
+    class HedgingRequestsProxy(RequestsProxy):
+        HEDGING_POLICY = HedgingPolicy(percentile=50, min_samples=5, **options)
+        CIRCUIT_BREAKER = breaker
+
+    return HedgingRequestsProxy(credentials=credentials)
+
+
+def pool_stats(server):
+    port = server.server_address[1]
+    return [pool for pool in get_pool_manager().stats()["pools"] if pool["port"] == port]
+
+
+def test_proxy_hedges_slow_requests(stub_credentials, server):
+    # Given that I have a proxy that hedges every slow request
+    proxy = make_proxy(stub_credentials, max_hedge_ratio=1)
+
+    # And it has seen a few fast requests
+    for _ in range(5):
+        proxy.request("GET", server.url)
+
+    # If the next request is slow to respond
+    server.delays = [1]
+    start = time.time()
+    response = proxy.request("GET", server.url)
+
+    # I expect the hedged copy to have won
+    assert time.time() - start < 0.5
+    assert response.content == b"0"
+    assert server.calls == 7
+    assert proxy.HEDGING_POLICY.stats()["hedges"] == 1
+
+    # And the losing copy to have been cancelled and its connection released
+    assert not any(pool["in_use"] for pool in pool_stats(server))
+
+
+def test_proxy_doesnt_count_cancelled_hedges_as_failures(stub_credentials, server):
+    # Given that I have a proxy that hedges every slow request
+    # And whose circuit breaker opens on the first failure
+    breaker = CircuitBreaker(failure_rate=0.1, min_requests=1)
+    proxy = make_proxy(stub_credentials, breaker=breaker, max_hedge_ratio=1)
+    for _ in range(5):
+        proxy.request("GET", server.url)
+
+    # If a request is slow enough to get hedged
+    server.delays = [1]
+    assert proxy.request("GET", server.url).content == b"0"
+
+    # I expect the cancelled copy not to have been counted as a failure
+    endpoint, = breaker.stats()
+    assert breaker.stats()[endpoint]["failures"] == 0
+    # And the next request to go through
+    assert proxy.request("GET", server.url).status_code == 200
+
+
+def test_hedging_policy_sends_the_first_copy_from_the_calling_thread():
+    # Given that I have a policy that hedges every slow request
+    policy = HedgingPolicy(percentile=50, min_samples=5, max_hedge_ratio=1)
+
+    class Response(object):
+        def __init__(self):
+            self.thread = threading.current_thread()
+            self.closed = False
+
+        def close(self):
+            self.closed = True
+
+    for _ in range(5):
+        policy.send("example", lambda cancellation: Response())
+
+    # If I send a request whose hedge is slower than the first copy
+    main_thread, hedges = threading.current_thread(), []
+
+    def send(cancellation):
+        response = Response()
+        if response.thread is main_thread:
+            time.sleep(0.05)
+        else:
+            hedges.append(response)
+            time.sleep(0.2)
+        return response
+
+    response = policy.send("example", send)
+
+    # I expect the first copy to have been sent from my thread and to have won
+    assert response.thread is main_thread
+    assert not response.closed
+    # And the hedge to have been closed once it finished
+    deadline = time.time() + 5
+    while not (hedges and hedges[0].closed):
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+
+def test_proxy_caps_the_ratio_of_hedged_requests(stub_credentials, server):
+    # Given that I have a proxy that never hedges
+    proxy = make_proxy(stub_credentials, max_hedge_ratio=0)
+
+    # And it has seen a few fast requests
+    for _ in range(5):
+        proxy.request("GET", server.url)
+
+    # If the next request is slow to respond
+    server.delays = [0.2]
+    response = proxy.request("GET", server.url)
+
+    # I expect it not to have been hedged
+    assert response.content == b"0.2"
+    assert server.calls == 6
+
+
+def test_datastore_proxy_only_hedges_reads_outside_of_transactions(stub_credentials):
+    # Given that I have a Datastore proxy
+    proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+    url = "https://datastore.googleapis.com/v1/projects/example"
+
+    # I expect lookups and queries to be hedgeable
+    assert proxy._is_hedgeable("POST", url + ":lookup")
+    assert proxy._is_hedgeable("POST", url + ":runQuery")
+    # But not commits
+    assert not proxy._is_hedgeable("POST", url + ":commit")
+
+    # And not reads inside transactions
+    enter_transaction()
+    try:
+        assert not proxy._is_hedgeable("POST", url + ":lookup")
+    finally:
+        exit_transaction()
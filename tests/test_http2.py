@@ -0,0 +1,144 @@
+import asyncio
+import json
+import threading
+
+import pytest
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from gcloud_requests import DatastoreRequestsProxy, get_pool_manager
+from gcloud_requests.http2 import HTTP2Adapter
+from h2.config import H2Configuration
+from h2.connection import H2Connection
+from h2.events import DataReceived, RequestReceived, StreamEnded
+from requests.packages.urllib3.util.retry import Retry
+
+
+class H2Protocol(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.conn = H2Connection(config=H2Configuration(client_side=False, header_encoding="utf-8"))
+
+    def connection_made(self, transport):
+        self.server.connections += 1
+        self.transport = transport
+        self.conn.initiate_connection()
+        self.transport.write(self.conn.data_to_send())
+
+    def data_received(self, data):
+        for event in self.conn.receive_data(data):
+            if isinstance(event, RequestReceived):
+                self.server.calls.append(dict(event.headers))
+            elif isinstance(event, DataReceived):
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, StreamEnded):
+                asyncio.ensure_future(self.respond(event.stream_id))
+        self.transport.write(self.conn.data_to_send())
+
+    async def respond(self, stream_id):
+        await asyncio.sleep(0.05)
+        status, body = self.server.response
+        body = json.dumps(body).encode("utf-8")
+        self.conn.send_headers(stream_id, [
+            (":status", str(status)),
+            ("content-type", "application/json"),
+            ("content-length", str(len(body))),
+        ])
+        self.conn.send_data(stream_id, body, end_stream=True)
+        self.transport.write(self.conn.data_to_send())
+
+
+@pytest.fixture
+def h2_server():
+    class server:
+        calls = []
+        connections = 0
+        response = (200, {"ok": True})
+
+    loop = asyncio.new_event_loop()
+    listener = loop.run_until_complete(loop.create_server(lambda: H2Protocol(server), "127.0.0.1", 0))
+    server.url = "http://127.0.0.1:{}".format(listener.sockets[0].getsockname()[1])
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    listener.close()
+
+
+class HTTP2DatastoreRequestsProxy(DatastoreRequestsProxy):
+    HTTP2 = "prior_knowledge"
+    CONNECTION_POOL_SIZE = 1
+
+
+def test_http2_proxy_multiplexes_requests_over_one_connection(stub_credentials, h2_server):
+    # Given that I have an HTTP/2 Datastore proxy
+    proxy = HTTP2DatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I make many concurrent requests
+    with ThreadPoolExecutor(max_workers=8) as e:
+        responses = list(e.map(lambda _: proxy.request("POST", h2_server.url, data=b"{}"), range(16)))
+
+    # I expect them all to succeed
+    assert [response.json() for response in responses] == [{"ok": True}] * 16
+    # And to have been authenticated
+    assert all(call["authorization"] == "Bearer token-1" for call in h2_server.calls)
+    # And to have shared a single connection
+    assert h2_server.connections == 1
+    # And the proxy's session to use the HTTP/2 adapter
+    assert isinstance(get_pool_manager().get_session(proxy).get_adapter(h2_server.url), HTTP2Adapter)
+
+
+def test_http2_proxy_retries_retriable_json_errors(stub_credentials, h2_server):
+    # Given that I have an HTTP/2 Datastore proxy
+    proxy = HTTP2DatastoreRequestsProxy(credentials=stub_credentials)
+
+    # And a server that always fails with a retriable error
+    h2_server.response = (500, {"error": {"status": "UNAVAILABLE"}})
+
+    # If I make a request
+    response = proxy.request("POST", h2_server.url, data=b"{}")
+
+    # I expect to get back a 500
+    assert response.status_code == 500
+    # And the endpoint to have been called a total of 6 times
+    assert len(h2_server.calls) == 6
+
+
+def test_http2_adapter_backs_off_between_connect_retries(monkeypatch):
+    # Given that I have an HTTP/2 adapter that retries failed connects
+    adapter = HTTP2Adapter(max_retries=Retry(connect=2))
+    session = requests.Session()
+    session.mount("http://", adapter)
+
+    # And that sleeps are recorded
+    sleeps = []
+    monkeypatch.setattr("gcloud_requests.http2.time.sleep", sleeps.append)
+
+    # If I send a request to a port nothing listens on
+    with pytest.raises(requests.exceptions.ConnectionError):
+        session.get("http://127.0.0.1:1")
+
+    # I expect the adapter to have backed off before each retry
+    assert len(sleeps) == 2
+    assert 0 <= sleeps[0] <= 0.0625 and 0 <= sleeps[1] <= 0.125
+
+
+def test_http2_adapter_honors_per_request_tls_settings(h2_server):
+    # Given that I have an HTTP/2 adapter
+    adapter = HTTP2Adapter(prior_knowledge=True)
+    session = requests.Session()
+    session.trust_env = False
+    session.mount("http://", adapter)
+
+    # If I send requests with different verify settings
+    responses = [session.get(h2_server.url, verify=verify) for verify in (True, False, True)]
+
+    # I expect them all to succeed
+    assert [response.json() for response in responses] == [{"ok": True}] * 3
+    # And to have been sent by one client per setting
+    assert adapter.get_client(verify=True) is adapter.get_client(verify=True)
+    assert adapter.get_client(verify=True) is not adapter.get_client(verify=False)
+    assert len(adapter._clients) == 2
+    adapter.close()
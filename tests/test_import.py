@@ -0,0 +1,60 @@
+import json
+import subprocess
+import sys
+
+import google.auth
+
+from gcloud_requests import PubSubRequestsProxy
+from httmock import HTTMock, urlmatch
+
+# Modules that are expensive to import and that should only be loaded
+# once they're needed.
+LAZY_MODULES = ("google.auth", "google.rpc.status_pb2", "google.protobuf", "opentelemetry", "http.server")
+
+
+def run_python(code):
+    return json.loads(subprocess.check_output([sys.executable, "-c", code]).decode("utf-8"))
+
+
+def test_importing_the_package_has_no_side_effects():
+    # If I import the package in a fresh interpreter
+    result = run_python("""if True:
+        import json, sys, threading
+        import gcloud_requests
+        print(json.dumps({"modules": sorted(sys.modules), "threads": threading.active_count()}))
+    """)
+
+    # I expect no expensive dependencies to have been imported
+    assert [module for module in LAZY_MODULES if module in result["modules"]] == []
+    # And no threads to have been started
+    assert result["threads"] == 1
+
+
+def test_proxies_look_up_default_credentials_on_first_use(monkeypatch, stub_credentials):
+    # Given that looking up default credentials is tracked
+    lookups = []
+
+    def default(*args, **kwargs):
+        lookups.append(1)
+        return stub_credentials, "example"
+
+    monkeypatch.setattr(google.auth, "default", default)
+
+    # If I create a proxy without credentials
+    proxy = PubSubRequestsProxy()
+
+    # I expect no credentials to have been looked up
+    assert lookups == []
+
+    # If I make a couple of requests
+    @urlmatch(netloc=r".*example\.com")
+    def request_handler(netloc, request):
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    with HTTMock(request_handler):
+        proxy.request("GET", "http://example.com")
+        proxy.request("GET", "http://example.com")
+
+    # I expect the credentials to have been looked up once
+    assert lookups == [1]
+    assert proxy.credentials is stub_credentials
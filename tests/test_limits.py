@@ -0,0 +1,185 @@
+import json
+import threading
+import time
+
+import pytest
+
+from gcloud_requests import CircuitBreaker, ConcurrencyLimiter, ConcurrencyLimitExceeded, PubSubRequestsProxy
+from httmock import HTTMock, urlmatch
+
+
+def test_limiter_shrinks_when_throttled():
+    # Given that I have a limiter
+    limiter = ConcurrencyLimiter(initial_limit=10, decrease_ratio=0.5)
+
+    # If a request gets throttled
+    limiter.acquire()
+    limiter.release(0.01, throttled=True)
+
+    # I expect the limit to have shrunk
+    assert limiter.limit == 5
+
+
+def test_limiter_grows_while_requests_succeed_at_the_limit():
+    # Given that I have a limiter
+    limiter = ConcurrencyLimiter(initial_limit=2)
+
+    # If I keep it full of successful requests for a while
+    for _ in range(10):
+        limiter.acquire()
+        limiter.acquire()
+        limiter.release(0.01)
+        limiter.release(0.01)
+
+    # I expect the limit to have grown
+    assert limiter.limit > 2
+
+
+def test_limiter_does_not_grow_while_underused():
+    # Given that I have a limiter
+    limiter = ConcurrencyLimiter(initial_limit=10)
+
+    # If I only ever make one request at a time
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.01)
+
+    # I expect the limit not to have changed
+    assert limiter.limit == 10
+
+
+def test_limiter_shrinks_when_latency_rises():
+    # Given that I have a limiter that has seen fast requests
+    limiter = ConcurrencyLimiter(initial_limit=10, decrease_ratio=0.5)
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(0.001)
+
+    # If requests start taking much longer
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(0.1)
+
+    # I expect the limit to have shrunk
+    assert limiter.limit < 10
+
+
+def test_limiter_queues_callers_at_the_limit():
+    # Given that I have a full limiter
+    limiter = ConcurrencyLimiter(initial_limit=1, timeout=5)
+    limiter.acquire()
+
+    # If another caller tries to acquire a slot
+    acquired = threading.Event()
+
+    def acquire():
+        limiter.acquire()
+        acquired.set()
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+
+    # I expect it to wait
+    time.sleep(0.1)
+    assert not acquired.is_set()
+    assert limiter.stats() == {"limit": 1, "in_flight": 1, "waiting": 1}
+
+    # Until a slot is released
+    limiter.release(0.01)
+    thread.join(timeout=5)
+    assert acquired.is_set()
+
+
+def test_limiter_times_out_waiting_callers():
+    # Given that I have a full limiter with a short timeout
+    limiter = ConcurrencyLimiter(initial_limit=1, timeout=0.1)
+    limiter.acquire()
+
+    # If I try to acquire another slot
+    # I expect a ConcurrencyLimitExceeded error to be raised
+    with pytest.raises(ConcurrencyLimitExceeded):
+        limiter.acquire()
+
+
+def test_proxy_shrinks_its_limit_on_resource_exhausted_errors(stub_credentials):
+    # Given that I have a proxy with a concurrency limiter
+    class LimitedPubSubRequestsProxy(PubSubRequestsProxy):
+        CONCURRENCY_LIMITER = ConcurrencyLimiter(initial_limit=10, decrease_ratio=0.5)
+
+    proxy = LimitedPubSubRequestsProxy(credentials=stub_credentials)
+
+    # And an endpoint that's out of quota once
+    calls = []
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        calls.append(1)
+        if len(calls) == 1:
+            return {
+                "status_code": 429,
+                "headers": {"content-type": "application/json"},
+                "content": json.dumps({"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}),
+            }
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    # If I make a request to it
+    url = "https://pubsub.googleapis.com/v1/projects/example/topics/example:publish"
+    with HTTMock(handler):
+        response = proxy.request("POST", url)
+
+    # I expect the request to have been retried
+    assert response.status_code == 200
+    # And the limit to have shrunk
+    assert proxy.CONCURRENCY_LIMITER.stats() == {"limit": 5, "in_flight": 0, "waiting": 0}
+
+
+def test_proxy_limiter_timeouts_do_not_count_against_circuits(stub_credentials):
+    # Given that I have a proxy with a limiter and a circuit breaker
+    class GuardedPubSubRequestsProxy(PubSubRequestsProxy):
+        CONCURRENCY_LIMITER = ConcurrencyLimiter(initial_limit=1, min_limit=1, timeout=0.01)
+        CIRCUIT_BREAKER = CircuitBreaker(failure_rate=0.5, min_requests=2, open_duration=60)
+
+    proxy = GuardedPubSubRequestsProxy(credentials=stub_credentials)
+
+    # And that the limiter's only slot is taken
+    proxy.CONCURRENCY_LIMITER.acquire()
+
+    # If I make a few requests
+    url = "https://pubsub.googleapis.com/v1/projects/example/topics/example:publish"
+    for _ in range(4):
+        # I expect them to time out waiting for a slot
+        with pytest.raises(ConcurrencyLimitExceeded):
+            proxy.request("POST", url)
+
+    # But no failures to have been recorded against the endpoint
+    assert proxy.CIRCUIT_BREAKER.stats() == {}
+
+    # If the slot frees up and I make another request
+    proxy.CONCURRENCY_LIMITER.release()
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    # I expect it to reach the endpoint
+    with HTTMock(handler):
+        assert proxy.request("POST", url).status_code == 200
+
+
+def test_proxy_waits_for_slots_until_its_deadline(stub_credentials):
+    # Given that I have a proxy with a limiter that waits up to 30 seconds for slots
+    class LimitedPubSubRequestsProxy(PubSubRequestsProxy):
+        CONCURRENCY_LIMITER = ConcurrencyLimiter(initial_limit=1, min_limit=1, timeout=30)
+
+    proxy = LimitedPubSubRequestsProxy(credentials=stub_credentials)
+
+    # And that the limiter's only slot is taken
+    proxy.CONCURRENCY_LIMITER.acquire()
+
+    # If I make a request with a short deadline
+    start = time.time()
+    with pytest.raises(ConcurrencyLimitExceeded):
+        proxy.request("POST", "https://pubsub.googleapis.com/v1/projects/example:publish", deadline=0.1)
+
+    # I expect it to have given up at its deadline
+    assert time.time() - start < 1
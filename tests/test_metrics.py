@@ -0,0 +1,221 @@
+import array
+import json
+
+import pytest
+import requests
+
+from gcloud_requests import Instrumentation, MetricsAggregator, PrometheusExporter, PubSubRequestsProxy
+from gcloud_requests import RequestCall
+from httmock import HTTMock, urlmatch
+
+URL = "https://pubsub.googleapis.com/v1/projects/example/topics/example:publish"
+
+
+class RecordingInstrumentation(Instrumentation):
+    def __init__(self):
+        self.events = []
+
+    def before_request(self, call):
+        self.events.append("before_request")
+
+    def before_attempt(self, call, headers):
+        self.events.append("before_attempt")
+        headers["x-attempt"] = str(call.attempts)
+
+    def after_attempt(self, call, response=None, error=None, latency=0, pool_wait=0, connect_time=0):
+        self.events.append("after_attempt")
+
+    def on_retry(self, call, reason, backoff):
+        self.events.append(("on_retry", reason))
+
+    def on_refresh(self, call, latency, error=None):
+        self.events.append("on_refresh")
+
+    def after_request(self, call, response=None, error=None):
+        self.events.append("after_request")
+
+
+def make_proxy(instrumentation, credentials):
+    class InstrumentedPubSubRequestsProxy(PubSubRequestsProxy):
+        INSTRUMENTATION = instrumentation
+
+    return InstrumentedPubSubRequestsProxy(credentials=credentials)
+
+
+def unavailable_once():
+    calls = []
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        calls.append(request.headers.get("x-attempt"))
+        if len(calls) == 1:
+            return {
+                "status_code": 503,
+                "headers": {"content-type": "application/json"},
+                "content": json.dumps({"error": {"code": 503, "status": "UNAVAILABLE"}}),
+            }
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    return calls, handler
+
+
+def test_instrumentation_hooks_are_called_around_every_attempt(stub_credentials):
+    # Given that I have an instrumented proxy
+    instrumentation = RecordingInstrumentation()
+    proxy = make_proxy(instrumentation, stub_credentials)
+
+    # If I make a request that fails once
+    calls, handler = unavailable_once()
+    with HTTMock(handler):
+        response = proxy.request("POST", URL, data=b"{}")
+
+    # I expect the request to have been retried
+    assert response.status_code == 200
+    # And every hook to have been called in order
+    events = [event for event in instrumentation.events if event != "on_refresh"]
+    assert events == [
+        "before_request",
+        "before_attempt",
+        "after_attempt",
+        ("on_retry", "UNAVAILABLE"),
+        "before_attempt",
+        "after_attempt",
+        "after_request",
+    ]
+    # And headers added by hooks to have been sent
+    assert calls == ["1", "2"]
+
+
+def test_instrumentation_is_told_about_failed_requests(stub_credentials):
+    # Given that I have an instrumented proxy
+    instrumentation = RecordingInstrumentation()
+    proxy = make_proxy(instrumentation, stub_credentials)
+
+    # And an endpoint that can't be reached
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        raise requests.ConnectionError("unreachable")
+
+    # If I make a request to it
+    # I expect the error to be raised
+    with HTTMock(handler), pytest.raises(requests.ConnectionError):
+        proxy.request("POST", URL)
+
+    # And the hooks to have been called
+    assert instrumentation.events[-2:] == ["after_attempt", "after_request"]
+
+
+@pytest.mark.parametrize("data,expected_size", [
+    (None, 0),
+    (b"{}", 2),
+    ('{"a": 1}', 8),
+    (memoryview(b"x" * 1024)[256:], 768),
+    (memoryview(array.array("i", [1, 2])), 8),
+])
+def test_request_calls_measure_request_bodies(stub_credentials, data, expected_size):
+    # Given that I have a proxy
+    proxy = make_proxy(MetricsAggregator(), stub_credentials)
+
+    # If I describe a call with the given body
+    call = RequestCall(proxy, "POST", URL, data)
+
+    # I expect its size to be the number of bytes sent
+    assert call.bytes_out == expected_size
+
+
+def test_metrics_aggregator_records_requests(stub_credentials):
+    # Given that I have a proxy instrumented with a metrics aggregator
+    aggregator = MetricsAggregator()
+    proxy = make_proxy(aggregator, stub_credentials)
+
+    # If I make a request that fails once
+    _, handler = unavailable_once()
+    with HTTMock(handler):
+        proxy.request("POST", URL, data=b"{}")
+
+    # I expect metrics to have been recorded for both attempts
+    snapshot = aggregator.snapshot()
+    labels = ("pubsub", "publish")
+    assert snapshot["responses"] == {labels + ("503",): 1, labels + ("200",): 1}
+    assert snapshot["retries"] == {labels + ("UNAVAILABLE",): 1}
+    assert snapshot["bytes_out"] == {labels: 4}
+    assert snapshot["bytes_in"][labels] > 0
+    assert snapshot["attempt_latency"][labels]["count"] == 2
+    assert snapshot["request_latency"][labels]["count"] == 1
+    assert snapshot["pool_wait"][("pubsub",)]["count"] == 2
+
+    # If I reset the aggregator
+    aggregator.reset()
+
+    # I expect its metrics to be gone
+    assert aggregator.snapshot()["responses"] == {}
+
+
+def test_metrics_aggregator_records_credentials_refreshes(stub_credentials):
+    # Given that I have a proxy instrumented with a metrics aggregator
+    aggregator = MetricsAggregator()
+    proxy = make_proxy(aggregator, stub_credentials)
+
+    # And an endpoint that rejects the first request it sees
+    calls = []
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        calls.append(1)
+        if len(calls) == 1:
+            return {"status_code": 401, "content": ""}
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    # If I make a request to it
+    with HTTMock(handler):
+        response = proxy.request("POST", URL)
+
+    # I expect the request to have succeeded after a refresh
+    assert response.status_code == 200
+    snapshot = aggregator.snapshot()
+    assert snapshot["refresh_latency"]["count"] >= 1
+    assert snapshot["refresh_failures"] == 0
+    assert snapshot["responses"][("pubsub", "publish", "401")] == 1
+
+
+def test_prometheus_exporter_renders_metrics(stub_credentials):
+    # Given that I have a proxy instrumented with a metrics aggregator
+    aggregator = MetricsAggregator()
+    proxy = make_proxy(aggregator, stub_credentials)
+
+    # And I've made a request
+    _, handler = unavailable_once()
+    with HTTMock(handler):
+        proxy.request("POST", URL)
+
+    # If I render its metrics
+    output = PrometheusExporter(aggregator).render()
+
+    # I expect them to be in the Prometheus text format
+    assert "# TYPE gcloud_requests_request_duration_seconds histogram" in output
+    assert 'gcloud_requests_request_duration_seconds_count{service="pubsub",method="publish"} 1' in output
+    assert 'gcloud_requests_request_duration_seconds_bucket{service="pubsub",method="publish",le="+Inf"} 1' \
+        in output
+    assert 'gcloud_requests_retries_total{service="pubsub",method="publish",reason="UNAVAILABLE"} 1' in output
+    assert 'gcloud_requests_responses_total{service="pubsub",method="publish",status="200"} 1' in output
+    assert "gcloud_requests_credentials_refresh_failures_total 0" in output
+
+
+def test_prometheus_exporter_serves_metrics():
+    # Given that I have an exporter serving metrics
+    exporter = PrometheusExporter(MetricsAggregator())
+    server = exporter.serve(0)
+
+    try:
+        # If I request its metrics
+        response = requests.get("http://127.0.0.1:{}/metrics".format(server.server_address[1]))
+
+        # I expect them to be rendered
+        assert response.status_code == 200
+        assert response.text == exporter.render()
+
+        # And the server to only listen on the loopback interface
+        assert server.server_address[0] == "127.0.0.1"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,309 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from gcloud_requests import ConnectionPoolManager, DatastoreRequestsProxy, DNSCache, MetricsAggregator
+from gcloud_requests import PubSubRequestsProxy, get_pool_manager
+from requests.packages.urllib3.exceptions import EmptyPoolError
+from six.moves import BaseHTTPServer, socketserver
+
+
+class SlowHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.peak = max(self.server.peak, self.server.in_flight)
+
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.in_flight -= 1
+
+        self.send_response(200)
+        self.send_header("content-length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SlowServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = SlowServer(("127.0.0.1", 0), SlowHandler)
+    server.lock = threading.Lock()
+    server.latency = 0.1
+    server.in_flight = server.peak = server.connections = 0
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_pool_manager_shares_sessions_per_proxy_class(stub_credentials):
+    # Given that I have a pool manager and proxies of two types
+    manager = ConnectionPoolManager()
+    datastore_proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+    pubsub_proxy = PubSubRequestsProxy(credentials=stub_credentials)
+
+    # If I get the Datastore session from many threads
+    with ThreadPoolExecutor(max_workers=8) as e:
+        sessions = set(e.map(lambda _: manager.get_session(datastore_proxy), range(32)))
+
+    # I expect them to share one session
+    assert len(sessions) == 1
+
+    # And the PubSub proxy to get a different one
+    assert manager.get_session(pubsub_proxy) not in sessions
+
+
+def test_pool_manager_reports_connections_in_use_and_idle(stub_credentials, server):
+    # Given that I have a pool manager and a session
+    manager = ConnectionPoolManager()
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+
+    # If I make a couple of concurrent requests
+    with ThreadPoolExecutor(max_workers=4) as e:
+        futures = [e.submit(session.get, server.url) for _ in range(4)]
+        time.sleep(server.latency / 2)
+
+        # I expect all the connections to be in use
+        assert manager.stats()["in_use"] == 4
+
+        for future in futures:
+            assert future.result().status_code == 200
+
+    # And once they're done, I expect them all to be idle
+    stats = manager.stats()
+    assert stats["in_use"] == 0
+    assert stats["idle"] == 4
+    pool, = stats["pools"]
+    assert pool["proxy"] == "DatastoreRequestsProxy"
+    assert pool["host"] == "127.0.0.1"
+    assert pool["in_use"] == 0
+    assert pool["idle"] == 4
+
+
+def test_pool_manager_caps_connections_globally(stub_credentials, server):
+    # Given that I have a pool manager that allows 2 connections at once
+    manager = ConnectionPoolManager(max_connections=2)
+    datastore_session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+    pubsub_session = manager.get_session(PubSubRequestsProxy(credentials=stub_credentials))
+
+    # If I make many concurrent requests through both sessions
+    with ThreadPoolExecutor(max_workers=8) as e:
+        sessions = [datastore_session, pubsub_session] * 4
+        responses = list(e.map(lambda session: session.get(server.url), sessions))
+
+    # I expect them all to succeed
+    assert all(response.status_code == 200 for response in responses)
+    # But no more than 2 of them to have been in flight at once
+    assert server.peak == 2
+    assert manager.stats()["in_use"] == 0
+
+
+def test_pool_manager_times_out_waiting_for_connections(stub_credentials, server):
+    # Given that I have a pool manager that allows 1 connection at once and waits 100ms for it
+    manager = ConnectionPoolManager(max_connections=1, pool_timeout=0.1)
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+
+    # And that the connection is in use by a streamed response
+    streamed = session.get(server.url, stream=True)
+
+    # If I make another request
+    # I expect it to fail once the timeout runs out
+    with pytest.raises(EmptyPoolError):
+        session.get(server.url)
+
+    # If I release the connection
+    streamed.close()
+
+    # I expect it not to be counted as in use
+    assert manager.stats()["in_use"] == 0
+
+    # And subsequent requests to keep working and releasing their connections
+    for _ in range(3):
+        assert session.get(server.url).status_code == 200
+    assert manager.stats()["in_use"] == 0
+
+
+def test_pool_manager_releases_discarded_connections(stub_credentials):
+    # Given that I have a pool manager that allows 1 connection at once
+    manager = ConnectionPoolManager(max_connections=1, pool_timeout=0.1)
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+
+    # If I make requests to a host that refuses connections
+    for _ in range(3):
+        with pytest.raises(requests.ConnectionError):
+            session.get("http://127.0.0.1:1")
+
+    # I expect the failed connections to have been released
+    assert manager.stats()["in_use"] == 0
+
+
+def test_pool_manager_warms_connections(stub_credentials, server):
+    # Given that I have a pool manager
+    manager = ConnectionPoolManager()
+
+    # If I warm 3 connections to a host
+    opened = manager.warm(DatastoreRequestsProxy, server.url, connections=3)
+
+    # I expect them to be open and idle
+    assert opened == 3
+    assert manager.stats()["idle"] == 3
+
+    # And requests to be able to use them
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+    assert session.get(server.url).status_code == 200
+    assert manager.stats()["idle"] == 3
+
+
+def test_pool_manager_drops_inherited_connections_in_forked_children(stub_credentials, server, run_in_child):
+    # Given that I have a pool manager with an idle connection
+    manager = ConnectionPoolManager()
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+    session.get(server.url)
+    assert manager.stats()["idle"] == 1
+
+    # If I fork
+    def check():
+        child_session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+        return manager.stats()["idle"], child_session is session, child_session.get(server.url).status_code
+
+    # I expect the child to start without any connections and to make requests with a new session
+    assert run_in_child(check) == "(0, False, 200)"
+    # And the parent's connection to still be usable
+    assert session.get(server.url).status_code == 200
+    assert manager.stats()["idle"] == 1
+
+
+def test_pool_manager_warms_connections_in_forked_children(server, run_in_child):
+    # Given that I have a pool manager that warms connections after forking
+    manager = ConnectionPoolManager()
+    manager.warm_after_fork(DatastoreRequestsProxy, server.url, connections=2)
+
+    # If I fork
+    def check():
+        for _ in range(50):
+            if manager.stats()["idle"] == 2:
+                break
+            time.sleep(0.05)
+        return manager.stats()["idle"]
+
+    # I expect the child to open the connections
+    assert run_in_child(check) == "2"
+    # But the parent not to
+    assert manager.stats()["idle"] == 0
+
+
+def test_pool_manager_reopens_stale_connections(stub_credentials, server):
+    # Given that I have a pool manager that reopens connections idle for more than 200ms
+    server.latency = 0
+    manager = ConnectionPoolManager(max_idle_time=0.2)
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+
+    # If I make two requests in quick succession
+    session.get(server.url)
+    session.get(server.url)
+
+    # I expect them to have shared a connection
+    assert server.connections == 1
+
+    # If I wait for the connection to go stale and make another request
+    time.sleep(0.3)
+    assert session.get(server.url).status_code == 200
+
+    # I expect a new connection to have been opened
+    assert server.connections == 2
+    assert manager.stats()["reaped"] == 1
+
+
+def test_pool_manager_reaps_idle_connections(stub_credentials, server):
+    # Given that I have a pool manager with a couple of idle connections
+    manager = ConnectionPoolManager(max_idle_time=0.1)
+    manager.warm(DatastoreRequestsProxy, server.url, connections=2)
+
+    # If I reap them before they go stale
+    # I expect nothing to happen
+    assert manager.reap() == 0
+
+    # If I reap them once they've gone stale
+    time.sleep(0.2)
+
+    # I expect them to be closed
+    assert manager.reap() == 2
+    stats = manager.stats()
+    assert stats["idle"] == 0
+    assert stats["reaped"] == 2
+
+    # And requests to open new connections in their place
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+    assert session.get(server.url).status_code == 200
+    assert server.connections == 3
+
+
+def test_pool_manager_resolves_hosts_through_its_dns_cache(stub_credentials, server):
+    # Given that I have a pool manager with a DNS cache
+    dns_cache = DNSCache()
+    manager = ConnectionPoolManager(dns_cache=dns_cache)
+    session = manager.get_session(DatastoreRequestsProxy(credentials=stub_credentials))
+
+    # If I make a request by host name
+    response = session.get("http://localhost:{}".format(server.server_address[1]))
+
+    # I expect it to succeed
+    assert response.status_code == 200
+    # And the host to have been cached
+    assert [host for host, _ in dns_cache._entries] == ["localhost"]
+
+
+def test_proxies_warm_connections_on_construction(stub_credentials, server):
+    # Given that I have a proxy class that warms 2 connections to my server
+    class WarmDatastoreRequestsProxy(DatastoreRequestsProxy):
+        WARM_CONNECTIONS = {server.url: 2}
+
+    # If I create a couple of proxies
+    WarmDatastoreRequestsProxy(credentials=stub_credentials)
+    WarmDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # I expect 2 connections to have been opened
+    assert server.connections == 2
+    pools = get_pool_manager().stats()["pools"]
+    pool, = [pool for pool in pools if pool["proxy"] == "WarmDatastoreRequestsProxy"]
+    assert pool["idle"] == 2
+
+
+def test_proxies_report_connect_time(stub_credentials, server):
+    # Given that I have an instrumented proxy
+    server.latency = 0
+    aggregator = MetricsAggregator()
+
+    class InstrumentedDatastoreRequestsProxy(DatastoreRequestsProxy):
+        INSTRUMENTATION = aggregator
+
+    proxy = InstrumentedDatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I make two requests
+    proxy.request("GET", server.url)
+    proxy.request("GET", server.url)
+
+    # I expect connect time to have been recorded once
+    histogram, = aggregator.snapshot()["connect_time"].values()
+    assert histogram["count"] == 1
+    assert histogram["sum"] > 0
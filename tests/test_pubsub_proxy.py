@@ -1,6 +1,9 @@
 import json
 import pytest
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+from gcloud_requests import PubSubRequestsProxy
 from httmock import HTTMock, urlmatch
 
 
@@ -32,3 +35,30 @@ def test_pubsub_proxy_retries_retriable_json_errors(pubsub_proxy, error_data, ex
 
         # I expect the endpoint to have been called some number of times
         assert sum(calls) == expected_tries
+
+
+def test_pubsub_proxy_refreshes_rejected_tokens_once(stub_credentials):
+    # Given that I have a PubSub Proxy
+    proxy = PubSubRequestsProxy(credentials=stub_credentials)
+    refresh_calls = stub_credentials.refresh_calls
+
+    # And an endpoint that rejects the current token
+    rejected_token = "Bearer {}".format(stub_credentials.token)
+    tokens = []
+
+    @urlmatch(netloc=r".*example\.com")
+    def request_handler(netloc, request):
+        tokens.append(request.headers["authorization"])
+        if request.headers["authorization"] == rejected_token:
+            time.sleep(0.1)
+            return {"status_code": 401}
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    # If many threads make requests with that token at once
+    with HTTMock(request_handler), ThreadPoolExecutor(max_workers=10) as pool:
+        responses = list(pool.map(lambda _: proxy.request("GET", "http://example.com"), range(10)))
+
+    # I expect every request to succeed
+    assert [response.status_code for response in responses] == [200] * 10
+    # And the credentials to have been refreshed only once
+    assert stub_credentials.refresh_calls == refresh_calls + 1
@@ -0,0 +1,157 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+
+from gcloud_requests import PubSubPublisher, PubSubRequestsProxy
+from httmock import HTTMock, urlmatch
+from requests import HTTPError
+
+TOPIC = "projects/example/topics/example"
+
+
+@pytest.fixture
+def pubsub_server():
+    class server:
+        batches = []
+        failures = 0
+        unblocked = threading.Event()
+        unblocked.set()
+
+    lock = threading.Lock()
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com", path=r"^/v1/projects/[^/]+/topics/[^/]+:publish$")
+    def publish(netloc, request):
+        server.unblocked.wait()
+        with lock:
+            if server.failures:
+                server.failures -= 1
+                return {
+                    "status_code": 429,
+                    "headers": {"content-type": "application/json"},
+                    "content": json.dumps({"error": {"code": 429, "status": "RESOURCE_EXHAUSTED"}}),
+                }
+
+            data = [base64.b64decode(message["data"]) for message in json.loads(request.body)["messages"]]
+            server.batches.append(data)
+
+        # Batches may be published concurrently so message ids are
+        # derived from their data rather than from their order.
+        return {
+            "status_code": 200,
+            "headers": {"content-type": "application/json"},
+            "content": json.dumps({"messageIds": ["id-" + item.decode("ascii") for item in data]}),
+        }
+
+    with HTTMock(publish):
+        yield server
+
+
+@pytest.fixture
+def publisher(stub_credentials):
+    proxy = PubSubRequestsProxy(credentials=stub_credentials)
+    publisher = PubSubPublisher(proxy, max_messages=5, max_latency=60)
+    yield publisher
+    publisher.stop()
+
+
+def test_publisher_flushes_full_batches(publisher, pubsub_server):
+    # Given that I have a publisher whose batches hold 5 messages
+
+    # If I publish 10 messages
+    futures = [publisher.publish(TOPIC, str(i).encode("ascii")) for i in range(10)]
+
+    # I expect every future to resolve to its message id
+    assert [future.result(timeout=5) for future in futures] == ["id-{}".format(i) for i in range(10)]
+    # And the messages to have been published in two batches
+    assert sorted(pubsub_server.batches) == [
+        [str(i).encode("ascii") for i in range(5)],
+        [str(i).encode("ascii") for i in range(5, 10)],
+    ]
+
+
+def test_publisher_flushes_batches_after_max_latency(stub_credentials, pubsub_server):
+    # Given that I have a publisher with a short max latency
+    publisher = PubSubPublisher(PubSubRequestsProxy(credentials=stub_credentials), max_latency=0.05)
+
+    # If I publish a single message
+    future = publisher.publish(TOPIC, b"hello", origin="test")
+
+    # I expect it to be published on its own after the max latency
+    assert future.result(timeout=5) == "id-hello"
+    assert pubsub_server.batches == [[b"hello"]]
+    publisher.stop()
+
+
+def test_publisher_drops_cancelled_messages(publisher, pubsub_server):
+    # Given that I've published a few messages
+    futures = [publisher.publish(TOPIC, str(i).encode("ascii")) for i in range(3)]
+
+    # If I cancel one of them before its batch is flushed
+    assert futures[1].cancel()
+    publisher.flush()
+
+    # I expect the other messages to have been published
+    assert futures[0].result(timeout=5) == "id-0"
+    assert futures[2].result(timeout=5) == "id-2"
+    assert futures[1].cancelled()
+    assert pubsub_server.batches == [[b"0", b"2"]]
+
+
+def test_publisher_retries_resource_exhausted_errors(publisher, pubsub_server):
+    # Given that the server is overloaded
+    pubsub_server.failures = 2
+
+    # If I publish a message and flush it
+    future = publisher.publish(TOPIC, b"hello")
+    publisher.flush()
+
+    # I expect it to eventually be published
+    assert future.result(timeout=5) == "id-hello"
+
+
+def test_publisher_applies_backpressure(stub_credentials, pubsub_server):
+    # Given that I have a publisher that allows at most 10 outstanding bytes
+    publisher = PubSubPublisher(
+        PubSubRequestsProxy(credentials=stub_credentials),
+        max_messages=1, max_outstanding_bytes=10,
+    )
+
+    # And the server is slow to respond
+    pubsub_server.unblocked.clear()
+
+    # If I publish enough data to exceed that limit
+    publisher.publish(TOPIC, b"x" * 8)
+    published = threading.Event()
+
+    def publish():
+        publisher.publish(TOPIC, b"x" * 8)
+        published.set()
+
+    thread = threading.Thread(target=publish)
+    thread.start()
+
+    # I expect publishing to block until the first message is published
+    time.sleep(0.1)
+    assert not published.is_set()
+
+    pubsub_server.unblocked.set()
+    thread.join(timeout=5)
+    assert published.is_set()
+    publisher.stop()
+    assert len(pubsub_server.batches) == 2
+
+
+def test_publisher_fails_futures_when_publishing_fails(publisher, pubsub_server):
+    # Given that the server is overloaded for longer than we retry
+    pubsub_server.failures = 10
+
+    # If I publish a message and flush it
+    future = publisher.publish(TOPIC, b"hello")
+    publisher.flush()
+
+    # I expect its future to fail with the last error
+    with pytest.raises(HTTPError):
+        future.result(timeout=10)
@@ -0,0 +1,161 @@
+import base64
+import json
+import threading
+import time
+
+import pytest
+
+from gcloud_requests import PubSubRequestsProxy, PubSubSubscriber
+from httmock import HTTMock, urlmatch
+from six.moves.queue import Empty
+
+SUBSCRIPTION = "projects/example/subscriptions/example"
+
+
+@pytest.fixture
+def pubsub_server():
+    class server:
+        messages = []
+        pulls = []
+        acks = []
+        modifications = []
+
+    lock = threading.Lock()
+
+    def respond(data):
+        return {
+            "status_code": 200,
+            "headers": {"content-type": "application/json"},
+            "content": json.dumps(data),
+        }
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com", path=r"^/v1/projects/[^/]+/subscriptions/[^/]+:pull$")
+    def pull(netloc, request):
+        count = json.loads(request.body)["maxMessages"]
+        with lock:
+            messages, server.messages[:count] = server.messages[:count], []
+            server.pulls.append(count)
+
+        if not messages:
+            # Imitate a long poll.
+            time.sleep(0.01)
+
+        return respond({"receivedMessages": [{
+            "ackId": "ack-" + message,
+            "message": {
+                "messageId": message,
+                "data": base64.b64encode(message.encode("ascii")).decode("ascii"),
+            },
+        } for message in messages]})
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com", path=r"^/v1/projects/[^/]+/subscriptions/[^/]+:acknowledge$")
+    def acknowledge(netloc, request):
+        with lock:
+            server.acks.append(json.loads(request.body)["ackIds"])
+        return respond({})
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com", path=r"^/v1/projects/[^/]+/subscriptions/[^/]+:modifyAck")
+    def modify_ack_deadline(netloc, request):
+        data = json.loads(request.body)
+        with lock:
+            server.modifications.append((data["ackIds"], data["ackDeadlineSeconds"]))
+        return respond({})
+
+    with HTTMock(pull, acknowledge, modify_ack_deadline):
+        yield server
+
+
+@pytest.fixture
+def pubsub_proxy(stub_credentials):
+    return PubSubRequestsProxy(credentials=stub_credentials)
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+
+def test_subscriber_batches_acks(pubsub_proxy, pubsub_server):
+    # Given that I have some messages
+    pubsub_server.messages = ["a", "b", "c"]
+
+    # And a subscriber that flushes acks every second
+    subscriber = PubSubSubscriber(pubsub_proxy, SUBSCRIPTION, flush_interval=1)
+
+    # If I consume and ack every message
+    messages = [subscriber.get(timeout=5) for _ in range(3)]
+    for message in messages:
+        message.ack()
+    subscriber.stop()
+
+    # I expect to have received every message
+    assert [message.data for message in messages] == [b"a", b"b", b"c"]
+    # And their acks to have been sent in a single request
+    assert pubsub_server.acks == [["ack-a", "ack-b", "ack-c"]]
+
+
+def test_subscriber_limits_outstanding_messages(pubsub_proxy, pubsub_server):
+    # Given that I have some messages
+    pubsub_server.messages = ["a", "b", "c", "d", "e"]
+
+    # If I start a subscriber that allows two outstanding messages
+    subscriber = PubSubSubscriber(pubsub_proxy, SUBSCRIPTION, max_messages=2)
+
+    # I expect it to only pull two messages
+    first = subscriber.get(timeout=5)
+    second = subscriber.get(timeout=5)
+    with pytest.raises(Empty):
+        subscriber.get(timeout=0.1)
+    assert pubsub_server.messages == ["c", "d", "e"]
+
+    # And to pull another one after I ack one of them
+    first.ack()
+    assert subscriber.get(timeout=5).data == b"c"
+
+    second.ack()
+    subscriber.stop()
+
+
+def test_subscriber_nacks_messages_that_were_never_handed_out(pubsub_proxy, pubsub_server):
+    # Given that I have some messages
+    pubsub_server.messages = ["a", "b"]
+
+    # And a subscriber that has prefetched them
+    subscriber = PubSubSubscriber(pubsub_proxy, SUBSCRIPTION)
+    wait_for(lambda: not pubsub_server.messages)
+
+    # If I nack one of them and then stop the subscriber
+    subscriber.get(timeout=5).nack()
+    subscriber.stop()
+
+    # I expect both messages to have been made available for redelivery
+    nacked = sum([ack_ids for ack_ids, deadline in pubsub_server.modifications if deadline == 0], [])
+    assert sorted(nacked) == ["ack-a", "ack-b"]
+
+
+def test_subscriber_extends_leases_based_on_processing_times(pubsub_proxy, pubsub_server):
+    # Given that I have a subscriber with short deadlines
+    class ShortLeaseSubscriber(PubSubSubscriber):
+        MIN_ACK_DEADLINE = 0.5
+
+    pubsub_server.messages = ["a", "b"]
+    subscriber = ShortLeaseSubscriber(pubsub_proxy, SUBSCRIPTION, ack_deadline=0.5, flush_interval=0.05)
+
+    # And processing a message takes about 1.5 seconds
+    message = subscriber.get(timeout=5)
+    time.sleep(1.5)
+    message.ack()
+
+    # If I hold on to the next message
+    message = subscriber.get(timeout=5)
+    time.sleep(0.5)
+
+    # I expect its lease to have been extended by the processing time
+    extensions = [deadline for ack_ids, deadline in pubsub_server.modifications if "ack-b" in ack_ids]
+    assert extensions[0] == 1
+    assert extensions[-1] == 2
+
+    message.ack()
+    subscriber.stop()
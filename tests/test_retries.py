@@ -0,0 +1,134 @@
+import json
+import socket
+import time
+
+import pytest
+import requests
+
+from gcloud_requests import DatastoreRequestsProxy, RequestsProxy, RetryBudget
+from httmock import HTTMock, urlmatch
+
+
+def unavailable_handler(calls):
+    @urlmatch(netloc=r".*example\.com")
+    def handler(netloc, request):
+        calls.append(time.time())
+        return {
+            "status_code": 503,
+            "headers": {"content-type": "application/json"},
+            "content": json.dumps({"error": {"status": "UNAVAILABLE"}}),
+        }
+
+    return handler
+
+
+def test_retry_budget_limits_retries():
+    # Given that I have a budget with two tokens that doesn't refill
+    budget = RetryBudget(max_tokens=2, tokens_per_second=0, tokens_per_request=0.5)
+
+    # I expect to be able to withdraw two tokens
+    assert budget.acquire()
+    assert budget.acquire()
+    # But not a third one
+    assert not budget.acquire()
+
+    # If I make two requests
+    budget.deposit()
+    budget.deposit()
+
+    # I expect them to have earned another token
+    assert budget.acquire()
+    assert not budget.acquire()
+
+
+def test_retry_budget_refills_over_time():
+    # Given that I have an empty budget that refills quickly
+    budget = RetryBudget(max_tokens=1, tokens_per_second=100)
+    assert budget.acquire()
+
+    # If I wait for a bit
+    time.sleep(0.05)
+
+    # I expect it to have been refilled
+    assert budget.tokens == 1
+    assert budget.acquire()
+
+
+def test_proxy_backoff_is_jittered(stub_credentials):
+    # Given that I have a proxy
+    proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I compute many backoffs for the same attempt
+    backoffs = [proxy._compute_backoff(3) for _ in range(100)]
+
+    # I expect them to be spread out between 0 and the cap
+    assert all(0 <= backoff <= 0.5 for backoff in backoffs)
+    assert len(set(backoffs)) > 1
+
+
+def test_proxy_stops_retrying_once_the_budget_is_exhausted(stub_credentials, monkeypatch):
+    # Given that the retry budget only has two tokens left
+    budget = RetryBudget(max_tokens=2, tokens_per_second=0, tokens_per_request=0)
+    monkeypatch.setattr(RequestsProxy, "RETRY_BUDGET", budget)
+
+    # If I make a request that keeps failing
+    calls = []
+    proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+    with HTTMock(unavailable_handler(calls)):
+        response = proxy.request("GET", "http://example.com")
+
+    # I expect it to only have been retried twice
+    assert response.status_code == 503
+    assert len(calls) == 3
+
+
+def test_proxy_stops_retrying_before_the_deadline(stub_credentials):
+    # Given that I have a proxy
+    proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I make a request that keeps failing with a short deadline
+    calls = []
+    start = time.time()
+    with HTTMock(unavailable_handler(calls)):
+        response = proxy.request("GET", "http://example.com", deadline=0.3)
+
+    # I expect every attempt to have been made before the deadline
+    assert response.status_code == 503
+    assert all(call - start < 0.3 for call in calls)
+    # And fewer attempts than the retry table allows to have been made
+    assert len(calls) < 6
+
+
+def test_proxy_caps_attempt_timeouts_at_the_deadline(stub_credentials):
+    # Given that I have a proxy
+    proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+
+    # If I compute an attempt's timeouts 1 second before its deadline
+    connect_timeout, read_timeout = proxy._compute_timeout(time.time() + 1)
+
+    # I expect them to be capped
+    assert connect_timeout <= 1
+    assert read_timeout <= 1
+
+
+def test_proxy_stops_retrying_stalled_connects_at_the_deadline(stub_credentials):
+    # Given that I have a server whose accept queue is full, so that new connections stall
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(0)
+    filler = socket.create_connection(listener.getsockname())
+
+    try:
+        # And a proxy
+        proxy = DatastoreRequestsProxy(credentials=stub_credentials)
+
+        # If I make a request to that server with a short deadline
+        start = time.time()
+        with pytest.raises(requests.ConnectionError):
+            proxy.request("GET", "http://127.0.0.1:{}".format(listener.getsockname()[1]), deadline=0.5)
+
+        # I expect the adapter's connect retries to have stopped at the deadline
+        assert time.time() - start < 1
+    finally:
+        filler.close()
+        listener.close()
@@ -0,0 +1,291 @@
+import json
+import os
+import re
+
+import pytest
+
+from gcloud_requests import CloudStorageRequestsProxy, DataCorruption
+from gcloud_requests import crc32c
+from httmock import HTTMock, urlmatch
+
+
+@pytest.fixture
+def storage_proxy(stub_credentials):
+    return CloudStorageRequestsProxy(credentials=stub_credentials)
+
+
+def media_response(server, data, request):
+    start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", request.headers["range"]).groups())
+    server.media_calls.append((start, end))
+    if server.failures.get(start):
+        server.failures[start] -= 1
+        return {"status_code": 503, "content": ""}
+
+    if server.ignore_ranges:
+        return {"status_code": 200, "content": data}
+
+    content = data[start:end + 1]
+    if server.truncations.get(start):
+        # Drop the connection half way through the range.
+        server.truncations[start] -= 1
+        content = content[:len(content) // 2]
+
+    return {
+        "status_code": 206,
+        "headers": {"content-range": "bytes {}-{}/{}".format(start, end, len(data))},
+        "content": content,
+    }
+
+
+@pytest.fixture
+def gcs_server():
+    class server:
+        objects = {}
+        media_calls = []
+        failures = {}
+        truncations = {}
+        ignore_ranges = False
+        corrupt = False
+        uploads = {}
+        upload_failures = {}
+        composed = []
+
+    @urlmatch(netloc=r"storage\.googleapis\.com", path=r"^/storage/v1/b/[^/]+/o/[^/]+$")
+    def handler(netloc, request):
+        name = request.path_url.split("/o/")[1].split("?")[0]
+        data = server.objects[name]
+        if "alt=media" not in request.url:
+            return {
+                "status_code": 200,
+                "headers": {"content-type": "application/json"},
+                "content": json.dumps({
+                    "name": name,
+                    "size": str(len(data)),
+                    "generation": "1",
+                    "crc32c": crc32c.encode(crc32c.extend(0, data) ^ server.corrupt),
+                }),
+            }
+
+        return media_response(server, data, request)
+
+    @urlmatch(netloc=r"storage\.googleapis\.com", path=r"^/upload/storage/v1/b/[^/]+/o$")
+    def start_upload(netloc, request):
+        name = request.url.split("name=")[1]
+        session_id = str(len(server.uploads))
+        server.uploads[session_id] = {"name": name, "data": b""}
+        return {
+            "status_code": 200,
+            "headers": {"location": "https://storage.googleapis.com/upload/session/" + session_id},
+        }
+
+    @urlmatch(netloc=r"storage\.googleapis\.com", path=r"^/upload/session/")
+    def upload_chunk(netloc, request):
+        upload = server.uploads[request.path_url.split("/")[-1]]
+        persisted = len(upload["data"])
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+)", request.headers["content-range"])
+        if match:
+            start, end, size = map(int, match.groups())
+            chunk = bytes(request.body)
+            if start != persisted:
+                return {"status_code": 308, "headers": {"range": "bytes=0-{}".format(persisted - 1)}}
+
+            if server.upload_failures.get(start):
+                # Persist half the chunk before failing.
+                server.upload_failures[start] -= 1
+                upload["data"] += chunk[:len(chunk) // 2]
+                return {"status_code": 503, "content": ""}
+
+            upload["data"] += chunk
+        else:
+            size = int(request.headers["content-range"].split("/")[1])
+
+        if len(upload["data"]) == size:
+            server.objects[upload["name"]] = upload["data"]
+            return {
+                "status_code": 200,
+                "headers": {"content-type": "application/json"},
+                "content": json.dumps({"name": upload["name"], "size": str(size)}),
+            }
+
+        headers = {"range": "bytes=0-{}".format(len(upload["data"]) - 1)} if upload["data"] else {}
+        return {"status_code": 308, "headers": headers}
+
+    @urlmatch(netloc=r"storage\.googleapis\.com", path=r"^/storage/v1/b/[^/]+/o/[^/]+/compose$")
+    def compose(netloc, request):
+        name = request.path_url.split("/o/")[1].split("/")[0]
+        sources = [source["name"] for source in json.loads(request.body)["sourceObjects"]]
+        server.composed.append(sources)
+        server.objects[name] = b"".join(server.objects[source] for source in sources)
+        return {
+            "status_code": 200,
+            "headers": {"content-type": "application/json"},
+            "content": json.dumps({"name": name, "size": str(len(server.objects[name]))}),
+        }
+
+    @urlmatch(netloc=r"storage\.googleapis\.com", method="DELETE")
+    def delete(netloc, request):
+        del server.objects[request.path_url.split("/o/")[1]]
+        return {"status_code": 204}
+
+    with HTTMock(delete, start_upload, upload_chunk, compose, handler):
+        yield server
+
+
+def test_storage_proxy_downloads_ranges_into_a_buffer(storage_proxy, gcs_server):
+    # Given that I have an object
+    data = gcs_server.objects["example"] = os.urandom(1000)
+
+    # And a buffer to download it into
+    buf = bytearray(1000)
+
+    # If I download it in ranges
+    metadata = storage_proxy.download("bucket", "example", buf, chunk_size=128, parallelism=4)
+
+    # I expect the buffer to contain the object
+    assert bytes(buf) == data
+    assert metadata["size"] == "1000"
+    # And every range to have been fetched
+    assert sorted(gcs_server.media_calls) == [(start, min(start + 127, 999)) for start in range(0, 1000, 128)]
+
+
+def test_storage_proxy_downloads_ranges_into_a_file(storage_proxy, gcs_server, tmpdir):
+    # Given that I have an object
+    data = gcs_server.objects["example"] = os.urandom(1000)
+
+    # If I download it to a file
+    filename = str(tmpdir.join("example"))
+    storage_proxy.download("bucket", "example", filename, chunk_size=300)
+
+    # I expect the file to contain the object
+    with open(filename, "rb") as f:
+        assert f.read() == data
+
+
+def test_storage_proxy_retries_failed_ranges_on_their_own(storage_proxy, gcs_server):
+    # Given that I have an object
+    data = gcs_server.objects["example"] = os.urandom(1000)
+
+    # And the server fails the second range twice
+    gcs_server.failures[500] = 2
+
+    # If I download it in two ranges
+    buf = bytearray(1000)
+    storage_proxy.download("bucket", "example", buf, chunk_size=500)
+
+    # I expect the download to succeed
+    assert bytes(buf) == data
+    # And only the failed range to have been retried
+    assert sorted(gcs_server.media_calls) == [(0, 499), (500, 999), (500, 999), (500, 999)]
+
+
+def test_storage_proxy_resumes_interrupted_ranges(storage_proxy, gcs_server):
+    # Given that I have an object
+    data = gcs_server.objects["example"] = os.urandom(1000)
+
+    # And the server drops the second range half way through twice
+    gcs_server.truncations[500] = 1
+    gcs_server.truncations[750] = 1
+
+    # If I download it in two ranges
+    buf = bytearray(1000)
+    storage_proxy.download("bucket", "example", buf, chunk_size=500)
+
+    # I expect the download to succeed
+    assert bytes(buf) == data
+    # And the range to have been resumed from where it left off
+    assert sorted(gcs_server.media_calls) == [(0, 499), (500, 999), (750, 999), (875, 999)]
+
+
+def test_storage_proxy_gives_up_on_ranges_that_keep_being_interrupted(storage_proxy, gcs_server):
+    # Given that I have an object
+    gcs_server.objects["example"] = os.urandom(1000)
+
+    # And the server keeps dropping the second range
+    gcs_server.truncations = {start: 1 for start in range(500, 1000)}
+
+    # If I download it
+    # I expect a DataCorruption error to be raised
+    with pytest.raises(DataCorruption):
+        storage_proxy.download("bucket", "example", bytearray(1000), chunk_size=500)
+
+
+def test_storage_proxy_rejects_responses_to_the_wrong_range(storage_proxy, gcs_server, tmpdir):
+    # Given that I have an object
+    data = gcs_server.objects["example"] = os.urandom(1000)
+
+    # And the server ignores range headers
+    gcs_server.ignore_ranges = True
+
+    # If I download it in ranges
+    # I expect a DataCorruption error to be raised
+    with pytest.raises(DataCorruption):
+        storage_proxy.download("bucket", "example", str(tmpdir.join("example")), chunk_size=500)
+
+    # If I download it in a single range
+    buf = bytearray(1000)
+    storage_proxy.download("bucket", "example", buf, chunk_size=1000)
+
+    # I expect the whole object to be accepted
+    assert bytes(buf) == data
+
+
+def test_storage_proxy_validates_downloads_against_their_checksum(storage_proxy, gcs_server):
+    # Given that I have an object whose content doesn't match its checksum
+    gcs_server.objects["example"] = os.urandom(1000)
+    gcs_server.corrupt = True
+
+    # If I download it
+    # I expect a DataCorruption error to be raised
+    with pytest.raises(DataCorruption):
+        storage_proxy.download("bucket", "example", bytearray(1000), chunk_size=500)
+
+
+CHUNK_SIZE = 256 * 1024
+
+
+def test_storage_proxy_uploads_files_in_chunks(storage_proxy, gcs_server, tmpdir):
+    # Given that I have a file that spans a few chunks
+    data = os.urandom(CHUNK_SIZE * 2 + 100)
+    filename = tmpdir.join("example")
+    filename.write_binary(data)
+
+    # If I upload it
+    metadata = storage_proxy.upload("bucket", "example", str(filename), chunk_size=CHUNK_SIZE)
+
+    # I expect the object to contain the file
+    assert metadata["name"] == "example"
+    assert gcs_server.objects["example"] == data
+
+
+def test_storage_proxy_resumes_uploads_from_the_confirmed_offset(storage_proxy, gcs_server, tmpdir):
+    # Given that I have a file that spans a few chunks
+    data = os.urandom(CHUNK_SIZE * 3)
+    filename = tmpdir.join("example")
+    filename.write_binary(data)
+
+    # And the server fails the second chunk after persisting part of it
+    gcs_server.upload_failures[CHUNK_SIZE] = 1
+
+    # If I upload it
+    storage_proxy.upload("bucket", "example", str(filename), chunk_size=CHUNK_SIZE)
+
+    # I expect the upload to have resumed and the object to contain the file
+    assert gcs_server.objects["example"] == data
+
+
+def test_storage_proxy_uploads_composite_objects_in_parallel(storage_proxy, gcs_server, tmpdir):
+    # Given that I have a file that spans a few chunks
+    data = os.urandom(CHUNK_SIZE * 3 + 100)
+    filename = tmpdir.join("example")
+    filename.write_binary(data)
+
+    # If I upload it in parallel
+    storage_proxy.upload("bucket", "example", str(filename), chunk_size=CHUNK_SIZE, parallelism=4)
+
+    # I expect it to have been uploaded as four parts
+    assert len(gcs_server.composed) == 1
+    assert len(gcs_server.composed[0]) == 4
+    # And the object to contain the file
+    assert gcs_server.objects["example"] == data
+    # And the parts to have been deleted
+    assert list(gcs_server.objects) == ["example"]
@@ -0,0 +1,107 @@
+import json
+import os
+import threading
+
+import pytest
+
+from gcloud_requests import CloudStorageRequestsProxy, get_pool_manager
+from gcloud_requests.streaming import iter_into, readinto
+from six.moves import BaseHTTPServer, socketserver
+
+BODY = os.urandom(3 * 1024 * 1024 + 17)
+
+
+class BodyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.calls.append(self.path)
+        if self.path == "/error" and len(self.server.calls) == 1:
+            body = json.dumps({"error": {"code": 503}}).encode("utf-8")
+            self.send_response(500)
+            self.send_header("content-type", "application/json")
+        else:
+            body = BODY
+            self.send_response(200)
+            self.send_header("content-type", "application/octet-stream")
+
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BodyServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    server = BodyServer(("127.0.0.1", 0), BodyHandler)
+    server.calls = []
+    server.url = "http://127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class StreamingStorageRequestsProxy(CloudStorageRequestsProxy):
+    pass
+
+
+def pool_stats(server):
+    port = server.server_address[1]
+    pool, = [pool for pool in get_pool_manager().stats()["pools"] if pool["port"] == port]
+    return pool
+
+
+def test_readinto_fills_caller_provided_buffers(stub_credentials, server):
+    # Given that I have a proxy
+    proxy = StreamingStorageRequestsProxy(credentials=stub_credentials)
+
+    # If I stream a response into a buffer that's larger than the body
+    buf = bytearray(len(BODY) + 100)
+    response = proxy.request("GET", server.url + "/body", stream=True)
+    read = readinto(response, memoryview(buf)[10:])
+
+    # I expect the whole body to have been read into the buffer
+    assert read == len(BODY)
+    assert buf[10:10 + read] == BODY
+
+    # And the connection to have been handed back to the pool
+    assert pool_stats(server)["in_use"] == 0
+    assert pool_stats(server)["idle"] == 1
+
+
+def test_iter_into_reuses_the_same_buffer(stub_credentials, server):
+    # Given that I have a proxy
+    proxy = StreamingStorageRequestsProxy(credentials=stub_credentials)
+
+    # If I iterate over a streamed response using a small buffer
+    buf = bytearray(64 * 1024)
+    response = proxy.request("GET", server.url + "/body", stream=True)
+    chunks = [bytes(chunk) for chunk in iter_into(response, buf)]
+
+    # I expect every chunk but the last one to fill the buffer
+    assert all(len(chunk) == len(buf) for chunk in chunks[:-1])
+    # And the chunks to make up the body
+    assert b"".join(chunks) == BODY
+
+
+def test_streamed_error_responses_are_still_retried(stub_credentials, server):
+    # Given that I have a proxy
+    proxy = StreamingStorageRequestsProxy(credentials=stub_credentials)
+
+    # If I stream a response whose first attempt fails with a retriable error
+    response = proxy.request("GET", server.url + "/error", stream=True)
+
+    # I expect the request to have been retried
+    assert server.calls == ["/error", "/error"]
+    # And the body of the successful response not to have been read yet
+    assert not response._content_consumed
+    assert readinto(response, bytearray(len(BODY))) == len(BODY)
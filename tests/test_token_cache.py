@@ -0,0 +1,252 @@
+import json
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from datetime import datetime, timedelta
+from gcloud_requests import CredentialsWatcher, SharedTokenCache
+from gcloud_requests import token_cache as token_cache_module
+
+pytestmark = pytest.mark.skipif(token_cache_module.fcntl is None, reason="requires fcntl")
+
+
+class StubCredentials(object):
+    service_account_email = "example@example.iam.gserviceaccount.com"
+
+    def __init__(self, refresh_delay=0, log_path=None):
+        self.refresh_calls = 0
+        self.refresh_delay = refresh_delay
+        self.log_path = log_path
+        self.token = None
+        self.expiry = None
+
+    def refresh(self, request):
+        time.sleep(self.refresh_delay)
+        self.refresh_calls += 1
+        self.token = "token-{}-{}".format(os.getpid(), self.refresh_calls)
+        self.expiry = datetime.utcnow() + timedelta(hours=1)
+        if self.log_path:
+            with open(self.log_path, "a") as f:
+                f.write("refresh\n")
+
+    @property
+    def valid(self):
+        return self.token is not None and self.expiry > datetime.utcnow()
+
+
+@pytest.fixture
+def cache(tmpdir):
+    return SharedTokenCache(str(tmpdir.join("tokens.json")))
+
+
+@pytest.fixture
+def watcher(cache):
+    watcher = CredentialsWatcher(token_cache=cache)
+    yield watcher
+    watcher.stop()
+
+
+def test_shared_token_cache_shares_refreshed_tokens(watcher):
+    # Given that one process has refreshed its credentials
+    credentials_1 = StubCredentials()
+    watcher.refresh(credentials_1)
+
+    # If another process refreshes the same credentials
+    credentials_2 = StubCredentials()
+    watcher.refresh(credentials_2)
+
+    # I expect it to have reused the first token
+    assert credentials_2.refresh_calls == 0
+    assert credentials_2.token == credentials_1.token
+    assert credentials_2.expiry == credentials_1.expiry
+
+
+class StubUserCredentials(StubCredentials):
+    service_account_email = None
+
+    def __init__(self, refresh_token=None):
+        super(StubUserCredentials, self).__init__()
+        self.refresh_token = refresh_token
+
+
+def test_shared_token_cache_keeps_user_tokens_apart(cache, watcher):
+    # Given that one user's credentials have been refreshed
+    credentials_1 = StubUserCredentials("refresh-1")
+    watcher.refresh(credentials_1)
+
+    # If another user's credentials get refreshed
+    credentials_2 = StubUserCredentials("refresh-2")
+    watcher.refresh(credentials_2)
+
+    # I expect them to have gotten a token of their own
+    assert credentials_2.refresh_calls == 1
+    with open(cache.path) as f:
+        assert len(json.load(f)) == 2
+
+    # And the same user's credentials to share the first token
+    credentials_3 = StubUserCredentials("refresh-1")
+    watcher.refresh(credentials_3)
+    assert credentials_3.refresh_calls == 0
+    assert credentials_3.token == credentials_1.token
+
+
+def test_shared_token_cache_bypasses_credentials_it_cant_identify(cache, watcher):
+    # Given that some credentials without a known principal have been refreshed
+    watcher.refresh(StubUserCredentials())
+
+    # If other such credentials get refreshed
+    credentials = StubUserCredentials()
+    watcher.refresh(credentials)
+
+    # I expect them not to have used the cache
+    assert credentials.refresh_calls == 1
+    assert not os.path.exists(cache.path)
+
+
+def test_shared_token_cache_ignores_tokens_that_are_about_to_expire(cache, watcher):
+    # Given that the cache holds a token that's about to expire
+    credentials_1 = StubCredentials()
+    credentials_1.token, credentials_1.expiry = "old-token", datetime.utcnow() + timedelta(seconds=30)
+    with cache.lock():
+        cache.store(credentials_1)
+
+    # If I refresh another credentials object
+    credentials_2 = StubCredentials()
+    watcher.refresh(credentials_2)
+
+    # I expect it to have fetched a new token
+    assert credentials_2.refresh_calls == 1
+    assert credentials_2.token != "old-token"
+
+
+def test_shared_token_cache_ignores_tokens_no_newer_than_the_current_one(watcher):
+    # Given that the cache holds my current token
+    credentials = StubCredentials()
+    watcher.refresh(credentials)
+    token = credentials.token
+
+    # If that token gets rejected and I refresh it
+    watcher.refresh(credentials, token=token)
+
+    # I expect a new token to have been fetched
+    assert credentials.refresh_calls == 2
+    assert credentials.token != token
+
+
+def test_shared_token_cache_recovers_from_corrupt_files(cache, watcher):
+    # Given that the cache file is corrupt
+    with os.fdopen(os.open(cache.path, os.O_WRONLY | os.O_CREAT, 0o600), "w") as f:
+        f.write("{not json")
+
+    # If I refresh some credentials
+    credentials = StubCredentials()
+    watcher.refresh(credentials)
+
+    # I expect them to have been refreshed
+    assert credentials.refresh_calls == 1
+    # And the cache file to have been replaced
+    with open(cache.path) as f:
+        assert list(json.load(f).values())[0]["token"] == credentials.token
+
+
+def test_shared_token_cache_refreshes_directly_when_the_cache_is_unusable(tmpdir):
+    # Given that I have a cache in a directory that doesn't exist
+    cache = SharedTokenCache(str(tmpdir.join("missing", "tokens.json")))
+    watcher = CredentialsWatcher(token_cache=cache)
+
+    # If I refresh some credentials
+    credentials = StubCredentials()
+    watcher.refresh(credentials)
+
+    # I expect them to have been refreshed anyway
+    assert credentials.refresh_calls == 1
+    watcher.stop()
+
+
+def write_cache(path, token, mode):
+    data = {"StubCredentials:{}:".format(StubCredentials.service_account_email): {
+        "token": token,
+        "expiry": time.time() + 3600,
+    }}
+    with open(path, "w") as f:
+        json.dump(data, f)
+    os.chmod(path, mode)
+
+
+def test_shared_token_cache_ignores_files_other_users_can_access(cache, watcher):
+    # Given that the cache file holds a token but is readable by everyone
+    write_cache(cache.path, "planted-token", 0o644)
+
+    # If I refresh some credentials
+    credentials = StubCredentials()
+    watcher.refresh(credentials)
+
+    # I expect the cached token to have been ignored
+    assert credentials.refresh_calls == 1
+    assert credentials.token != "planted-token"
+
+
+def test_shared_token_cache_does_not_follow_symlinks(tmpdir, cache, watcher):
+    # Given that the cache file is a symlink to a file that holds a token
+    write_cache(str(tmpdir.join("elsewhere.json")), "planted-token", 0o600)
+    os.symlink(str(tmpdir.join("elsewhere.json")), cache.path)
+
+    # If I refresh some credentials
+    credentials = StubCredentials()
+    watcher.refresh(credentials)
+
+    # I expect the cached token to have been ignored
+    assert credentials.refresh_calls == 1
+    assert credentials.token != "planted-token"
+
+
+def test_shared_token_cache_writes_private_files(cache, watcher):
+    # If I refresh some credentials
+    watcher.refresh(StubCredentials())
+
+    # I expect the cache file to only be accessible to me
+    assert os.stat(cache.path).st_mode & 0o077 == 0
+    # And no temporary files to have been left behind
+    assert sorted(os.listdir(os.path.dirname(cache.path))) == ["tokens.json", "tokens.json.lock"]
+
+
+def test_shared_token_cache_defaults_to_a_private_directory(tmpdir, monkeypatch):
+    # Given that there's a runtime directory
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmpdir))
+
+    # I expect the cache to default to it
+    assert SharedTokenCache().path == str(tmpdir.join("gcloud_requests-tokens.json"))
+
+    # Given that there's no runtime directory
+    monkeypatch.delenv("XDG_RUNTIME_DIR")
+
+    # I expect the cache to default to a new directory only I can access
+    directory = os.path.dirname(SharedTokenCache().path)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    os.rmdir(directory)
+
+
+def refresh_in_subprocess(cache_path, log_path):
+    watcher = CredentialsWatcher(token_cache=SharedTokenCache(cache_path))
+    watcher.refresh(StubCredentials(refresh_delay=0.2, log_path=log_path))
+
+
+def test_shared_token_cache_refreshes_once_across_processes(tmpdir):
+    # Given that I have many processes
+    cache_path, log_path = str(tmpdir.join("tokens.json")), str(tmpdir.join("refreshes.log"))
+    processes = [
+        multiprocessing.Process(target=refresh_in_subprocess, args=(cache_path, log_path))
+        for _ in range(4)
+    ]
+
+    # If they all refresh the same credentials at once
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    # I expect only one of them to have called the token endpoint
+    with open(log_path) as f:
+        assert f.read() == "refresh\n"
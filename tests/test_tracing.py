@@ -0,0 +1,119 @@
+import json
+
+import pytest
+
+from gcloud_requests import CompositeInstrumentation, MetricsAggregator, PubSubRequestsProxy
+from gcloud_requests import TracingInstrumentation
+from httmock import HTTMock, urlmatch
+
+trace = pytest.importorskip("opentelemetry.sdk.trace")
+in_memory = pytest.importorskip("opentelemetry.sdk.trace.export.in_memory_span_exporter")
+export = pytest.importorskip("opentelemetry.sdk.trace.export")
+
+URL = "https://pubsub.googleapis.com/v1/projects/example/topics/example:publish"
+
+
+@pytest.fixture
+def exporter():
+    return in_memory.InMemorySpanExporter()
+
+
+@pytest.fixture
+def tracing(exporter):
+    provider = trace.TracerProvider()
+    provider.add_span_processor(export.SimpleSpanProcessor(exporter))
+    return TracingInstrumentation(provider.get_tracer("test"))
+
+
+def make_proxy(instrumentation, credentials):
+    class TracedPubSubRequestsProxy(PubSubRequestsProxy):
+        INSTRUMENTATION = instrumentation
+
+    return TracedPubSubRequestsProxy(credentials=credentials)
+
+
+def test_tracing_creates_spans_for_calls_and_attempts(stub_credentials, tracing, exporter):
+    # Given that I have a traced proxy
+    proxy = make_proxy(tracing, stub_credentials)
+
+    # And an endpoint that's unavailable once
+    traceparents = []
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        traceparents.append(request.headers["traceparent"])
+        if len(traceparents) == 1:
+            return {
+                "status_code": 503,
+                "headers": {"content-type": "application/json"},
+                "content": json.dumps({"error": {"code": 503, "status": "UNAVAILABLE"}}),
+            }
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    # If I make a request to it
+    with HTTMock(handler):
+        proxy.request("POST", URL)
+
+    # I expect a span to have been created for the call
+    spans = [span for span in exporter.get_finished_spans() if span.name != "credentials.refresh"]
+    attempts, call = spans[:-1], spans[-1]
+    assert call.name == "pubsub.publish"
+    assert call.attributes["rpc.method"] == "publish"
+    assert call.attributes["http.status_code"] == 200
+    assert call.attributes["gcloud_requests.retry_reason"] == "UNAVAILABLE"
+    assert call.attributes["gcloud_requests.attempts"] == 2
+    assert [event.name for event in call.events] == ["backoff"]
+
+    # And a child span to have been created for every attempt
+    assert [span.attributes["http.status_code"] for span in attempts] == [503, 200]
+    assert all(span.parent.span_id == call.context.span_id for span in attempts)
+
+    # And every attempt to have propagated its own trace context
+    assert [traceparent.split("-")[1:3] for traceparent in traceparents] == [
+        ["{:032x}".format(span.context.trace_id), "{:016x}".format(span.context.span_id)]
+        for span in attempts
+    ]
+
+
+def test_tracing_creates_spans_for_credentials_refreshes(stub_credentials, tracing, exporter):
+    # Given that I have a traced proxy
+    proxy = make_proxy(tracing, stub_credentials)
+
+    # And an endpoint that rejects the first request it sees
+    calls = []
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        calls.append(1)
+        if len(calls) == 1:
+            return {"status_code": 401, "content": ""}
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    # If I make a request to it
+    with HTTMock(handler):
+        proxy.request("POST", URL)
+
+    # I expect the refresh to show up as a child span of the call
+    spans = exporter.get_finished_spans()
+    call = spans[-1]
+    refreshes = [span for span in spans if span.name == "credentials.refresh"]
+    assert refreshes
+    assert all(span.parent.span_id == call.context.span_id for span in refreshes)
+
+
+def test_tracing_can_be_combined_with_other_instrumentation(stub_credentials, tracing, exporter):
+    # Given that I have a proxy that's both traced and measured
+    metrics = MetricsAggregator()
+    proxy = make_proxy(CompositeInstrumentation(tracing, metrics), stub_credentials)
+
+    @urlmatch(netloc=r"pubsub\.googleapis\.com")
+    def handler(netloc, request):
+        return {"status_code": 200, "headers": {"content-type": "application/json"}, "content": "{}"}
+
+    # If I make a request
+    with HTTMock(handler):
+        proxy.request("POST", URL)
+
+    # I expect both instrumentations to have seen it
+    assert exporter.get_finished_spans()[-1].name == "pubsub.publish"
+    assert metrics.snapshot()["responses"] == {("pubsub", "publish", "200"): 1}